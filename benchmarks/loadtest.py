@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import httpx
+import pandas as pd
+
+from serving import QUESTIONS_FILE, summarize
+
+# Load test of the whole serving path: replays the ground-truth questions
+# against a running app and reports throughput, latency percentiles, errors by
+# kind and the rate of rows written to Postgres (from GET /metrics).
+#
+# Questions arrive at --rate per second, as a Poisson process, whether or not
+# earlier ones have been answered; at most --concurrency are in flight and the
+# rest wait. Latency is counted from the moment a question arrived, so waiting
+# for a free slot shows up in it. Without --rate every slot sends its next
+# question as soon as the last one is answered, as in serving.py.
+#
+# With --spawn the test starts its own app under gunicorn, pointed at the fake
+# LLM (fridgechef/fake_openai.py) running in this process, so it needs no
+# network access. Postgres has to be up, unless --no-db is given: the app then
+# only has to have its index loaded, and its writes go to a spool in a
+# temporary directory (see write_behind.py) instead of the database. The
+# --max-* options turn the run into a check: the exit status is 1 when a
+# threshold is exceeded.
+#
+#   python benchmarks/loadtest.py --spawn --rate 20 --requests 400 --llm-latency 0.5 --max-p95 2
+
+FRIDGECHEF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fridgechef")
+
+
+async def run(url, questions, concurrency, num_requests, rate=None, path="/question"):
+    results = []
+    slots = asyncio.Semaphore(concurrency)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+
+        async def ask(question, arrived):
+            async with slots:
+                try:
+                    response = await client.post(f"{url}{path}", json={"question": question})
+                    await response.aread()
+                    outcome = response.status_code
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+            results.append((outcome, time.perf_counter() - arrived))
+
+        t0 = time.perf_counter()
+        if rate:
+            tasks = []
+            arrival = t0
+            for i in range(num_requests):
+                arrival += random.expovariate(rate)
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+                tasks.append(asyncio.create_task(ask(questions[i % len(questions)], arrival)))
+            await asyncio.gather(*tasks)
+        else:
+            next_request = 0
+
+            async def user():
+                nonlocal next_request
+                while next_request < num_requests:
+                    question = questions[next_request % len(questions)]
+                    next_request += 1
+                    await ask(question, time.perf_counter())
+
+            await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    return results, elapsed
+
+
+def rows_written(url):
+    # Sum of fridgechef_db_rows_written_total over all workers, or None
+    try:
+        response = httpx.get(f"{url}/metrics", timeout=10)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    total = 0.0
+    for line in response.text.splitlines():
+        if line.startswith("fridgechef_db_rows_written_total"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def report(results, elapsed, rows_before, rows_after, write_window):
+    latencies = [seconds for outcome, seconds in results if outcome == 200]
+    errors = {}
+    for outcome, _ in results:
+        if outcome != 200:
+            errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+
+    result = summarize(latencies, len(results) - len(latencies), elapsed)
+    result["error_rate"] = round(result["errors"] / len(results), 4) if results else 0.0
+    result["errors_by_kind"] = errors
+    if rows_before is not None and rows_after is not None:
+        result["db_rows_written"] = int(rows_after - rows_before)
+        result["db_write_rate_rows_s"] = round((rows_after - rows_before) / write_window, 2)
+    else:
+        result["db_rows_written"] = None
+        result["db_write_rate_rows_s"] = None
+    return result
+
+
+def failed_checks(result, args):
+    failed = []
+    if args.max_p95 is not None and (result["p95_s"] is None or result["p95_s"] > args.max_p95):
+        failed.append(f"p95 {result['p95_s']} s > {args.max_p95} s")
+    if args.max_p99 is not None and (result["p99_s"] is None or result["p99_s"] > args.max_p99):
+        failed.append(f"p99 {result['p99_s']} s > {args.max_p99} s")
+    if args.max_error_rate is not None and result["error_rate"] > args.max_error_rate:
+        failed.append(f"error rate {result['error_rate']} > {args.max_error_rate}")
+    if args.min_throughput is not None and result["throughput_rps"] < args.min_throughput:
+        failed.append(f"throughput {result['throughput_rps']} req/s < {args.min_throughput} req/s")
+    return failed
+
+
+def start_fake_llm(args):
+    sys.path.insert(0, FRIDGECHEF_DIR)
+    import fake_openai
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = fake_openai.serve(
+        args.llm_port, args.llm_latency, args.llm_error_rate,
+        latency_sigma=args.llm_latency_sigma,
+        token_latency=args.llm_token_latency,
+        completion_tokens=args.llm_completion_tokens,
+        tokens_sigma=args.llm_tokens_sigma,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def app_ready(url, need_db):
+    # GET /ready answers 503 while the database is down; without one, a loaded
+    # index is enough to answer questions
+    response = httpx.get(f"{url}/ready", timeout=5)
+    if response.status_code == 200:
+        return True
+    return not need_db and response.status_code == 503 and response.json()["index"]["loaded"]
+
+
+def start_app(args):
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.llm_port}/v1",
+        "OPENAI_API_KEY": "fake",
+        "APP_PORT": str(args.app_port),
+    })
+    # Repeated questions would be answered from the cache, not the LLM
+    env.setdefault("ANSWER_CACHE", "0")
+    # Metric files of this run only, apart from any app running on the host
+    env["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="fridgechef-loadtest-metrics-")
+    if args.no_db:
+        # Buffer the writes and keep the spool of this run out of the real one,
+        # where it would be replayed into the database later
+        spool = os.path.join(tempfile.mkdtemp(prefix="fridgechef-loadtest-"), "writes.jsonl")
+        env.update({"WRITE_BEHIND": "1", "WRITE_BEHIND_SPOOL": spool})
+        env.pop("WRITE_BEHIND_REJECTED", None)
+    if args.app_module.startswith("asgi"):
+        env.setdefault("GUNICORN_WORKER_CLASS", "asgi")
+
+    process = subprocess.Popen(
+        ["gunicorn", "--config", "gunicorn.conf.py", args.app_module], cwd=FRIDGECHEF_DIR, env=env,
+    )
+    url = f"http://127.0.0.1:{args.app_port}"
+
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"The app exited during startup with status {process.returncode}")
+        try:
+            if app_ready(url, need_db=not args.no_db):
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+
+    process.terminate()
+    hint = "" if args.no_db else "; is Postgres up? (--no-db runs without it)"
+    raise SystemExit(f"The app was not ready after {args.startup_timeout} s{hint}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test /question with the ground-truth questions")
+    parser.add_argument("--url", default="http://localhost:5000", help="App to test, unless --spawn")
+    parser.add_argument("--rate", type=float, help="Questions per second (Poisson arrivals); default: closed loop")
+    parser.add_argument("--concurrency", type=int, default=64, help="Questions in flight at most")
+    parser.add_argument("--requests", type=int, default=500, help="Questions in total")
+    parser.add_argument("--stream", action="store_true", help="Use /question/stream; latency is then to the last byte")
+    parser.add_argument("--shuffle", action="store_true", help="Shuffle the questions")
+    parser.add_argument("--seed", type=int, help="Seed for the arrivals, the shuffle and the fake LLM")
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to wait for buffered writes before reading the row count")
+    parser.add_argument("--label", default="", help="Name of the run in the output")
+
+    spawn = parser.add_argument_group("self-contained run")
+    spawn.add_argument("--spawn", action="store_true", help="Start the fake LLM and the app under gunicorn")
+    spawn.add_argument("--app-module", default="app:app", help="app:app, or asgi:app for async mode")
+    spawn.add_argument("--app-port", type=int, default=5055)
+    spawn.add_argument("--startup-timeout", type=float, default=120.0)
+    spawn.add_argument("--no-db", action="store_true", help="Do not wait for Postgres; writes are spooled to a temporary file")
+    spawn.add_argument("--llm-port", type=int, default=8011)
+    spawn.add_argument("--llm-latency", type=float, default=0.5, help="Median seconds to the first token")
+    spawn.add_argument("--llm-latency-sigma", type=float, default=0.3, help="Spread of the log-normal latency")
+    spawn.add_argument("--llm-token-latency", type=float, default=0.0, help="Seconds per generated token")
+    spawn.add_argument("--llm-completion-tokens", type=int, default=0, help="Median answer length; 0 for the canned answer")
+    spawn.add_argument("--llm-tokens-sigma", type=float, default=0.0, help="Spread of the log-normal answer length")
+    spawn.add_argument("--llm-error-rate", type=float, default=0.0)
+
+    checks = parser.add_argument_group("regression checks")
+    checks.add_argument("--max-p95", type=float, help="Seconds")
+    checks.add_argument("--max-p99", type=float, help="Seconds")
+    checks.add_argument("--max-error-rate", type=float, help="Share of failed questions, 0 to 1")
+    checks.add_argument("--min-throughput", type=float, help="Answered questions per second")
+    args = parser.parse_args()
+    if args.stream and args.spawn and args.app_module.startswith("asgi"):
+        parser.error("asgi:app has no /question/stream; use --app-module app:app with --stream")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    questions = pd.read_csv(QUESTIONS_FILE)["question"].tolist()
+    if args.shuffle:
+        random.shuffle(questions)
+
+    app_process = None
+    url = args.url
+    if args.spawn:
+        start_fake_llm(args)
+        app_process, url = start_app(args)
+
+    try:
+        rows_before = rows_written(url)
+        results, elapsed = asyncio.run(run(
+            url, questions, args.concurrency, args.requests, args.rate,
+            "/question/stream" if args.stream else "/question",
+        ))
+        time.sleep(args.settle)
+        rows_after = rows_written(url)
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait(timeout=30)
+
+    result = {
+        "label": args.label,
+        "url": url,
+        "rate": args.rate,
+        "concurrency": args.concurrency,
+    }
+    result.update(report(results, elapsed, rows_before, rows_after, elapsed + args.settle))
+    failed = failed_checks(result, args)
+    result["failed_checks"] = failed
+
+    print(json.dumps(result))
+    sys.exit(1 if failed else 0)
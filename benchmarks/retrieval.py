@@ -0,0 +1,361 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import platform
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+# Retrieval at scale: builds the index (ingest.load_index) over synthetic
+# corpora of growing size and measures rag.search on them.
+#
+# The corpora are generated from Data/RecipeData.json: every synthetic recipe
+# takes the shape of a real one, with main ingredients drawn from the real ones
+# plus made-up names whose number grows with the corpus, so the vocabulary grows
+# too. Questions are generated from sampled recipes in the style of the
+# ground-truth questions.
+#
+# Every size runs in its own process, so peak RSS is that of one build. The
+# results are compared with a reference scorer: minsearch's per-field cosine
+# similarities over all recipes, plus the fridge coverage counted with sets.
+#
+#   python benchmarks/retrieval.py --sizes 1000 10000 100000 --output retrieval.json
+
+FRIDGECHEF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fridgechef")
+RECIPES_FILE = os.path.join(os.path.dirname(__file__), "..", "Data", "RecipeData.json")
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "ve", "no", "ta", "shi", "bu", "zen", "da", "po", "lin", "ma", "qui", "sa"]
+
+
+def made_up_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+
+
+def zipf_weights(n):
+    # Cumulative; the first names are the most common, as in real recipe collections
+    return list(itertools.accumulate(1.0 / (rank + 1) for rank in range(n)))
+
+
+class CorpusGenerator:
+    def __init__(self, recipes, size, seed=0):
+        self.recipes = recipes
+        self.rng = random.Random(seed)
+
+        real = []
+        self.quantities = {}
+        for recipe in recipes:
+            for item in recipe.get("ingredients_full", []):
+                self.quantities.setdefault(item["item"], []).append(item["quantity"])
+            for name in recipe.get("main_ingredients", []):
+                if name not in real:
+                    real.append(name)
+
+        # About 20 * sqrt(size) new names, e.g. "kalomi pepper"
+        made_up = {
+            f"{made_up_word(self.rng)} {self.rng.choice(real).split()[-1]}" for _ in range(int(20 * size ** 0.5))
+        }
+        self.ingredients = real + sorted(made_up - set(real))
+        self.cum_weights = zipf_weights(len(self.ingredients))
+        self.prefixes = [made_up_word(self.rng).title() for _ in range(max(10, int(size ** 0.5)))]
+        self.tags = sorted({tag for recipe in recipes for tag in recipe.get("tags", [])})
+
+    def sample_ingredients(self, count):
+        names = []
+        while len(names) < count:
+            name = self.rng.choices(self.ingredients, cum_weights=self.cum_weights)[0]
+            if name not in names:
+                names.append(name)
+        return names
+
+    def recipe(self):
+        base = self.rng.choice(self.recipes)
+        main = self.sample_ingredients(self.rng.randint(4, 9))
+        renamed = dict(zip(base.get("main_ingredients", []), main))
+
+        def rename(text):
+            for old, new in renamed.items():
+                text = text.replace(old, new)
+            return text
+
+        other = self.rng.choice(self.recipes)
+        substitutions = {
+            name: self.sample_ingredients(2) for name in self.rng.sample(main, min(2, len(main)))
+        }
+        return {
+            "dish_name": f"{self.rng.choice(self.prefixes)} {main[0].title()} {base['dish_name'].split()[-1]}",
+            "cuisine": base["cuisine"] if self.rng.random() < 0.7 else other["cuisine"],
+            "diet": base["diet"],
+            "tags": sorted(set(base.get("tags", [])) | {self.rng.choice(self.tags)}),
+            "main_ingredients": main,
+            "cooking_time_minutes": max(5, base["cooking_time_minutes"] + 5 * self.rng.randint(-3, 3)),
+            "difficulty": base["difficulty"] if self.rng.random() < 0.7 else other["difficulty"],
+            "ingredients_full": [
+                {"item": name, "quantity": self.rng.choice(self.quantities.get(name, ["1 cup", "2 tbsp", "100g"]))}
+                for name in main
+            ],
+            "instructions": [rename(step) for step in base.get("instructions", [])],
+            "substitutions": substitutions,
+            "flavor_notes": base.get("flavor_notes", ""),
+        }
+
+    def question(self, recipe):
+        kind = self.rng.randrange(4)
+        if kind == 0:
+            names = self.rng.sample(recipe["main_ingredients"], 3)
+            return f"What can I cook with {names[0]}, {names[1]} and {names[2]}?"
+        if kind == 1:
+            return f"What are the main ingredients used in the {recipe['dish_name']} recipe?"
+        if kind == 2:
+            return f"How long does it take to cook the {recipe['dish_name']}?"
+        name = next(iter(recipe["substitutions"]))
+        return f"What can I use instead of {name} in the {recipe['dish_name']}?"
+
+
+def write_corpus(path, recipes, size, num_queries, seed=0):
+    # Streams the corpus to a JSON file; returns [(question, recipe id)]
+    generator = CorpusGenerator(recipes, size, seed)
+    targets = set(generator.rng.sample(range(size), min(num_queries, size)))
+    queries = []
+    with open(path, "w") as f:
+        f.write("[\n")
+        for doc_id in range(size):
+            recipe = generator.recipe()
+            f.write(json.dumps(recipe))
+            f.write(",\n" if doc_id < size - 1 else "\n")
+            if doc_id in targets:
+                queries.append((generator.question(recipe), doc_id))
+        f.write("]\n")
+    generator.rng.shuffle(queries)
+    return queries
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+class ReferenceScorer:
+    # Scores every recipe the slow, obvious way, independently of RecipeIndex:
+    # one cosine similarity per field as minsearch.Index.search computes it,
+    # and the share of each recipe's main ingredients in the fridge from sets
+
+    def __init__(self, ingest, ingredient_index, data_path):
+        recipes = ingest.read_recipes(data_path)
+        texts, _ = ingest.project_recipes(recipes)
+        self.minsearch = ingest.fit_text_index(texts)
+        self.recipe_ingredients = [
+            {ingredient_index.normalize_ingredient(name) for name in recipe.get("main_ingredients", [])} - {""}
+            for recipe in recipes
+        ]
+        self.using = {}
+        for doc_id, names in enumerate(self.recipe_ingredients):
+            for name in names:
+                self.using.setdefault(name, []).append(doc_id)
+
+    def top_k(self, query, fridge, boost_dict, ingredient_boost, num_results):
+        index = self.minsearch
+        scores = np.zeros(len(index.docs))
+        for field in index.text_fields:
+            sim = cosine_similarity(index.vectorizers[field].transform([query]), index.text_matrices[field]).flatten()
+            scores += sim * boost_dict.get(field, 1)
+
+        fridge = set(fridge)
+        for doc_id in {doc_id for name in fridge for doc_id in self.using.get(name, [])}:
+            names = self.recipe_ingredients[doc_id]
+            scores[doc_id] += ingredient_boost * len(names & fridge) / len(names)
+
+        ranked = [doc_id for doc_id in np.lexsort((np.arange(len(scores)), -scores)) if scores[doc_id] > 0]
+        return ranked[:num_results]
+
+
+def measure(data_path, queries, num_results=5, batch_sizes=(1, 32, 256), accuracy_queries=100):
+    # Runs in the worker process for one corpus
+    sys.path.insert(0, FRIDGECHEF_DIR)
+    import ingest
+    import ingredient_index
+    import rag
+
+    index_dir = os.path.join(os.path.dirname(data_path), "index")
+    result = {"baseline_rss_mb": round(rss_mb(), 1)}
+
+    t0 = time.perf_counter()
+    index = ingest.load_index(data_path, index_dir)
+    result["build_seconds"] = round(time.perf_counter() - t0, 3)
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+
+    t0 = time.perf_counter()
+    index = ingest.load_index(data_path, index_dir)
+    result["load_seconds"] = round(time.perf_counter() - t0, 3)
+    result["rss_after_load_mb"] = round(rss_mb(), 1)
+    result["index"] = {
+        "recipes": len(index.docs),
+        "columns": int(index.matrix.shape[1]),
+        "nnz": int(index.matrix.nnz),
+        "ingredients": len(index.ingredients.vocabulary),
+    }
+
+    rag.index = index
+    questions = [question for question, _ in queries]
+
+    # Warm up the caches before timing
+    for question in questions[:10]:
+        rag.search(question)
+
+    latencies = []
+    for question in questions:
+        t0 = time.perf_counter()
+        rag.search(question)
+        latencies.append(time.perf_counter() - t0)
+    result["single"] = percentiles(latencies)
+
+    latencies = []
+    for question in questions:
+        t0 = time.perf_counter()
+        rag.search(question, filters={"diet": "Vegan", "cooking_time_minutes": [["<=", 30]]})
+        latencies.append(time.perf_counter() - t0)
+    result["single_filtered"] = percentiles(latencies)
+
+    result["batched"] = {}
+    for batch_size in batch_sizes:
+        batches = [questions[i : i + batch_size] for i in range(0, len(questions), batch_size)]
+        t0 = time.perf_counter()
+        for batch in batches:
+            rag.search_batch(batch, num_results=num_results)
+        elapsed = time.perf_counter() - t0
+        result["batched"][str(batch_size)] = {
+            "per_query_ms": round(elapsed / len(questions) * 1000, 3),
+            "queries_per_s": round(len(questions) / elapsed, 1),
+        }
+
+    # Accuracy: top-k overlap with the reference, and how often the recipe a
+    # question was generated from is in the top k (for both)
+    sample = queries[:accuracy_queries]
+    if sample:
+        reference = ReferenceScorer(ingest, ingredient_index, data_path)
+        found = rag.search_batch([question for question, _ in sample], num_results=num_results)
+        overlap = exact = hits = reference_hits = 0
+        for (question, target), top_ids in zip(sample, found):
+            fridge = [index.ingredients.vocabulary[i] for i in index.ingredients.match(question)]
+            expected = reference.top_k(question, fridge, rag.DEFAULT_BOOST, rag.INGREDIENT_BOOST, num_results)
+            overlap += len(set(top_ids) & set(expected)) / max(1, len(expected))
+            exact += top_ids == expected
+            hits += target in top_ids
+            reference_hits += target in expected
+        result["accuracy"] = {
+            "queries": len(sample),
+            "k": num_results,
+            "overlap_at_k": round(overlap / len(sample), 4),
+            "exact_ranking": round(exact / len(sample), 4),
+            "hit_rate": round(hits / len(sample), 4),
+            "reference_hit_rate": round(reference_hits / len(sample), 4),
+        }
+
+    return result
+
+
+def run_size(size, args, workdir):
+    with open(RECIPES_FILE) as f:
+        recipes = json.load(f)
+
+    corpus_dir = os.path.join(workdir, str(size))
+    os.makedirs(corpus_dir, exist_ok=True)
+    data_path = os.path.join(corpus_dir, "RecipeData.json")
+
+    t0 = time.perf_counter()
+    queries = write_corpus(data_path, recipes, size, args.queries, args.seed)
+    generate_seconds = time.perf_counter() - t0
+    with open(os.path.join(corpus_dir, "queries.json"), "w") as f:
+        json.dump(queries, f)
+
+    worker = subprocess.run(
+        [sys.executable, __file__, "--worker", corpus_dir, "--accuracy-queries", str(args.accuracy_queries)],
+        capture_output=True, text=True,
+    )
+    if worker.returncode != 0:
+        return {"size": size, "error": worker.stderr.strip().splitlines()[-1] if worker.stderr.strip() else "failed"}
+
+    result = {"size": size, "corpus_mb": round(os.path.getsize(data_path) / 2**20, 1), "generate_seconds": round(generate_seconds, 3)}
+    result.update(json.loads(worker.stdout.strip().splitlines()[-1]))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=FRIDGECHEF_DIR, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark index build and search over synthetic corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Recipes per corpus")
+    parser.add_argument("--queries", type=int, default=500, help="Generated questions per corpus")
+    parser.add_argument("--accuracy-queries", type=int, default=100, help="Questions compared with the reference scorer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Where to write the corpora and indexes (default: a temporary directory)")
+    parser.add_argument("--output", help="Write the JSON here instead of to stdout")
+    parser.add_argument("--label", default="", help="Name of the run in the output")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(os.path.join(args.worker, "queries.json")) as f:
+            queries = [tuple(query) for query in json.load(f)]
+        result = measure(os.path.join(args.worker, "RecipeData.json"), queries, accuracy_queries=args.accuracy_queries)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = [run_size(size, args, workdir) for size in args.sizes]
+
+    import minsearch
+    import scipy
+    import sklearn
+
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "seed": args.seed,
+        "queries": args.queries,
+        "python": platform.python_version(),
+        "versions": {
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "sklearn": sklearn.__version__,
+            "minsearch": minsearch.__version__,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+import httpx
+import pandas as pd
+
+# Throughput of a running app (sync Flask or async ASGI) under concurrent
+# questions, and the memory of the server processes serving it.
+#
+# Point the app at fridgechef/fake_openai.py with a fixed latency, so the
+# numbers measure the serving path and not OpenAI:
+#
+#   python fridgechef/fake_openai.py --port 8000 --latency 1.0
+#   OPENAI_BASE_URL=http://localhost:8000/v1 gunicorn --config gunicorn.conf.py app:app
+#   python benchmarks/serving.py --url http://localhost:5000 --pid <gunicorn master pid>
+#
+# and again with GUNICORN_WORKER_CLASS=asgi ... asgi:app.
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(__file__), "..", "Data", "ground-truth-retrieval.csv")
+
+
+def process_tree(pid):
+    # The pid and all of its descendants
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+
+def memory_mb(pid):
+    # Proportional set size of the server: pages shared between the gunicorn
+    # workers are split between them instead of counted once per worker
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+async def run(url, questions, concurrency, num_requests):
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+
+        async def user():
+            nonlocal next_request, errors
+            while next_request < num_requests:
+                question = questions[next_request % len(questions)]
+                next_request += 1
+
+                t0 = time.perf_counter()
+                try:
+                    response = await client.post(f"{url}/question", json={"question": question})
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - t0)
+                else:
+                    errors += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    return latencies, errors, elapsed
+
+
+def summarize(latencies, errors, elapsed):
+    series = pd.Series(latencies, dtype=float)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_s": round(series.quantile(0.50), 3) if len(series) else None,
+        "p95_s": round(series.quantile(0.95), 3) if len(series) else None,
+        "p99_s": round(series.quantile(0.99), 3) if len(series) else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /question throughput of a running app")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=64, help="Questions in flight")
+    parser.add_argument("--requests", type=int, default=512, help="Questions in total")
+    parser.add_argument("--pid", type=int, help="Server (gunicorn master) pid, to report its memory")
+    parser.add_argument("--label", default="", help="Name of the run in the output")
+    args = parser.parse_args()
+
+    questions = pd.read_csv(QUESTIONS_FILE)["question"].tolist()
+
+    latencies, errors, elapsed = asyncio.run(run(args.url, questions, args.concurrency, args.requests))
+
+    result = {"label": args.label, "url": args.url, "concurrency": args.concurrency}
+    result.update(summarize(latencies, errors, elapsed))
+    if args.pid:
+        result["memory_mb"] = round(memory_mb(args.pid), 1)
+        result["throughput_per_gb"] = round(result["throughput_rps"] / result["memory_mb"] * 1024, 2)
+
+    print(json.dumps(result))
@@ -19,6 +19,37 @@ def ask_question(url, question):
     return response.json()
 
 
+def read_events(response):
+    # Parses a server-sent events stream into (event, data) pairs
+    event = "message"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+            event = "message"
+
+
+def ask_question_stream(url, question):
+    # Prints the answer as it arrives and returns the final response
+    data = {"question": question}
+    result = {}
+    with requests.post(url, json=data, stream=True) as response:
+        if response.status_code != 200:
+            return response.json()
+
+        print("\nAnswer: ", end="", flush=True)
+        for event, payload in read_events(response):
+            if event == "token":
+                print(payload["text"], end="", flush=True)
+            elif event in ("meta", "done", "error"):
+                result.update(payload)
+        print()
+    return result
+
+
 def send_feedback(url, conversation_id, feedback):
     feedback_data = {"conversation_id": conversation_id, "feedback": feedback}
     response = requests.post(f"{url}/feedback", json=feedback_data)
@@ -32,6 +63,9 @@ def main():
     parser.add_argument(
         "--random", action="store_true", help="Use random questions from the CSV file"
     )
+    parser.add_argument(
+        "--stream", action="store_true", help="Print the answer while it is generated"
+    )
     args = parser.parse_args()
 
     base_url = "http://localhost:5000"
@@ -47,8 +81,13 @@ def main():
         else:
             question = questionary.text("Enter your question:").ask()
 
-        response = ask_question(f"{base_url}/question", question)
-        print("\nAnswer:", response.get("answer", "No answer provided"))
+        if args.stream:
+            response = ask_question_stream(f"{base_url}/question/stream", question)
+            if "error" in response:
+                print("\nError:", response["error"])
+        else:
+            response = ask_question(f"{base_url}/question", question)
+            print("\nAnswer:", response.get("answer", "No answer provided"))
 
         conversation_id = response.get("conversation_id", str(uuid.uuid4()))
 
@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict
+
+import metrics
+from ingredient_index import normalize_word
+
+# Words that do not change what a question asks for, so "What can I cook with
+# tomato and onion?" and "what can i make with onions, tomato" share a key
+STOPWORDS = {
+    "a", "an", "and", "any", "are", "can", "cook", "could", "dish", "do", "for", "from",
+    "got", "have", "how", "i", "in", "is", "it", "make", "me", "my", "of", "on", "or",
+    "please", "prepare", "recipe", "some", "something", "suggest", "that", "the", "there",
+    "to", "use", "using", "what", "which", "with", "you",
+}
+
+
+def tokenize(text):
+    # Like ingredient_index.tokenize, but numbers are kept: "pasta for 2" and
+    # "pasta for 6", or "under 20 minutes" and "under 45 minutes", differ
+    return [normalize_word(word) for word in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+def normalize_query(query):
+    # Lowercased, singularized, order-insensitive set of the meaningful words
+    return sorted(set(tokenize(query)) - STOPWORDS)
+
+
+def cache_key(query, doc_ids, namespace=""):
+    # The retrieved ids are part of the key: the same words with different
+    # filters, or after new recipes changed the hits, get a different answer.
+    # The ids are a set: the ranking comes from the raw question, and TF-IDF
+    # orders the same hits differently for "tomato and onion" and "onion, tomato"
+    payload = {
+        "query": normalize_query(query),
+        "doc_ids": sorted({int(i) for i in doc_ids}),
+        "namespace": namespace,
+    }
+    return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    # Generated answers, in two tiers: an LRU dict in the process, and a SQLite
+    # file shared by every worker on the machine. A lookup tries the process
+    # first, then the shared file, and copies shared hits into the process.
+    #
+    # Entries expire after ttl seconds. Every entry records the index snapshot
+    # it was answered from; entries of other snapshots are dropped when a
+    # process opens the file, so new recipe data invalidates the cache.
+
+    def __init__(self, path, snapshot, size=1024, ttl=86400, max_rows=100000):
+        self.path = path
+        self.snapshot = snapshot
+        self.size = size
+        self.ttl = ttl
+        self.max_rows = max_rows
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {"memory_hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    def connection(self):
+        # One connection per thread and process; the first one in a process
+        # also drops stale entries
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                snapshot TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM answers WHERE snapshot != ? OR expires < ?", (self.snapshot, time()))
+
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+        if name in metrics.answer_cache_results:
+            metrics.answer_cache_results[name].inc()
+
+    def get_memory(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                return None
+            answer, expires = entry
+            if expires < time():
+                del self.memory[key]
+                return None
+            self.memory.move_to_end(key)
+            return answer
+
+    def put_memory(self, key, answer, expires):
+        with self.lock:
+            self.memory[key] = (answer, expires)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        answer = self.get_memory(key)
+        if answer is not None:
+            self.count("memory_hits")
+            return answer
+        return self.get_shared(key)
+
+    def get_shared(self, key):
+        # The SQLite tier alone; may wait on another process's write lock
+        try:
+            row = self.connection().execute(
+                "SELECT answer, expires FROM answers WHERE key = ? AND snapshot = ? AND expires >= ?",
+                (key, self.snapshot, time()),
+            ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Answer cache lookup failed: {e}")
+            self.count("errors")
+            row = None
+
+        if row is None:
+            self.count("misses")
+            return None
+
+        answer, expires = row
+        self.put_memory(key, answer, expires)
+        self.count("shared_hits")
+        return answer
+
+    def put(self, key, answer):
+        expires = time() + self.ttl
+        self.put_memory(key, answer, expires)
+
+        try:
+            conn = self.connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, snapshot, answer, expires) VALUES (?, ?, ?, ?)",
+                (key, self.snapshot, answer, expires),
+            )
+            # Keep the file bounded: now and then, drop the entries closest to expiry
+            if self.counters["stores"] % 100 == 0:
+                conn.execute(
+                    """
+                    DELETE FROM answers WHERE key IN (
+                        SELECT key FROM answers ORDER BY expires DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_rows,),
+                )
+        except (sqlite3.Error, OSError) as e:
+            print(f"Answer cache store failed: {e}")
+            self.count("errors")
+            return
+        self.count("stores")
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        self.connection().execute("DELETE FROM answers")
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result["memory_entries"] = len(self.memory)
+        lookups = result["memory_hits"] + result["shared_hits"] + result["misses"]
+        result["hit_rate"] = (result["memory_hits"] + result["shared_hits"]) / lookups if lookups else 0.0
+        return result
@@ -1,23 +1,55 @@
+import json
 import uuid
-from flask import Flask, request, jsonify
-from rag import rag
+from time import time
+from flask import Flask, Response, request, jsonify, stream_with_context, g
+from rag import rag, rag_stream, cache_stats
 
 import db
+import evaluator
+import metrics
+import warmup
+import write_behind
+from llm_client import LLMError, LLMBusyError
 
 app = Flask(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.t0 = time()
+
+
+@app.after_request
+def record_request(response):
+    # Labelled by route, not path, so unknown paths share one series
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe_request(endpoint, response.status_code, time() - g.t0)
+    return response
+
+
 @app.route("/question", methods=["POST"])
 def handle_question():
     data = request.json
+    if not isinstance(data, dict):
+        return not_an_object()
     question = data["question"]
 
     if not question:
         return jsonify({"error": "No question provided"}), 400
 
+    # Optional structured filters, e.g. {"diet": "Vegan", "cooking_time_minutes": [["<=", 30]]}
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        return jsonify({"error": "filters must be an object"}), 400
+
     conversation_id = str(uuid.uuid4())
 
-    answer_data = rag(question)
+    try:
+        answer_data = rag(question, filters=filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LLMError as e:
+        return llm_error(e)
 
     result = {
         "conversation_id": conversation_id,
@@ -25,25 +57,98 @@ def handle_question():
         "answer": answer_data["answer"],
     }
 
-    db.save_conversation(
+    write_behind.save_conversation(
         conversation_id=conversation_id,
         question=question,
         answer_data=answer_data,
     )
+    if not answer_data["cached"]:
+        evaluator.submit(conversation_id, question, answer_data["answer"], answer_data["model_used"])
 
     return jsonify(result)
 
 
+def not_an_object():
+    return jsonify({"error": "The request body must be a JSON object"}), 400
+
+
+def llm_error(e):
+    # The model did not answer in time or kept failing; tell the client to retry
+    headers = {"Retry-After": "1" if isinstance(e, LLMBusyError) else "5"}
+    return jsonify({"error": str(e)}), 503, headers
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/question/stream", methods=["POST"])
+def handle_question_stream():
+    # Same as /question, but the answer is sent as server-sent events while it is
+    # generated: "meta", then "retrieved", one "token" per chunk and a final "done"
+    data = request.json
+    if not isinstance(data, dict):
+        return not_an_object()
+    question = data["question"]
+
+    if not question:
+        return jsonify({"error": "No question provided"}), 400
+
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        return jsonify({"error": "filters must be an object"}), 400
+
+    conversation_id = str(uuid.uuid4())
+
+    # Run retrieval before the response starts, so bad filters still get a 400
+    events = rag_stream(question, filters=filters)
+    try:
+        retrieved = next(events)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        yield sse("meta", {"conversation_id": conversation_id, "question": question})
+        yield sse("retrieved", {"recipes": retrieved["recipes"]})
+
+        try:
+            for event in events:
+                if event["type"] == "token":
+                    yield sse("token", {"text": event["text"]})
+                elif event["type"] == "done":
+                    answer_data = event["answer_data"]
+                    write_behind.save_conversation(
+                        conversation_id=conversation_id,
+                        question=question,
+                        answer_data=answer_data,
+                    )
+                    if not answer_data["cached"]:
+                        evaluator.submit(conversation_id, question, answer_data["answer"], answer_data["model_used"])
+                    yield sse("done", {
+                        "conversation_id": conversation_id,
+                        "question": question,
+                        "answer": answer_data["answer"],
+                    })
+        except LLMError as e:
+            # Headers are already sent, so the failure is reported in the stream
+            yield sse("error", {"error": str(e)})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
 @app.route("/feedback", methods=["POST"])
 def handle_feedback():
     data = request.json
+    if not isinstance(data, dict):
+        return not_an_object()
     conversation_id = data["conversation_id"]
     feedback = data["feedback"]
 
     if not conversation_id or feedback not in [1, -1]:
         return jsonify({"error": "Invalid input"}), 400
 
-    db.save_feedback(
+    write_behind.save_feedback(
         conversation_id=conversation_id,
         feedback=feedback,
     )
@@ -54,5 +159,30 @@ def handle_feedback():
     return jsonify(result)
 
 
+@app.route("/stats", methods=["GET"])
+def handle_stats():
+    result = {
+        "answer_cache": cache_stats(),
+        "evaluator": evaluator.stats(),
+        "db_pool": db.pool_stats(),
+        "write_behind": write_behind.stats(),
+    }
+    return jsonify(result)
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+@app.route("/ready", methods=["GET"])
+def handle_ready():
+    ready, details = warmup.readiness()
+    return jsonify(details), 200 if ready else 503
+
+
 if __name__ == "__main__":
+    warmup.warmup()
+    warmup.warmup_worker()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,205 @@
+import json
+import uuid
+import asyncio
+from time import time
+
+from rag import arag, cache_stats
+
+import db
+import evaluator
+import metrics
+import warmup
+import write_behind
+from llm_client import LLMError, LLMBusyError
+
+# Async serving mode: the same /question, /feedback and /stats API as app.py,
+# as a plain ASGI application. While a question waits on the LLM the event loop
+# serves other requests, so one process handles many questions in flight
+# instead of one per worker. Run it with gunicorn's ASGI worker:
+#
+#   GUNICORN_WORKER_CLASS=asgi gunicorn --config gunicorn.conf.py asgi:app
+#
+# Conversations and feedback are buffered by write_behind.py; queueing an
+# evaluation runs in the default thread pool.
+
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body or b"{}")
+
+
+async def send_json(send, status, data, headers=None):
+    await send_body(send, status, json.dumps(data).encode(), "application/json", headers)
+
+
+async def send_body(send, status, body, content_type, headers=None):
+    response_headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    for name, value in (headers or {}).items():
+        response_headers.append((name.lower().encode(), value.encode()))
+
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def handle_question(data):
+    question = data.get("question")
+
+    if not question:
+        return 400, {"error": "No question provided"}
+
+    # Optional structured filters, e.g. {"diet": "Vegan", "cooking_time_minutes": [["<=", 30]]}
+    filters = data.get("filters") or {}
+    if not isinstance(filters, dict):
+        return 400, {"error": "filters must be an object"}
+
+    conversation_id = str(uuid.uuid4())
+
+    try:
+        answer_data = await arag(question, filters=filters)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+    result = {
+        "conversation_id": conversation_id,
+        "question": question,
+        "answer": answer_data["answer"],
+    }
+
+    write_behind.save_conversation(
+        conversation_id=conversation_id,
+        question=question,
+        answer_data=answer_data,
+    )
+    if not answer_data["cached"]:
+        await asyncio.to_thread(
+            evaluator.submit, conversation_id, question, answer_data["answer"], answer_data["model_used"]
+        )
+
+    return 200, result
+
+
+async def handle_feedback(data):
+    conversation_id = data.get("conversation_id")
+    feedback = data.get("feedback")
+
+    if not conversation_id or feedback not in [1, -1]:
+        return 400, {"error": "Invalid input"}
+
+    write_behind.save_feedback(
+        conversation_id=conversation_id,
+        feedback=feedback,
+    )
+
+    result = {
+        "message": f"Feedback received for conversation {conversation_id}: {feedback}"
+    }
+    return 200, result
+
+
+async def handle_stats():
+    result = {
+        "answer_cache": cache_stats(),
+        "evaluator": evaluator.stats(),
+        "db_pool": db.pool_stats(),
+        "write_behind": write_behind.stats(),
+    }
+    return 200, result
+
+
+async def handle_ready():
+    ready, details = await asyncio.to_thread(warmup.readiness)
+    return 200 if ready else 503, details
+
+
+routes = {
+    "/question": handle_question,
+    "/feedback": handle_feedback,
+}
+
+get_routes = {
+    "/stats": handle_stats,
+    "/ready": handle_ready,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Already done by the gunicorn hooks; needed when run on its own
+            await asyncio.to_thread(warmup.warmup)
+            await asyncio.to_thread(warmup.warmup_worker)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    t0 = time()
+    status = []
+
+    async def send_recorded(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+        await send(message)
+
+    try:
+        await dispatch(scope, receive, send_recorded)
+    finally:
+        known = scope["path"] in routes or scope["path"] in get_routes or scope["path"] == "/metrics"
+        endpoint = scope["path"] if known else "unmatched"
+        metrics.observe_request(endpoint, status[0] if status else 500, time() - t0)
+
+
+async def dispatch(scope, receive, send):
+    if scope["method"] == "GET" and scope["path"] == "/metrics":
+        body, content_type = metrics.render()
+        await send_body(send, 200, body, content_type)
+        return
+
+    if scope["method"] == "GET" and scope["path"] in get_routes:
+        status, result = await get_routes[scope["path"]]()
+        await send_json(send, status, result)
+        return
+
+    handler = routes.get(scope["path"])
+    if handler is None:
+        await send_json(send, 404, {"error": "Not found"})
+        return
+    if scope["method"] != "POST":
+        await send_json(send, 405, {"error": "Method not allowed"}, {"Allow": "POST"})
+        return
+
+    try:
+        data = await read_json(receive)
+    except ValueError:
+        await send_json(send, 400, {"error": "Invalid JSON"})
+        return
+    if not isinstance(data, dict):
+        await send_json(send, 400, {"error": "The request body must be a JSON object"})
+        return
+
+    try:
+        status, result = await handler(data)
+    except LLMError as e:
+        # The model did not answer in time or kept failing; tell the client to retry
+        retry_after = "1" if isinstance(e, LLMBusyError) else "5"
+        await send_json(send, 503, {"error": str(e)}, {"Retry-After": retry_after})
+        return
+
+    await send_json(send, status, result)
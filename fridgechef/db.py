@@ -1,17 +1,54 @@
 import os
+import threading
+from time import time
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2.extras import DictCursor
-from datetime import datetime, timezone
+from psycopg2 import pool
+from psycopg2.extras import DictCursor, execute_values
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
-RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
+import metrics
+
+# check_timezone() writes and deletes a test row; warmup_worker() runs it
+# only when asked to
+RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '0') == '1'
 
 TZ_INFO = os.getenv("TZ", "Europe/Berlin")
 tz = ZoneInfo(TZ_INFO)
 
+# Connections are pooled per process. DB_POOL_MIN stay open when idle, up to
+# DB_POOL_MAX are open at once, and a caller waits up to DB_POOL_TIMEOUT
+# seconds for a free one. Connections idle for more than DB_POOL_CHECK_AFTER
+# seconds are checked with a "SELECT 1" before use, and replaced when the
+# check fails.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "30"))
 
-def get_db_connection():
-    return psycopg2.connect(
+# conversations and feedback are partitioned by month. Partitions are created
+# DB_PARTITION_MONTHS_AHEAD months in advance; partitions older than
+# DB_RETENTION_MONTHS are summarized per day and dropped (0 keeps everything)
+DB_PARTITION_MONTHS_AHEAD = int(os.getenv("DB_PARTITION_MONTHS_AHEAD", "3"))
+DB_RETENTION_MONTHS = int(os.getenv("DB_RETENTION_MONTHS", "12"))
+
+# Seconds between two maintain() runs of the write-behind thread
+DB_MAINTENANCE_INTERVAL = float(os.getenv("DB_MAINTENANCE_INTERVAL", "3600"))
+
+# The dashboard reads per-minute and per-hour rollups instead of raw rows.
+# Every DB_ROLLUP_INTERVAL seconds the buckets of the last DB_ROLLUP_LOOKBACK
+# seconds are recomputed, and so are older buckets that writes have marked in
+# metrics_dirty since: replayed spool rows and late verdicts. Minute buckets
+# are kept DB_ROLLUP_MINUTE_RETENTION_DAYS days, hour buckets for good
+DB_ROLLUP_INTERVAL = float(os.getenv("DB_ROLLUP_INTERVAL", "60"))
+DB_ROLLUP_LOOKBACK = float(os.getenv("DB_ROLLUP_LOOKBACK", "900"))
+DB_ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("DB_ROLLUP_MINUTE_RETENTION_DAYS", "7"))
+
+
+def connection_params():
+    return dict(
         host=os.getenv("POSTGRES_HOST", "postgres"),
         database=os.getenv("POSTGRES_DB", "course_assistant"),
         user=os.getenv("POSTGRES_USER", "your_username"),
@@ -19,121 +56,877 @@ def get_db_connection():
     )
 
 
-def init_db():
-    conn = get_db_connection()
+def get_db_connection():
+    # A new, unpooled connection
+    return psycopg2.connect(**connection_params())
+
+
+class ConnectionPool:
+    # psycopg2's ThreadedConnectionPool fails right away when all connections
+    # are taken; the semaphore makes callers wait for one instead. Connections
+    # are never shared between processes: a pool created before a fork is
+    # replaced, not reused, in the child.
+
+    def __init__(self, minconn, maxconn, timeout, check_after):
+        self.pid = os.getpid()
+        self.pool = pool.ThreadedConnectionPool(minconn, maxconn, **connection_params())
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        self.check_after = check_after
+        self.last_used = {}
+
+        self.lock = threading.Lock()
+        self.counters = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "timeouts": 0,
+            "discarded": 0,
+            "in_use": 0,
+        }
+
+    def healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time() - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        t0 = time()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.counters["timeouts"] += 1
+            raise pool.PoolError(f"No database connection free after {self.timeout}s")
+        waited = time() - t0
+
+        try:
+            conn = self.pool.getconn()
+            while not self.healthy(conn):
+                self.discard(conn)
+                conn = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.counters["acquired"] += 1
+            self.counters["in_use"] += 1
+            self.counters["wait_seconds"] += waited
+            self.counters["max_wait_seconds"] = max(self.counters["max_wait_seconds"], waited)
+            if waited > 0.001:
+                self.counters["waited"] += 1
+        metrics.db_pool_wait_seconds.observe(waited)
+        return conn
+
+    def discard(self, conn):
+        self.last_used.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+        with self.lock:
+            self.counters["discarded"] += 1
+
+    def putconn(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self.discard(conn)
+            else:
+                self.last_used[id(conn)] = time()
+                self.pool.putconn(conn)
+        finally:
+            with self.lock:
+                self.counters["in_use"] -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+        result["open"] = len(self.pool._used) + len(self.pool._pool)
+        result["max"] = self.pool.maxconn
+        return result
+
+    def close(self):
+        self.pool.closeall()
+
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+# Pools inherited from the parent process. They are kept referenced but never
+# used: closing their connections in the child would end the parent's sessions
+inherited_pools = []
+
+
+def get_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None or db_pool.pid != os.getpid():
+            if db_pool is not None:
+                inherited_pools.append(db_pool)
+            db_pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_AFTER)
+        return db_pool
+
+
+@contextmanager
+def connection():
+    # A pooled connection for the duration of the block. Uncommitted work is
+    # rolled back when the block raises; connections that broke are replaced
+    db_pool = get_pool()
+    conn = db_pool.getconn()
+    broken = False
     try:
-        with conn.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS feedback")
-            cur.execute("DROP TABLE IF EXISTS conversations")
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if not broken and not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+            # Leave no transaction open on a pooled connection
+            conn.rollback()
+        db_pool.putconn(conn, broken=broken)
+
+
+def pool_stats():
+    return db_pool.stats() if db_pool is not None and db_pool.pid == os.getpid() else None
+
+
+PARTITIONED_TABLES = ("conversations", "feedback")
+
+
+def month_start(dt):
+    dt = dt.astimezone(timezone.utc)
+    return datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def create_partitions(cur, first, last):
+    # Monthly partitions of both tables, from the month of first to the month
+    # of last, both included. Bounds are in UTC
+    month = month_start(first)
+    while month <= month_start(last):
+        for table in PARTITIONED_TABLES:
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {partition_name(table, month)}
+                PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)
+                """,
+                (month, add_months(month, 1)),
+            )
+        month = add_months(month, 1)
+
+
+def partition_months(cur, table):
+    # Months of the existing partitions of table, oldest first
+    cur.execute(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        """,
+        (table,),
+    )
+    prefix = f"{table}_p"
+    months = [
+        datetime.strptime(name[len(prefix):], "%Y%m").replace(tzinfo=timezone.utc)
+        for (name,) in cur.fetchall()
+        if name.startswith(prefix)
+    ]
+    return sorted(months)
+
+
+def partition_tables(cur):
+    # Migration 4: moves the rows of the plain tables into monthly partitioned
+    # ones. The primary keys include the timestamp, as Postgres requires for
+    # partitioned tables, and feedback no longer has a foreign key
+    cur.execute("ALTER TABLE conversations RENAME TO conversations_unpartitioned")
+    cur.execute("ALTER TABLE conversations_unpartitioned RENAME CONSTRAINT conversations_pkey TO conversations_unpartitioned_pkey")
+    cur.execute("ALTER TABLE feedback RENAME TO feedback_unpartitioned")
+    cur.execute("ALTER TABLE feedback_unpartitioned RENAME CONSTRAINT feedback_pkey TO feedback_unpartitioned_pkey")
+    cur.execute("ALTER SEQUENCE feedback_id_seq RENAME TO feedback_unpartitioned_id_seq")
+
+    cur.execute("""
+        CREATE TABLE conversations (
+            id TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            time_to_first_token FLOAT NOT NULL DEFAULT 0,
+            prompt_tokens_saved INTEGER NOT NULL DEFAULT 0,
+            evaluation_lag FLOAT,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    cur.execute("""
+        CREATE TABLE feedback (
+            id SERIAL,
+            conversation_id TEXT NOT NULL,
+            feedback INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+
+    now = datetime.now(timezone.utc)
+    cur.execute("""
+        SELECT MIN(timestamp) FROM (
+            SELECT MIN(timestamp) AS timestamp FROM conversations_unpartitioned
+            UNION ALL
+            SELECT MIN(timestamp) FROM feedback_unpartitioned
+        ) t
+    """)
+    first = cur.fetchone()[0] or now
+    create_partitions(cur, min(first, now), add_months(month_start(now), DB_PARTITION_MONTHS_AHEAD))
+
+    cur.execute("""
+        INSERT INTO conversations (id, question, answer, model_used, response_time, relevance,
+            relevance_explanation, prompt_tokens, completion_tokens, total_tokens,
+            eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp,
+            time_to_first_token, prompt_tokens_saved, evaluation_lag)
+        SELECT id, question, answer, model_used, response_time, relevance,
+            relevance_explanation, prompt_tokens, completion_tokens, total_tokens,
+            eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp,
+            time_to_first_token, prompt_tokens_saved, evaluation_lag
+        FROM conversations_unpartitioned
+    """)
+    cur.execute("""
+        INSERT INTO feedback (id, conversation_id, feedback, timestamp)
+        SELECT id, conversation_id, feedback, timestamp FROM feedback_unpartitioned
+        WHERE conversation_id IS NOT NULL
+    """)
+    cur.execute("SELECT setval(pg_get_serial_sequence('feedback', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM feedback")
+
+    cur.execute("DROP TABLE feedback_unpartitioned")
+    cur.execute("DROP TABLE conversations_unpartitioned")
+
+
+ROLLUP_RESOLUTIONS = ("minute", "hour")
+
+
+# Per-stage averages of metrics_latency, from migration 6 on
+STAGE_AVERAGES = {
+    "retrieval_time_avg": "AVG(retrieval_time)",
+    "prompt_time_avg": "AVG(prompt_time)",
+    "generation_time_avg": "AVG(generation_time)",
+    "evaluation_time_avg": "AVG(evaluation_time)",
+    "db_write_time_avg": "AVG(db_write_time)",
+}
+
+
+def rollup_range(cur, resolution, start, end=None, stages=True):
+    # Recomputes the buckets of one resolution from start (a bucket boundary)
+    # up to end, or onwards. Only the raw rows of that range are read, through
+    # the timestamp indexes. Without stages, the per-stage averages are left
+    # out, for schemas older than migration 6
+    params = {"resolution": resolution, "start": start, "end": end}
+    window = "timestamp >= %(start)s" + (" AND timestamp < %(end)s" if end is not None else "")
+    buckets = window.replace("timestamp", "bucket")
+    stage_columns = "".join(f", {column}" for column in STAGE_AVERAGES) if stages else ""
+    stage_values = "".join(f", {value}" for value in STAGE_AVERAGES.values()) if stages else ""
+
+    for table in ("metrics_conversations", "metrics_latency", "metrics_feedback"):
+        cur.execute(f"DELETE FROM {table} WHERE resolution = %(resolution)s AND {buckets}", params)
+
+    cur.execute(
+        f"""
+        INSERT INTO metrics_conversations
+        SELECT %(resolution)s, date_trunc(%(resolution)s, timestamp, 'UTC'), model_used, relevance,
+            COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens),
+            SUM(eval_total_tokens), SUM(openai_cost)
+        FROM conversations
+        WHERE {window}
+        GROUP BY 2, 3, 4
+        """,
+        params,
+    )
+    cur.execute(
+        f"""
+        INSERT INTO metrics_latency (resolution, bucket, conversations,
+            response_time_avg, response_time_p50, response_time_p95, response_time_p99, response_time_max,
+            evaluation_lag_avg, evaluation_lag_max{stage_columns})
+        SELECT %(resolution)s, date_trunc(%(resolution)s, timestamp, 'UTC'), COUNT(*),
+            AVG(response_time),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY response_time),
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY response_time),
+            MAX(response_time),
+            AVG(evaluation_lag),
+            MAX(evaluation_lag){stage_values}
+        FROM conversations
+        WHERE {window}
+        GROUP BY 2
+        """,
+        params,
+    )
+    cur.execute(
+        f"""
+        INSERT INTO metrics_feedback
+        SELECT %(resolution)s, date_trunc(%(resolution)s, timestamp, 'UTC'),
+            SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END)
+        FROM feedback
+        WHERE {window}
+        GROUP BY 2
+        """,
+        params,
+    )
+
+
+def rollup_since(cur, since, stages=True):
+    # Recomputes every bucket from the one containing since onwards
+    for resolution in ROLLUP_RESOLUTIONS:
+        cur.execute("SELECT date_trunc(%s, %s::timestamptz, 'UTC')", (resolution, since))
+        rollup_range(cur, resolution, cur.fetchone()[0], stages=stages)
+
+
+def rollup_dirty(cur, since):
+    # Recomputes the buckets before since that rows were written to or updated
+    # in after they were rolled up: spooled rows replayed later, verdicts that
+    # arrived after retries. The marks from since on are covered by
+    # rollup_since and just cleared
+    cur.execute("DELETE FROM metrics_dirty RETURNING bucket")
+    minutes = sorted(bucket for (bucket,) in cur.fetchall())
+    if not minutes:
+        return []
+
+    cur.execute("SELECT date_trunc('minute', %s::timestamptz, 'UTC'), date_trunc('hour', %s::timestamptz, 'UTC')", (since, since))
+    minute_since, hour_since = cur.fetchone()
+
+    stale = [minute for minute in minutes if minute < minute_since]
+    # Minute buckets past their retention stay dropped; their hours are redone
+    kept_from = datetime.now(timezone.utc) - timedelta(days=DB_ROLLUP_MINUTE_RETENTION_DAYS)
+    for minute in stale:
+        if minute >= kept_from:
+            rollup_range(cur, "minute", minute, minute + timedelta(minutes=1))
+    hours = sorted({minute.astimezone(timezone.utc).replace(minute=0) for minute in stale})
+    for hour in hours:
+        if hour < hour_since:
+            rollup_range(cur, "hour", hour, hour + timedelta(hours=1))
+    return stale
+
+
+def mark_dirty(cur, timestamps):
+    # Records the minute buckets of rows written, for rollup_dirty()
+    if timestamps:
+        cur.execute(
+            """
+            INSERT INTO metrics_dirty (bucket)
+            SELECT DISTINCT date_trunc('minute', t, 'UTC') FROM unnest(%s::timestamptz[]) AS t
+            ON CONFLICT DO NOTHING
+            """,
+            (list(timestamps),),
+        )
+
+
+def first_timestamp(cur):
+    cur.execute("""
+        SELECT MIN(timestamp) FROM (
+            SELECT MIN(timestamp) AS timestamp FROM conversations
+            UNION ALL
+            SELECT MIN(timestamp) FROM feedback
+        ) t
+    """)
+    return cur.fetchone()[0]
+
+
+def backfill_rollups(cur):
+    # Migration 5: rollups of all the history there is, without the per-stage
+    # averages, which came later
+    first = first_timestamp(cur)
+    if first is not None:
+        rollup_since(cur, first, stages=False)
 
+
+def backfill_stage_rollups(cur):
+    # Migration 6: the history rolled up again, with the per-stage averages
+    first = first_timestamp(cur)
+    if first is not None:
+        rollup_since(cur, first)
+
+
+# Schema changes, applied in order by migrate(). Each one runs once per
+# database; the versions applied so far are recorded in schema_migrations.
+# A step is an SQL statement, or a function called with the cursor.
+# Never edit a migration that has shipped, add a new one instead.
+MIGRATIONS = [
+    (1, "create conversations and feedback", [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS feedback (
+            id SERIAL PRIMARY KEY,
+            conversation_id TEXT REFERENCES conversations(id),
+            feedback INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+    ]),
+    (2, "add streaming, prompt cache and evaluation lag columns", [
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS time_to_first_token FLOAT NOT NULL DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS prompt_tokens_saved INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS evaluation_lag FLOAT",
+    ]),
+    (3, "index the history, feedback and dashboard queries", [
+        # Time ranges and "latest first", in the dashboard and the history
+        "CREATE INDEX IF NOT EXISTS conversations_timestamp_idx ON conversations (timestamp)",
+        # get_recent_conversations(relevance=...)
+        "CREATE INDEX IF NOT EXISTS conversations_relevance_timestamp_idx ON conversations (relevance, timestamp)",
+        # The feedback join, and the feedback panel's time range
+        "CREATE INDEX IF NOT EXISTS feedback_conversation_id_idx ON feedback (conversation_id)",
+        "CREATE INDEX IF NOT EXISTS feedback_timestamp_idx ON feedback (timestamp)",
+    ]),
+    (4, "partition conversations and feedback by month, with daily summaries", [
+        partition_tables,
+        "CREATE INDEX conversations_timestamp_idx ON conversations (timestamp)",
+        "CREATE INDEX conversations_relevance_timestamp_idx ON conversations (relevance, timestamp)",
+        "CREATE INDEX feedback_conversation_id_idx ON feedback (conversation_id)",
+        "CREATE INDEX feedback_timestamp_idx ON feedback (timestamp)",
+        # What is left of partitions dropped by apply_retention()
+        """
+        CREATE TABLE conversations_daily (
+            day DATE NOT NULL,
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            conversations INTEGER NOT NULL,
+            prompt_tokens BIGINT NOT NULL,
+            completion_tokens BIGINT NOT NULL,
+            total_tokens BIGINT NOT NULL,
+            eval_total_tokens BIGINT NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            response_time_sum FLOAT NOT NULL,
+            response_time_max FLOAT NOT NULL,
+            PRIMARY KEY (day, model_used, relevance)
+        )
+        """,
+        """
+        CREATE TABLE feedback_daily (
+            day DATE PRIMARY KEY,
+            thumbs_up INTEGER NOT NULL,
+            thumbs_down INTEGER NOT NULL
+        )
+        """,
+    ]),
+    (5, "per-minute and per-hour rollups for the dashboard", [
+        """
+        CREATE TABLE metrics_conversations (
+            resolution TEXT NOT NULL,
+            bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            conversations INTEGER NOT NULL,
+            prompt_tokens BIGINT NOT NULL,
+            completion_tokens BIGINT NOT NULL,
+            total_tokens BIGINT NOT NULL,
+            eval_total_tokens BIGINT NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            PRIMARY KEY (resolution, bucket, model_used, relevance)
+        )
+        """,
+        """
+        CREATE TABLE metrics_latency (
+            resolution TEXT NOT NULL,
+            bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+            conversations INTEGER NOT NULL,
+            response_time_avg FLOAT NOT NULL,
+            response_time_p50 FLOAT NOT NULL,
+            response_time_p95 FLOAT NOT NULL,
+            response_time_p99 FLOAT NOT NULL,
+            response_time_max FLOAT NOT NULL,
+            evaluation_lag_avg FLOAT,
+            evaluation_lag_max FLOAT,
+            PRIMARY KEY (resolution, bucket)
+        )
+        """,
+        """
+        CREATE TABLE metrics_feedback (
+            resolution TEXT NOT NULL,
+            bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+            thumbs_up INTEGER NOT NULL,
+            thumbs_down INTEGER NOT NULL,
+            PRIMARY KEY (resolution, bucket)
+        )
+        """,
+        backfill_rollups,
+    ]),
+    (6, "per-stage latency columns", [
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS retrieval_time FLOAT NOT NULL DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS prompt_time FLOAT NOT NULL DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS generation_time FLOAT NOT NULL DEFAULT 0",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS evaluation_time FLOAT",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS db_write_time FLOAT",
+        "ALTER TABLE metrics_latency ADD COLUMN IF NOT EXISTS retrieval_time_avg FLOAT",
+        "ALTER TABLE metrics_latency ADD COLUMN IF NOT EXISTS prompt_time_avg FLOAT",
+        "ALTER TABLE metrics_latency ADD COLUMN IF NOT EXISTS generation_time_avg FLOAT",
+        "ALTER TABLE metrics_latency ADD COLUMN IF NOT EXISTS evaluation_time_avg FLOAT",
+        "ALTER TABLE metrics_latency ADD COLUMN IF NOT EXISTS db_write_time_avg FLOAT",
+        backfill_stage_rollups,
+    ]),
+    (7, "track rollup buckets written to after they were rolled up", [
+        # Minute buckets; write_batch() adds them, refresh_rollups() consumes them
+        """
+        CREATE TABLE metrics_dirty (
+            bucket TIMESTAMP WITH TIME ZONE PRIMARY KEY
+        )
+        """,
+    ]),
+]
+
+# Held while migrating, so workers starting together do not race
+MIGRATION_LOCK = 4173001
+
+
+def migrate():
+    # Brings the schema up to date in place, in one transaction. Returns the
+    # versions applied
+    applied = []
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK,))
             cur.execute("""
-                CREATE TABLE conversations (
-                    id TEXT PRIMARY KEY,
-                    question TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    model_used TEXT NOT NULL,
-                    response_time FLOAT NOT NULL,
-                    relevance TEXT NOT NULL,
-                    relevance_explanation TEXT NOT NULL,
-                    prompt_tokens INTEGER NOT NULL,
-                    completion_tokens INTEGER NOT NULL,
-                    total_tokens INTEGER NOT NULL,
-                    eval_prompt_tokens INTEGER NOT NULL,
-                    eval_completion_tokens INTEGER NOT NULL,
-                    eval_total_tokens INTEGER NOT NULL,
-                    openai_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            cur.execute("""
-                CREATE TABLE feedback (
-                    id SERIAL PRIMARY KEY,
-                    conversation_id TEXT REFERENCES conversations(id),
-                    feedback INTEGER NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+            cur.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in cur.fetchall()}
+
+            for version, description, statements in MIGRATIONS:
+                if version in done:
+                    continue
+                print(f"Applying migration {version}: {description}")
+                for statement in statements:
+                    if callable(statement):
+                        statement(cur)
+                    else:
+                        cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description),
                 )
-            """)
+                applied.append(version)
         conn.commit()
-    finally:
-        conn.close()
+    return applied
+
+
+def init_db(reset=False):
+    # Creates or upgrades the tables; reset=True drops all data first
+    if reset:
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS feedback")
+                cur.execute("DROP TABLE IF EXISTS conversations")
+                cur.execute("DROP TABLE IF EXISTS schema_migrations")
+                cur.execute("DROP TABLE IF EXISTS conversations_daily")
+                cur.execute("DROP TABLE IF EXISTS feedback_daily")
+                for table in ("metrics_conversations", "metrics_latency", "metrics_feedback", "metrics_dirty"):
+                    cur.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+    return migrate()
+
+
+# Held by the process running maintain() or refresh_rollups(); the others skip it
+MAINTENANCE_LOCK = 4173002
+ROLLUP_LOCK = 4173003
+
+
+def apply_retention(cur, months=DB_RETENTION_MONTHS):
+    # Summarizes the partitions older than months per day into
+    # conversations_daily and feedback_daily, then drops them. Returns the
+    # months dropped
+    if months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -months)
+
+    dropped = []
+    for month in partition_months(cur, "conversations"):
+        if month >= cutoff:
+            break
+        conversations = partition_name("conversations", month)
+        cur.execute(f"""
+            INSERT INTO conversations_daily
+            SELECT (timestamp AT TIME ZONE 'UTC')::date, model_used, relevance, COUNT(*),
+                SUM(prompt_tokens), SUM(completion_tokens), SUM(total_tokens), SUM(eval_total_tokens),
+                SUM(openai_cost), SUM(response_time), MAX(response_time)
+            FROM {conversations}
+            GROUP BY 1, 2, 3
+            ON CONFLICT (day, model_used, relevance) DO UPDATE SET
+                conversations = conversations_daily.conversations + EXCLUDED.conversations,
+                prompt_tokens = conversations_daily.prompt_tokens + EXCLUDED.prompt_tokens,
+                completion_tokens = conversations_daily.completion_tokens + EXCLUDED.completion_tokens,
+                total_tokens = conversations_daily.total_tokens + EXCLUDED.total_tokens,
+                eval_total_tokens = conversations_daily.eval_total_tokens + EXCLUDED.eval_total_tokens,
+                openai_cost = conversations_daily.openai_cost + EXCLUDED.openai_cost,
+                response_time_sum = conversations_daily.response_time_sum + EXCLUDED.response_time_sum,
+                response_time_max = GREATEST(conversations_daily.response_time_max, EXCLUDED.response_time_max)
+        """)
+        cur.execute(f"DROP TABLE {conversations}")
+        dropped.append(month)
+
+    for month in partition_months(cur, "feedback"):
+        if month >= cutoff:
+            break
+        feedback = partition_name("feedback", month)
+        cur.execute(f"""
+            INSERT INTO feedback_daily
+            SELECT (timestamp AT TIME ZONE 'UTC')::date,
+                SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END)
+            FROM {feedback}
+            GROUP BY 1
+            ON CONFLICT (day) DO UPDATE SET
+                thumbs_up = feedback_daily.thumbs_up + EXCLUDED.thumbs_up,
+                thumbs_down = feedback_daily.thumbs_down + EXCLUDED.thumbs_down
+        """)
+        cur.execute(f"DROP TABLE {feedback}")
+    return dropped
+
+
+def maintain():
+    # Creates the coming months' partitions and applies the retention policies.
+    # Safe to run from every process; only one at a time does the work
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (MAINTENANCE_LOCK,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return None
+            now = datetime.now(timezone.utc)
+            create_partitions(cur, now, add_months(month_start(now), DB_PARTITION_MONTHS_AHEAD))
+            dropped = apply_retention(cur)
+            for table in ("metrics_conversations", "metrics_latency", "metrics_feedback"):
+                cur.execute(
+                    f"DELETE FROM {table} WHERE resolution = 'minute' AND bucket < now() - make_interval(days => %s)",
+                    (DB_ROLLUP_MINUTE_RETENTION_DAYS,),
+                )
+        conn.commit()
+    return {"dropped": [f"{month:%Y-%m}" for month in dropped]}
+
+
+def refresh_rollups(lookback=DB_ROLLUP_LOOKBACK):
+    # Brings the rollups of the last lookback seconds, and the older buckets
+    # marked dirty, up to date. Returns False when another process was
+    # already doing it
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROLLUP_LOCK,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return False
+            since = datetime.now(timezone.utc) - timedelta(seconds=lookback)
+            rollup_since(cur, since)
+            rollup_dirty(cur, since)
+        conn.commit()
+    return True
+
+
+CONVERSATION_COLUMNS = """
+    (id, question, answer, model_used, response_time, time_to_first_token, relevance, 
+    relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
+    prompt_tokens_saved, eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp,
+    retrieval_time, prompt_time, generation_time, db_write_time)
+"""
+
+# The last value of a conversation row is the time() at which it was handed
+# over for writing. write_batch() replaces it with db_write_time, the seconds
+# from the hand-over until the insert, buffering included. Both ends are read
+# from the app's clock, so skew against the database's clock does not count
+def with_write_time(row, now):
+    handed_over = row[-1]
+    return row[:-1] + (max(now - handed_over, 0.0) if handed_over is not None else None,)
+
+
+def conversation_row(conversation_id, question, answer_data, timestamp):
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data.get("time_to_first_token", answer_data["response_time"]),
+        answer_data["relevance"],
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data.get("prompt_tokens_saved", 0),
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        answer_data["openai_cost"],
+        timestamp,
+        answer_data.get("retrieval_time", 0.0),
+        answer_data.get("prompt_time", 0.0),
+        answer_data.get("generation_time", 0.0),
+        time(),
+    )
+
+
+def relevance_row(conversation_id, relevance, explanation, token_stats=None, openai_cost=0, evaluation_lag=None, evaluation_time=None):
+    token_stats = token_stats or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    return (
+        conversation_id,
+        relevance,
+        explanation,
+        token_stats["prompt_tokens"],
+        token_stats["completion_tokens"],
+        token_stats["total_tokens"],
+        openai_cost,
+        evaluation_lag,
+        evaluation_time,
+    )
+
+
+def feedback_row(conversation_id, feedback, timestamp):
+    return (conversation_id, feedback, timestamp)
 
 
 def save_conversation(conversation_id, question, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    write_batch(conversations=[conversation_row(conversation_id, question, answer_data, timestamp)])
+
+
+def update_relevance(conversation_id, relevance, explanation, token_stats=None, openai_cost=0, evaluation_lag=None, evaluation_time=None):
+    # Called by the background evaluator once the answer has been judged;
+    # evaluation_lag is the time between queueing and the verdict, and
+    # evaluation_time the part of it spent in the judge call
+    write_batch(relevance_updates=[
+        relevance_row(conversation_id, relevance, explanation, token_stats, openai_cost, evaluation_lag, evaluation_time)
+    ])
+
+
+def write_batch(conversations=(), feedback=(), relevance_updates=()):
+    # Many rows in one transaction, with one multi-row statement per table.
+    # Rows come from conversation_row, feedback_row and relevance_row.
+    # Conversations go first, so feedback and verdicts can refer to them.
+    # The rollup buckets of all the rows are marked dirty in the same transaction.
+    # Returns the relevance updates that matched no conversation
+    unmatched = []
+    with connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    conversation_id,
-                    question,
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"],
-                    answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    answer_data["eval_prompt_tokens"],
-                    answer_data["eval_completion_tokens"],
-                    answer_data["eval_total_tokens"],
-                    answer_data["openai_cost"],
-                    timestamp
-                ),
-            )
+            timestamps = [row[16] for row in conversations] + [row[2] for row in feedback]
+            if conversations:
+                now = time()
+                execute_values(
+                    cur,
+                    f"INSERT INTO conversations {CONVERSATION_COLUMNS} VALUES %s",
+                    [with_write_time(row, now) for row in conversations],
+                    page_size=1000,
+                )
+            if feedback:
+                execute_values(
+                    cur,
+                    "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES %s",
+                    feedback,
+                    page_size=1000,
+                )
+            if relevance_updates:
+                updated = execute_values(
+                    cur,
+                    """
+                    UPDATE conversations AS c
+                    SET relevance = v.relevance,
+                        relevance_explanation = v.explanation,
+                        eval_prompt_tokens = v.eval_prompt_tokens,
+                        eval_completion_tokens = v.eval_completion_tokens,
+                        eval_total_tokens = v.eval_total_tokens,
+                        openai_cost = c.openai_cost + v.eval_cost,
+                        evaluation_lag = v.evaluation_lag,
+                        evaluation_time = v.evaluation_time
+                    FROM (VALUES %s) AS v (id, relevance, explanation, eval_prompt_tokens,
+                        eval_completion_tokens, eval_total_tokens, eval_cost, evaluation_lag, evaluation_time)
+                    WHERE c.id = v.id
+                    RETURNING c.id, c.timestamp
+                    """,
+                    relevance_updates,
+                    template="(%s, %s, %s, %s::integer, %s::integer, %s::integer, %s::float, %s::float, %s::float)",
+                    page_size=1000,
+                    fetch=True,
+                )
+                timestamps += [timestamp for _, timestamp in updated]
+                matched = {conversation_id for conversation_id, _ in updated}
+                unmatched = [row for row in relevance_updates if row[0] not in matched]
+            mark_dirty(cur, timestamps)
         conn.commit()
-    finally:
-        conn.close()
+    return unmatched
 
 
 def save_feedback(conversation_id, feedback, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))",
-                (conversation_id, feedback, timestamp),
-            )
-        conn.commit()
-    finally:
-        conn.close()
+    write_batch(feedback=[feedback_row(conversation_id, feedback, timestamp)])
 
 
 def get_recent_conversations(limit=5, relevance=None):
-    conn = get_db_connection()
-    try:
+    with connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             query = """
                 SELECT c.*, f.feedback
                 FROM conversations c
                 LEFT JOIN feedback f ON c.id = f.conversation_id
             """
+            params = []
             if relevance:
-                query += f" WHERE c.relevance = '{relevance}'"
+                query += " WHERE c.relevance = %s"
+                params.append(relevance)
             query += " ORDER BY c.timestamp DESC LIMIT %s"
+            params.append(limit)
 
-            cur.execute(query, (limit,))
+            cur.execute(query, params)
             return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def get_feedback_stats():
-    conn = get_db_connection()
-    try:
+    with connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("""
                 SELECT 
@@ -142,11 +935,10 @@ def get_feedback_stats():
                 FROM feedback
             """)
             return cur.fetchone()
-    finally:
-        conn.close()
 
 
 def check_timezone():
+    # A one-off diagnostic, on its own connection
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
@@ -193,7 +985,3 @@ def check_timezone():
         conn.rollback()
     finally:
         conn.close()
-
-
-if RUN_TIMEZONE_CHECK:
-    check_timezone()
\ No newline at end of file
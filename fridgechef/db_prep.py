@@ -1,12 +1,21 @@
-import os
+import argparse
 from dotenv import load_dotenv
 
-os.environ['RUN_TIMEZONE_CHECK'] = '0'
-
-from db import init_db
+from db import init_db, maintain, refresh_rollups
 
 load_dotenv()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or upgrade the database schema")
+    parser.add_argument("--reset", action="store_true", help="Drop all conversations and feedback first")
+    parser.add_argument("--maintain", action="store_true", help="Only create partitions, apply the retention policy and refresh the rollups")
+    args = parser.parse_args()
+
+    if args.maintain:
+        print(f"Maintenance: {maintain()}")
+        print(f"Rollups refreshed: {refresh_rollups()}")
+        raise SystemExit
+
     print("Initializing database...")
-    init_db()
\ No newline at end of file
+    applied = init_db(reset=args.reset)
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
\ No newline at end of file
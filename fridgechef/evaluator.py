@@ -0,0 +1,209 @@
+import os
+import queue
+import atexit
+import threading
+from time import time, sleep
+
+import metrics
+import write_behind
+import rag
+
+# Relevance of an answer is judged by a second LLM call. It runs here, in
+# background threads, so /question returns as soon as the answer is generated.
+# Conversations are saved with relevance "PENDING" and updated by the worker.
+
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "2"))
+
+# Bounded queue: when the judge falls behind, submit() waits up to
+# EVAL_QUEUE_TIMEOUT seconds for a free slot, then gives up on the evaluation
+# (relevance "SKIPPED") instead of holding the request or growing without bound
+EVAL_QUEUE_SIZE = int(os.getenv("EVAL_QUEUE_SIZE", "1000"))
+EVAL_QUEUE_TIMEOUT = float(os.getenv("EVAL_QUEUE_TIMEOUT", "0.5"))
+
+# Micro-batching: a worker takes the next job, then waits up to EVAL_BATCH_WAIT
+# seconds for more, and judges up to EVAL_BATCH_SIZE answers with one call
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", "8"))
+EVAL_BATCH_WAIT = float(os.getenv("EVAL_BATCH_WAIT", "0.2"))
+
+# Failed evaluations are retried with exponential backoff
+EVAL_MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "3"))
+EVAL_RETRY_DELAY = float(os.getenv("EVAL_RETRY_DELAY", "1.0"))
+
+# Seconds to keep draining the queue at shutdown
+EVAL_DRAIN_TIMEOUT = float(os.getenv("EVAL_DRAIN_TIMEOUT", "10"))
+
+jobs = queue.Queue(maxsize=EVAL_QUEUE_SIZE)
+
+lock = threading.Lock()
+counters = {
+    "submitted": 0,
+    "evaluated": 0,
+    "requests": 0,
+    "retried": 0,
+    "failed": 0,
+    "skipped": 0,
+    "last_lag": 0.0,
+    "max_lag": 0.0,
+}
+
+# Threads do not survive a fork, so the workers are started lazily in the
+# process that submits the first job (each gunicorn worker, not the master)
+workers_pid = None
+
+
+def start_workers():
+    global workers_pid
+    with lock:
+        if workers_pid == os.getpid():
+            return
+        workers_pid = os.getpid()
+        for i in range(EVAL_WORKERS):
+            thread = threading.Thread(target=work, name=f"evaluator-{i}", daemon=True)
+            thread.start()
+
+
+def submit(conversation_id, question, answer, model="gpt-4o-mini"):
+    # Queues the relevance evaluation of a saved conversation. Returns False
+    # when the queue stayed full and the evaluation was skipped
+    start_workers()
+
+    job = (conversation_id, question, answer, model, time())
+    try:
+        jobs.put(job, timeout=EVAL_QUEUE_TIMEOUT)
+    except queue.Full:
+        increment("skipped")
+        write_behind.update_relevance(
+            conversation_id,
+            relevance="SKIPPED",
+            explanation="Evaluation queue full",
+        )
+        return False
+
+    increment("submitted")
+    return True
+
+
+def next_batch():
+    batch = [jobs.get()]
+    deadline = time() + EVAL_BATCH_WAIT
+    while len(batch) < EVAL_BATCH_SIZE:
+        remaining = deadline - time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(jobs.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def split(count, n):
+    # count in n whole parts that add up to it, the larger ones first
+    return [count // n + (1 if i < count % n else 0) for i in range(n)]
+
+
+def evaluate(batch):
+    # One judge call for the whole batch; its tokens and cost are split evenly
+    # between the conversations, priced as calls to the judge model, not to
+    # the model that wrote the answers. Returns the lag of every job
+    model = rag.JUDGE_MODEL
+    pairs = [(question, answer) for _, question, answer, _, _ in batch]
+
+    t0 = time()
+    if len(pairs) == 1:
+        relevance, token_stats = rag.evaluate_relevance(*pairs[0], model=model)
+        verdicts = [relevance]
+    else:
+        verdicts, token_stats = rag.evaluate_relevance_batch(pairs, model=model)
+    # Every conversation of the batch waited for the whole call
+    judge_time = time() - t0
+    increment("requests")
+
+    n = len(batch)
+    parts = {name: split(count, n) for name, count in token_stats.items()}
+    total_cost = rag.calculate_openai_cost(model, token_stats)
+    cost = total_cost / n
+    metrics.observe_evaluation(model, token_stats, total_cost, judge_time)
+
+    lags = []
+    for i, ((conversation_id, _, _, _, enqueued_at), verdict) in enumerate(zip(batch, verdicts)):
+        lag = time() - enqueued_at
+        relevance = verdict.get("Relevance", "UNKNOWN")
+        metrics.observe_verdict(relevance)
+        write_behind.update_relevance(
+            conversation_id,
+            relevance=relevance,
+            explanation=verdict.get("Explanation", "Failed to parse evaluation"),
+            token_stats={name: counts[i] for name, counts in parts.items()},
+            openai_cost=cost,
+            evaluation_lag=lag,
+            evaluation_time=judge_time,
+        )
+        lags.append(lag)
+    return lags
+
+
+def work():
+    while True:
+        batch = next_batch()
+        try:
+            for attempt in range(EVAL_MAX_RETRIES + 1):
+                try:
+                    lags = evaluate(batch)
+                except Exception as e:
+                    if attempt == EVAL_MAX_RETRIES:
+                        print(f"Evaluation of {len(batch)} conversations failed: {e}")
+                        for conversation_id, _, _, _, enqueued_at in batch:
+                            increment("failed")
+                            mark_failed(conversation_id, e, enqueued_at)
+                        break
+                    increment("retried")
+                    sleep(EVAL_RETRY_DELAY * 2**attempt)
+                else:
+                    with lock:
+                        counters["evaluated"] += len(lags)
+                        counters["last_lag"] = lags[-1]
+                        counters["max_lag"] = max(counters["max_lag"], *lags)
+                    break
+        finally:
+            for _ in batch:
+                jobs.task_done()
+
+
+def mark_failed(conversation_id, error, enqueued_at):
+    try:
+        write_behind.update_relevance(
+            conversation_id,
+            relevance="ERROR",
+            explanation=f"Evaluation failed: {error}",
+            evaluation_lag=time() - enqueued_at,
+        )
+    except Exception as e:
+        print(f"Could not record failed evaluation of {conversation_id}: {e}")
+
+
+def increment(name):
+    with lock:
+        counters[name] += 1
+
+
+def stats():
+    # Counters plus the current backlog; the lag of every evaluation is also
+    # stored in conversations.evaluation_lag
+    with lock:
+        result = dict(counters)
+    result["queued"] = jobs.qsize()
+    return result
+
+
+def drain(timeout=EVAL_DRAIN_TIMEOUT):
+    # Gives queued evaluations a chance to finish before the process exits;
+    # whatever is left keeps relevance "PENDING"
+    if workers_pid != os.getpid():
+        return
+    deadline = time() + timeout
+    while jobs.unfinished_tasks and time() < deadline:
+        sleep(0.1)
+
+
+atexit.register(drain)
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the chat completions API, for testing the client layer
+# and the app without an API key or network:
+#
+#   python fake_openai.py --port 8000 --latency 0.5 --error-rate 0.1
+#   OPENAI_BASE_URL=http://localhost:8000/v1 OPENAI_API_KEY=fake python app.py
+#
+# Judge prompts get well-formed verdicts, everything else a canned answer.
+# A share of requests (--error-rate) fails with 429 or 500.
+#
+# For load tests the timing can follow a distribution instead: the latency
+# before the first token is log-normal around --latency (spread
+# --latency-sigma), answers are about --completion-tokens long (spread
+# --tokens-sigma), and every answer token adds --token-latency seconds, paced
+# over the chunks when streaming.
+
+ANSWER = "You can make Vegetable Pad Thai: stir-fry rice noodles with tofu, carrot and bean sprouts, then add soy sauce and lime."
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def lognormal(median, sigma):
+    # median when sigma is 0
+    if median <= 0:
+        return 0.0
+    return random.lognormvariate(math.log(median), sigma) if sigma > 0 else median
+
+
+def answer_of_length(tokens):
+    # The canned answer, repeated or cut to about that many tokens
+    words = re.findall(r"\S+\s*", ANSWER)
+    text = ""
+    i = 0
+    while count_tokens(text) < tokens:
+        text += words[i % len(words)]
+        i += 1
+    return text.strip()
+
+
+def reply_for(prompt):
+    if "JSON array" in prompt:
+        ids = re.findall(r"^\[(\d+)\]$", prompt, re.M)
+        return json.dumps([
+            {"id": int(i), "Relevance": "RELEVANT", "Explanation": "The answer addresses the question."}
+            for i in ids
+        ])
+    if '"Relevance"' in prompt:
+        return json.dumps({"Relevance": "RELEVANT", "Explanation": "The answer addresses the question."})
+    return ANSWER
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    latency_sigma = 0.0
+    token_latency = 0.0
+    completion_tokens = 0
+    tokens_sigma = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        time.sleep(lognormal(self.latency, self.latency_sigma))
+
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}}, {"Retry-After": "0"})
+            else:
+                self.send_json(500, {"error": {"message": "Internal error", "type": "server_error"}})
+            return
+
+        prompt = "\n".join(m.get("content", "") for m in request.get("messages", []))
+        content = reply_for(prompt)
+        if content == ANSWER and self.completion_tokens:
+            content = answer_of_length(round(lognormal(self.completion_tokens, self.tokens_sigma)))
+        usage = {
+            "prompt_tokens": count_tokens(prompt),
+            "completion_tokens": count_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.get("model", "gpt-4o-mini")
+
+        if request.get("stream"):
+            self.stream(completion_id, model, content, usage, request.get("stream_options") or {})
+            return
+
+        time.sleep(self.token_latency * usage["completion_tokens"])
+        self.send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def stream(self, completion_id, model, content, usage, stream_options):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None, usage=None):
+            body = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage is not None:
+                body["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(body)}\n\n".encode())
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        for word in re.findall(r"\S+\s*", content):
+            time.sleep(self.token_latency * count_tokens(word))
+            chunk({"content": word})
+        chunk({}, finish_reason="stop")
+        if stream_options.get("include_usage"):
+            chunk(None, usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def serve(port=8000, latency=0.0, error_rate=0.0, latency_sigma=0.0, token_latency=0.0, completion_tokens=0, tokens_sigma=0.0):
+    Handler.latency = latency
+    Handler.latency_sigma = latency_sigma
+    Handler.token_latency = token_latency
+    Handler.completion_tokens = completion_tokens
+    Handler.tokens_sigma = tokens_sigma
+    Handler.error_rate = error_rate
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake chat completions server")
+    parser.add_argument("--port", type=int, default=int(os.getenv("FAKE_OPENAI_PORT", "8000")))
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before every response (the median, with --latency-sigma)")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="Spread of the log-normal latency; 0 for a fixed latency")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per generated token")
+    parser.add_argument("--completion-tokens", type=int, default=0, help="Median answer length in tokens; 0 for the canned answer")
+    parser.add_argument("--tokens-sigma", type=float, default=0.0, help="Spread of the log-normal answer length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with 429 or 500")
+    parser.add_argument("--seed", type=int, help="Seed for repeatable runs")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = serve(
+        args.port, args.latency, args.error_rate,
+        latency_sigma=args.latency_sigma,
+        token_latency=args.token_latency,
+        completion_tokens=args.completion_tokens,
+        tokens_sigma=args.tokens_sigma,
+    )
+    print(f"Fake chat completions API on http://localhost:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,176 @@
+import os
+import json
+import math
+
+import numpy as np
+
+RANGE_OPERATORS = {
+    "<": lambda values, x: (0, np.searchsorted(values, x, side="left")),
+    "<=": lambda values, x: (0, np.searchsorted(values, x, side="right")),
+    ">": lambda values, x: (np.searchsorted(values, x, side="right"), len(values)),
+    ">=": lambda values, x: (np.searchsorted(values, x, side="left"), len(values)),
+    "==": lambda values, x: (np.searchsorted(values, x, side="left"), np.searchsorted(values, x, side="right")),
+}
+
+
+def normalize_keyword(value):
+    return str(value).strip().lower()
+
+
+def range_condition(field, condition):
+    # (operator, number) from a filter sent by a client; anything else is a
+    # ValueError, which the API turns into a 400
+    if not isinstance(condition, (list, tuple)) or len(condition) != 2:
+        raise ValueError(f"Range filters on {field} are [operator, number] pairs, got {condition!r}")
+    op, x = condition
+    if not isinstance(op, str) or op not in RANGE_OPERATORS:
+        raise ValueError(f"Unsupported range operator {op!r} for {field}")
+    if isinstance(x, bool) or not isinstance(x, (int, float, str)):
+        raise ValueError(f"Range filters on {field} need a number, got {x!r}")
+    try:
+        x = float(x)
+    except ValueError:
+        raise ValueError(f"Range filters on {field} need a number, got {x!r}") from None
+    if not math.isfinite(x):
+        raise ValueError(f"Range filters on {field} need a finite number, got {x!r}")
+    return op, x
+
+
+class FilterIndex:
+    # Structured filters resolved to candidate document ids before scoring.
+    #
+    # Keyword fields keep a sorted posting list per (lowercased) value, so an
+    # exact match is a lookup. Numeric fields keep their values sorted together
+    # with the matching document ids, so a range is two binary searches and a
+    # slice. Filters on different fields are intersected.
+    #
+    # filter_dict uses the minsearch conventions:
+    #   {"diet": "Vegan"}                           exact match
+    #   {"cuisine": ["Thai", "Indian"]}             any of the values
+    #   {"cooking_time_minutes": [("<=", 30)]}      range, list of (op, value)
+
+    def __init__(self, num_docs, keyword_postings, numeric_values, numeric_docs):
+        self.num_docs = num_docs
+        self.keyword_postings = keyword_postings
+        self.numeric_values = numeric_values
+        self.numeric_docs = numeric_docs
+
+    @property
+    def keyword_fields(self):
+        return list(self.keyword_postings)
+
+    @property
+    def numeric_fields(self):
+        return list(self.numeric_values)
+
+    @classmethod
+    def build(cls, recipes, keyword_fields, numeric_fields):
+        keyword_postings = {}
+        for field in keyword_fields:
+            postings = {}
+            for doc_id, recipe in enumerate(recipes):
+                value = recipe.get(field)
+                values = value if isinstance(value, list) else [value]
+                for v in values:
+                    if v is not None:
+                        postings.setdefault(normalize_keyword(v), []).append(doc_id)
+            keyword_postings[field] = {v: np.array(sorted(set(ids)), dtype=np.int64) for v, ids in postings.items()}
+
+        numeric_values = {}
+        numeric_docs = {}
+        for field in numeric_fields:
+            values = []
+            doc_ids = []
+            for doc_id, recipe in enumerate(recipes):
+                try:
+                    values.append(float(recipe.get(field)))
+                    doc_ids.append(doc_id)
+                except (TypeError, ValueError):
+                    continue
+            values = np.array(values, dtype=np.float64)
+            doc_ids = np.array(doc_ids, dtype=np.int64)
+            order = np.argsort(values, kind="stable")
+            numeric_values[field] = values[order]
+            numeric_docs[field] = doc_ids[order]
+
+        return cls(len(recipes), keyword_postings, numeric_values, numeric_docs)
+
+    def save(self, path):
+        # Keyword postings are stored as one flat array per field plus offsets
+        meta = {"num_docs": self.num_docs, "keyword": {}, "numeric": self.numeric_fields}
+        for field, postings in self.keyword_postings.items():
+            values = sorted(postings)
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(postings[v]) for v in values])
+            docs = np.concatenate([postings[v] for v in values]) if values else np.zeros(0, dtype=np.int64)
+            np.save(os.path.join(path, f"filters.{field}.docs.npy"), docs)
+            meta["keyword"][field] = {"values": values, "offsets": offsets.tolist()}
+
+        for field in self.numeric_fields:
+            np.save(os.path.join(path, f"filters.{field}.values.npy"), self.numeric_values[field])
+            np.save(os.path.join(path, f"filters.{field}.docs.npy"), self.numeric_docs[field])
+
+        with open(os.path.join(path, "filters.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "filters.json"), "r") as f:
+            meta = json.load(f)
+
+        keyword_postings = {}
+        for field, spec in meta["keyword"].items():
+            docs = np.load(os.path.join(path, f"filters.{field}.docs.npy"), mmap_mode="r")
+            offsets = spec["offsets"]
+            keyword_postings[field] = {
+                v: docs[offsets[i] : offsets[i + 1]] for i, v in enumerate(spec["values"])
+            }
+
+        numeric_values = {}
+        numeric_docs = {}
+        for field in meta["numeric"]:
+            numeric_values[field] = np.load(os.path.join(path, f"filters.{field}.values.npy"), mmap_mode="r")
+            numeric_docs[field] = np.load(os.path.join(path, f"filters.{field}.docs.npy"), mmap_mode="r")
+
+        return cls(meta["num_docs"], keyword_postings, numeric_values, numeric_docs)
+
+    def keyword_candidates(self, field, value):
+        postings = self.keyword_postings[field]
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if not values:
+            raise ValueError(f"Filter on {field} needs at least one value")
+        lists = [postings.get(normalize_keyword(v), np.zeros(0, dtype=np.int64)) for v in values]
+        if len(lists) == 1:
+            return np.asarray(lists[0])
+        return np.unique(np.concatenate(lists))
+
+    def range_candidates(self, field, conditions):
+        values = self.numeric_values[field]
+        docs = self.numeric_docs[field]
+
+        lo, hi = 0, len(values)
+        if not isinstance(conditions, list):
+            conditions = [("==", conditions)]
+        for condition in conditions:
+            op, x = range_condition(field, condition)
+            start, end = RANGE_OPERATORS[op](values, x)
+            lo, hi = max(lo, start), min(hi, end)
+
+        if lo >= hi:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(docs[lo:hi])
+
+    def candidates(self, filter_dict=None):
+        # Sorted ids of the documents passing every filter, or None when there
+        # is nothing to filter on
+        result = None
+        for field, value in (filter_dict or {}).items():
+            if field in self.keyword_postings:
+                ids = self.keyword_candidates(field, value)
+            elif field in self.numeric_values:
+                ids = self.range_candidates(field, value)
+            else:
+                raise ValueError(f"Cannot filter on {field!r}")
+
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        return result
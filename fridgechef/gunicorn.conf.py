@@ -0,0 +1,55 @@
+import gc
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('APP_PORT', '5000')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+
+# "sync" serves app:app, one request per worker at a time. "asgi" serves the
+# async app (asgi:app), where each worker keeps up to worker_connections
+# requests in flight while they wait on the LLM
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# Import the app once in the master, and load the recipe index there in
+# when_ready, before forking. Workers then share the index pages instead of
+# each building their own copy: the matrices and documents are memory-mapped
+# from the snapshot, and the rest of the heap is shared copy-on-write.
+preload_app = True
+
+# Workers share their Prometheus metrics through files in this directory. It
+# must be set before the app (and with it prometheus_client) is imported.
+# Unless one is given, every server gets a fresh directory of its own, removed
+# at exit; a given one is used as it is, so it must not hold another run's files
+metrics_dir = None
+if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    metrics_dir = tempfile.mkdtemp(prefix="fridgechef-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def when_ready(server):
+    import warmup
+    warmup.warmup()
+
+    # Move everything allocated so far out of the collector's reach, so garbage
+    # collection in the workers does not touch (and copy) the shared pages
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    if metrics_dir is not None:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Database pool and LLM client, before the worker accepts requests
+    import warmup
+    warmup.warmup_worker()
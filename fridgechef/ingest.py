@@ -4,10 +4,75 @@ import pandas as pd
 import requests
 import minsearch
 import json
+import pickle
+import re
+import time
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import sklearn
+from scipy import sparse
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from recipe_index import RecipeIndex
+from ingredient_index import IngredientIndex
+from filter_index import FilterIndex
 
 DATA_PATH = os.getenv("DATA_PATH", "../Data/RecipeData.json")
+INDEX_DIR = os.getenv("INDEX_DIR", os.path.join(os.path.dirname(DATA_PATH), "index"))
+
+# Bump when the snapshot layout changes so old snapshots are refitted
+SNAPSHOT_VERSION = 8
+
+# Unfinished snapshots (".tmp-" directories) older than this many seconds are
+# left over from a crashed build and removed
+SNAPSHOT_TMP_MAX_AGE = float(os.getenv("SNAPSHOT_TMP_MAX_AGE", "3600"))
+
+TEXT_FIELDS = [
+    "dish_name",
+    "cuisine",
+    "diet",
+    "tags",
+    "main_ingredients",
+    "cooking_time_minutes",
+    "difficulty",
+    "ingredients_full",
+    "instructions",
+    "substitutions",
+    "flavor_notes",
+]
+
+entry_template = """
+dish_name: {dish_name}
+cuisine: {cuisine}
+diet: {diet}
+tags: {tags}
+main_ingredients: {main_ingredients}
+cooking_time_minutes: {cooking_time_minutes}
+difficulty: {difficulty}
+ingredients_full: {ingredients_full}
+instructions: {instructions}
+substitutions: {substitutions}
+flavor_notes: {flavor_notes}
+""".strip()
+
+# Compact form of a recipe for lower-ranked hits when the prompt is over its token budget
+SUMMARY_FIELDS = ["dish_name", "cuisine", "diet", "main_ingredients", "cooking_time_minutes", "difficulty"]
+
+summary_template = "\n".join(f"{field}: {{{field}}}" for field in SUMMARY_FIELDS)
+
+# Structured fields for exact-match and range filters, indexed from the raw values
+KEYWORD_FIELDS = ["cuisine", "diet", "difficulty"]
+NUMERIC_FIELDS = ["cooking_time_minutes"]
+
 
-def load_index(data_path= DATA_PATH): #'https://raw.githubusercontent.com/eadka/fridgechef/main/Data/RecipeData.json'):
+def read_recipes(data_path=DATA_PATH): #'https://raw.githubusercontent.com/eadka/fridgechef/main/Data/RecipeData.json'):
 
     # data_response = requests.get(data_path)
     # recipes_data = data_response.json()
@@ -15,34 +80,386 @@ def load_index(data_path= DATA_PATH): #'https://raw.githubusercontent.com/eadka/
     with open(data_path, "r") as f:
         recipes_data = json.load(f)
 
+    return recipes_data
+
+
+def flatten_recipes(recipes_data):
     # Ensuring all the data has strings because minsearch, under the hood uses TfidfVectorizer and expects each text_field to be a string
+    # This is the original flattening; it is kept for the projection report only
     for recipe in recipes_data:
-        for field in ["dish_name",  "cuisine",  "diet", "tags",  "main_ingredients", 
-                    "cooking_time_minutes", "difficulty",  "ingredients_full", 
-                    "instructions", "substitutions", "flavor_notes"]:
+        for field in TEXT_FIELDS:
             value = recipe.get(field, "")
             if isinstance(value,list):
                 recipe[field] = " ".join(map(str,value)) # join the list into string
             elif not isinstance(value, str):
                 recipe[field] = str(value) # convert numbers to string
 
+    return recipes_data
+
+
+def unique(items):
+    seen = set()
+    result = []
+    for item in items:
+        item = str(item).strip()
+        if item and item.lower() not in seen:
+            seen.add(item.lower())
+            result.append(item)
+    return result
+
+
+def project_text(value):
+    # Clean token stream for indexing: the names in a structured value, deduplicated,
+    # without quantities or Python repr punctuation
+    if isinstance(value, dict):
+        if "item" in value:
+            return project_text(value["item"])
+        # substitutions: {"tofu": ["tempeh", "chickpeas"]}
+        names = []
+        for key, alternatives in value.items():
+            names.append(key)
+            names.extend(alternatives if isinstance(alternatives, list) else [alternatives])
+        return " ".join(unique(project_text(name) for name in names))
+    if isinstance(value, list):
+        return " ".join(unique(project_text(item) for item in value))
+    if value is None:
+        return ""
+    return str(value)
+
+
+def render_text(value):
+    # Readable text for the prompt, keeping the quantities next to their items
+    if isinstance(value, dict):
+        if "item" in value:
+            return " ".join(str(value[key]) for key in ["quantity", "item"] if value.get(key))
+        return "; ".join(f"{key}: {render_text(alternatives)}" for key, alternatives in value.items())
+    if isinstance(value, list):
+        items = [render_text(item) for item in value]
+        # Lists of sentences (instructions) read better without commas
+        separator = " " if items and all(item.endswith((".", "!", "?")) for item in items) else ", "
+        return separator.join(items)
+    if value is None:
+        return ""
+    return str(value)
+
+
+def project_recipes(recipes_data):
+    # Returns the texts to index and the documents to store and show, per recipe
+    texts = []
+    docs = []
+    for recipe in recipes_data:
+        texts.append({field: project_text(recipe.get(field, "")) for field in TEXT_FIELDS})
+        doc = {field: render_text(recipe.get(field, "")) for field in TEXT_FIELDS}
+        doc.update({key: value for key, value in recipe.items() if key not in TEXT_FIELDS})
+        docs.append(doc)
+    return texts, docs
+
+
+def get_encoding():
+    # tiktoken is optional; without it (or its encoding files) token counts are
+    # estimated at four characters per token
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4o-mini")
+    except Exception:
+        return None
+
+
+ENCODING = get_encoding()
+TOKENIZER = ENCODING.name if ENCODING is not None else "chars/4"
+
+
+def count_tokens(text):
+    if ENCODING is not None:
+        return len(ENCODING.encode(text))
+    return (len(text) + 3) // 4
+
+
+def render_contexts(docs):
+    # Each recipe's full and compact prompt blocks are rendered once at ingest time,
+    # together with the token count of every field line in them
+    contexts = [entry_template.format(**doc) for doc in docs]
+    summaries = [summary_template.format(**doc) for doc in docs]
+    field_tokens = np.array(
+        [[count_tokens(f"{field}: {doc[field]}") for field in TEXT_FIELDS] for doc in docs],
+        dtype=np.int32,
+    ).reshape(len(docs), len(TEXT_FIELDS))
+    return contexts, summaries, field_tokens
+
+
+def fit_text_index(texts):
     # Search engine and indexing
     # Indexing the document
     index = minsearch.Index(
-        text_fields=[
-            "dish_name",  
-            "cuisine",  
-            "diet", 
-            "tags",  
-            "main_ingredients", 
-            "cooking_time_minutes", 
-            "difficulty",  
-            "ingredients_full", 
-            "instructions", 
-            "substitutions", 
-            "flavor_notes"],
+        text_fields=TEXT_FIELDS,
         keyword_fields=[]
     )
 
-    index.fit(recipes_data)
-    return index
\ No newline at end of file
+    index.fit(texts)
+    return index
+
+
+def build_index(data_path=DATA_PATH):
+    recipes_data = read_recipes(data_path)
+
+    ingredients = IngredientIndex.build(recipes_data)
+    filters = FilterIndex.build(recipes_data, KEYWORD_FIELDS, NUMERIC_FIELDS)
+    texts, docs = project_recipes(recipes_data)
+
+    contexts, summaries, field_tokens = render_contexts(docs)
+
+    index = fit_text_index(texts)
+    return RecipeIndex.from_minsearch(
+        index,
+        docs=docs,
+        filters=filters,
+        ingredients=ingredients,
+        contexts=contexts,
+        summaries=summaries,
+        field_tokens=field_tokens,
+    )
+
+
+def index_stats(index):
+    fields = {
+        field: {
+            "vocabulary": len(index.vectorizers[field].vocabulary_),
+            "nnz": int(index.text_matrices[field].nnz),
+        }
+        for field in index.text_fields
+    }
+    return {
+        "vocabulary": sum(stats["vocabulary"] for stats in fields.values()),
+        "nnz": sum(stats["nnz"] for stats in fields.values()),
+        "fields": fields,
+    }
+
+
+def projection_report(data_path=DATA_PATH):
+    # Vocabulary size and matrix nnz with the original flattening and with the projection
+    flattened = fit_text_index(flatten_recipes(read_recipes(data_path)))
+    texts, _ = project_recipes(read_recipes(data_path))
+    projected = fit_text_index(texts)
+    return {"flattened": index_stats(flattened), "projected": index_stats(projected)}
+
+
+def write_store(path, name, items):
+    # Stores items as one JSON line each plus an offsets array, so the payload
+    # can be memory-mapped and decoded per hit instead of held in the heap
+    offsets = [0]
+    with open(os.path.join(path, f"{name}.jsonl"), "wb") as f:
+        for item in items:
+            line = json.dumps(item).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(os.path.join(path, f"{name}.offsets.npy"), np.array(offsets, dtype=np.int64))
+
+
+class DocStore:
+    # Read-only, list-like view over the documents (or other items) of a snapshot.
+    # The file is memory-mapped, so every process that opens the same snapshot
+    # shares one copy of the payload through the page cache.
+
+    def __init__(self, snapshot_path, name="docs"):
+        self.offsets = np.load(os.path.join(snapshot_path, f"{name}.offsets.npy"), mmap_mode="r")
+        path = os.path.join(snapshot_path, f"{name}.jsonl")
+        if os.path.getsize(path) > 0:
+            self.payload = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            self.payload = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("document index out of range")
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return json.loads(self.payload[start:end].tobytes())
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def dataset_prefix(data_path=DATA_PATH):
+    # Names the data file in its snapshots' keys, so datasets sharing an
+    # INDEX_DIR only ever prune their own snapshots
+    name = re.sub(r"[^A-Za-z0-9]+", "_", os.path.splitext(os.path.basename(data_path))[0]) or "data"
+    path_hash = hashlib.sha256(os.path.abspath(data_path).encode("utf-8")).hexdigest()[:8]
+    return f"{name}-{path_hash}-"
+
+
+def snapshot_key(data_path=DATA_PATH):
+    # The key covers the data file contents and everything that shapes the fitted index,
+    # including the library versions the vectorizers are pickled with
+    h = hashlib.sha256()
+    with open(data_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    config = {
+        "snapshot_version": SNAPSHOT_VERSION,
+        "text_fields": TEXT_FIELDS,
+        "keyword_fields": KEYWORD_FIELDS,
+        "numeric_fields": NUMERIC_FIELDS,
+        "minsearch": minsearch.__version__,
+        "sklearn": sklearn.__version__,
+        "entry_template": entry_template,
+        "summary_template": summary_template,
+        "tokenizer": TOKENIZER,
+    }
+    h.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+    return dataset_prefix(data_path) + h.hexdigest()[:16]
+
+
+def prune_snapshots(key, index_dir=INDEX_DIR):
+    # Keeps the snapshot just published and the one before it of the same
+    # dataset, which workers started earlier may still have mapped. Older ones
+    # of that dataset go, and so do unfinished snapshots of any dataset that
+    # are too old to still be in progress. Processes still mapping a removed
+    # snapshot keep their pages
+    prefix = key.rsplit("-", 1)[0] + "-"
+    siblings = []
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if name.startswith(".tmp-"):
+            try:
+                if time.time() - os.path.getmtime(path) > SNAPSHOT_TMP_MAX_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        elif name != key and name.startswith(prefix) and os.path.isdir(path):
+            siblings.append((os.path.getmtime(path), name))
+
+    for _, name in sorted(siblings, reverse=True)[1:]:
+        shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def save_snapshot(index, key, index_dir=INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    snapshot_path = os.path.join(index_dir, key)
+
+    # Write into a temporary directory and rename it into place, so a worker never
+    # sees a half-written snapshot and concurrent writers do not clobber each other
+    tmp_path = tempfile.mkdtemp(prefix=f".tmp-{key}-", dir=index_dir)
+    try:
+        with open(os.path.join(tmp_path, "vectorizers.pkl"), "wb") as f:
+            pickle.dump(index.vectorizers, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        write_store(tmp_path, "docs", index.docs)
+        write_store(tmp_path, "contexts", index.contexts)
+        write_store(tmp_path, "summaries", index.summaries)
+        np.save(os.path.join(tmp_path, "fields.tokens.npy"), index.field_tokens)
+
+        for part in ["data", "indices", "indptr"]:
+            np.save(os.path.join(tmp_path, f"matrix.{part}.npy"), getattr(index.matrix, part))
+            np.save(os.path.join(tmp_path, f"rows.{part}.npy"), getattr(index.rows, part))
+
+        index.filters.save(tmp_path)
+        index.ingredients.save(tmp_path)
+
+        meta = {
+            "key": key,
+            "text_fields": index.text_fields,
+            "shape": list(index.matrix.shape),
+            "field_offsets": [int(offset) for offset in index.field_offsets],
+        }
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        os.rename(tmp_path, snapshot_path)
+    except OSError:
+        # Another process finished the same snapshot first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(snapshot_path):
+            raise
+
+    prune_snapshots(key, index_dir)
+    return snapshot_path
+
+
+def load_snapshot(key, index_dir=INDEX_DIR):
+    snapshot_path = os.path.join(index_dir, key)
+    if not os.path.isfile(os.path.join(snapshot_path, "meta.json")):
+        return None
+
+    with open(os.path.join(snapshot_path, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    with open(os.path.join(snapshot_path, "vectorizers.pkl"), "rb") as f:
+        vectorizers = pickle.load(f)
+
+    docs = DocStore(snapshot_path)
+
+    # The matrix arrays are memory-mapped read-only, so the OS page cache backs them
+    # and they are never copied into the process heap
+    def load_matrix(name, fmt):
+        arrays = [
+            np.load(os.path.join(snapshot_path, f"{name}.{part}.npy"), mmap_mode="r")
+            for part in ["data", "indices", "indptr"]
+        ]
+        return fmt(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+
+    return RecipeIndex(
+        text_fields=meta["text_fields"],
+        vectorizers=vectorizers,
+        matrix=load_matrix("matrix", sparse.csc_matrix),
+        rows=load_matrix("rows", sparse.csr_matrix),
+        field_offsets=meta["field_offsets"],
+        docs=docs,
+        filters=FilterIndex.load(snapshot_path),
+        ingredients=IngredientIndex.load(snapshot_path),
+        contexts=DocStore(snapshot_path, "contexts"),
+        summaries=DocStore(snapshot_path, "summaries"),
+        field_tokens=np.load(os.path.join(snapshot_path, "fields.tokens.npy"), mmap_mode="r"),
+        key=key,
+    )
+
+
+def load_index(data_path=DATA_PATH, index_dir=INDEX_DIR):
+    key = snapshot_key(data_path)
+
+    index = load_snapshot(key, index_dir)
+    if index is not None:
+        print(f"Loaded index snapshot {key} from {index_dir}")
+        return index
+
+    print(f"No index snapshot for {key}, fitting index from {data_path}")
+    index = build_index(data_path)
+    try:
+        save_snapshot(index, key, index_dir)
+    except OSError as e:
+        print(f"Could not save index snapshot: {e}")
+        index.key = key
+        return index
+
+    # Serve from the snapshot even right after fitting, so the fitting process
+    # and every process forked from it map the same read-only pages
+    return load_snapshot(key, index_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the recipe index snapshot")
+    parser.add_argument(
+        "--report", action="store_true", help="Print vocabulary size and nnz before and after field projection"
+    )
+    args = parser.parse_args()
+
+    if args.report:
+        report = projection_report()
+        for field in TEXT_FIELDS:
+            before = report["flattened"]["fields"][field]
+            after = report["projected"]["fields"][field]
+            print(f"{field:22} vocabulary {before['vocabulary']:6} -> {after['vocabulary']:6}   nnz {before['nnz']:8} -> {after['nnz']:8}")
+        before, after = report["flattened"], report["projected"]
+        print(f"{'total':22} vocabulary {before['vocabulary']:6} -> {after['vocabulary']:6}   nnz {before['nnz']:8} -> {after['nnz']:8}")
+    else:
+        load_index()
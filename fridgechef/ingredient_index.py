@@ -0,0 +1,136 @@
+import os
+import re
+import json
+
+import numpy as np
+
+# Words that end in "s" but are not plurals
+SINGULAR_EXCEPTIONS = {"asparagus", "hummus", "couscous", "molasses", "swiss", "citrus", "harissa"}
+IRREGULAR_PLURALS = {"leaves": "leaf", "halves": "half"}
+
+
+def normalize_word(word):
+    if word in SINGULAR_EXCEPTIONS or len(word) <= 3:
+        return word
+    if word in IRREGULAR_PLURALS:
+        return IRREGULAR_PLURALS[word]
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith("oes") or word.endswith("ches") or word.endswith("shes"):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    return [normalize_word(word) for word in re.findall(r"[a-z]+", text.lower())]
+
+
+def normalize_ingredient(name):
+    return " ".join(tokenize(name))
+
+
+class IngredientIndex:
+    # Exact "what can I cook with ..." matching over each recipe's main ingredients.
+    #
+    # Ingredient names are normalized into a vocabulary; every recipe gets a bitset
+    # with one bit per vocabulary entry, and every ingredient a posting list of the
+    # recipes that use it. A fridge is encoded as a bitset too, so coverage and
+    # missing-ingredient counts are a bitwise AND and a popcount per recipe.
+
+    def __init__(self, vocabulary, bits, postings_indptr, postings_docs):
+        self.vocabulary = list(vocabulary)
+        self.ids = {name: i for i, name in enumerate(self.vocabulary)}
+        self.bits = bits
+        self.postings_indptr = postings_indptr
+        self.postings_docs = postings_docs
+        self.num_words = bits.shape[1]
+        self.needed = np.bitwise_count(bits).sum(axis=1).astype(np.int32)
+        self.max_phrase = max((len(name.split()) for name in self.vocabulary), default=0)
+
+    @classmethod
+    def build(cls, recipes, field="main_ingredients"):
+        recipe_ingredients = []
+        vocabulary = {}
+        for recipe in recipes:
+            names = {normalize_ingredient(name) for name in recipe.get(field, []) or []}
+            names.discard("")
+            recipe_ingredients.append(sorted(names))
+            for name in names:
+                vocabulary.setdefault(name, len(vocabulary))
+
+        vocabulary = sorted(vocabulary)
+        ids = {name: i for i, name in enumerate(vocabulary)}
+        num_words = max(1, (len(vocabulary) + 63) // 64)
+
+        bits = np.zeros((len(recipes), num_words), dtype=np.uint64)
+        postings = [[] for _ in vocabulary]
+        for doc_id, names in enumerate(recipe_ingredients):
+            for name in names:
+                i = ids[name]
+                bits[doc_id, i // 64] |= np.uint64(1) << np.uint64(i % 64)
+                postings[i].append(doc_id)
+
+        postings_indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        postings_indptr[1:] = np.cumsum([len(docs) for docs in postings])
+        postings_docs = np.array([doc_id for docs in postings for doc_id in docs], dtype=np.int64)
+
+        return cls(vocabulary, bits, postings_indptr, postings_docs)
+
+    def save(self, path):
+        np.save(os.path.join(path, "ingredients.bits.npy"), self.bits)
+        np.save(os.path.join(path, "ingredients.postings_indptr.npy"), self.postings_indptr)
+        np.save(os.path.join(path, "ingredients.postings_docs.npy"), self.postings_docs)
+        with open(os.path.join(path, "ingredients.vocabulary.json"), "w") as f:
+            json.dump(self.vocabulary, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "ingredients.vocabulary.json"), "r") as f:
+            vocabulary = json.load(f)
+        return cls(
+            vocabulary,
+            np.load(os.path.join(path, "ingredients.bits.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "ingredients.postings_indptr.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "ingredients.postings_docs.npy"), mmap_mode="r"),
+        )
+
+    def match(self, text):
+        # Longest-first phrase matching, so "spring onions" wins over "onion"
+        words = tokenize(text)
+        found = []
+        i = 0
+        while i < len(words):
+            for size in range(min(self.max_phrase, len(words) - i), 0, -1):
+                ingredient_id = self.ids.get(" ".join(words[i : i + size]))
+                if ingredient_id is not None:
+                    found.append(ingredient_id)
+                    i += size
+                    break
+            else:
+                i += 1
+        return sorted(set(found))
+
+    def fridge(self, ingredient_ids):
+        fridge = np.zeros(self.num_words, dtype=np.uint64)
+        for i in ingredient_ids:
+            fridge[i // 64] |= np.uint64(1) << np.uint64(i % 64)
+        return fridge
+
+    def candidates(self, ingredient_ids):
+        # Recipes that use at least one of the ingredients, from the posting lists
+        if not ingredient_ids:
+            return np.zeros(0, dtype=np.int64)
+        lists = [self.postings_docs[self.postings_indptr[i] : self.postings_indptr[i + 1]] for i in ingredient_ids]
+        return np.unique(np.concatenate(lists))
+
+    def coverage(self, ingredient_ids, doc_ids=None):
+        # Returns (have, missing, coverage) for the given recipes, or for all of them
+        bits = self.bits if doc_ids is None else self.bits[doc_ids]
+        needed = self.needed if doc_ids is None else self.needed[doc_ids]
+
+        have = np.bitwise_count(bits & self.fridge(ingredient_ids)).sum(axis=1).astype(np.int32)
+        missing = needed - have
+        coverage = np.divide(have, needed, out=np.zeros(len(have)), where=needed > 0)
+        return have, missing, coverage
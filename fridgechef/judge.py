@@ -0,0 +1,53 @@
+import argparse
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+import rag
+
+
+def judge(df, batch_size=10, model=rag.JUDGE_MODEL):
+    # Adds relevance and explanation columns to a dataframe with question and
+    # answer columns, judging batch_size answers per LLM call
+    verdicts = []
+    usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    pairs = list(zip(df["question"], df["answer"]))
+    for start in tqdm(range(0, len(pairs), batch_size)):
+        batch_verdicts, tokens = rag.evaluate_relevance_batch(pairs[start : start + batch_size], model=model)
+        verdicts.extend(batch_verdicts)
+        usage["requests"] += 1
+        for name in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            usage[name] += tokens[name]
+
+    df = df.copy()
+    df["relevance"] = [v["Relevance"] for v in verdicts]
+    df["explanation"] = [v["Explanation"] for v in verdicts]
+    usage["openai_cost"] = rag.calculate_openai_cost(model, usage)
+    return df, usage
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Judge the relevance of RAG answers in batches, e.g. ../Data/rag-eval-gpt-4o-mini.csv"
+    )
+    parser.add_argument("input", help="CSV file with question and answer columns")
+    parser.add_argument("--output", help="Where to write the judged CSV (default: print a summary only)")
+    parser.add_argument("--batch-size", type=int, default=10, help="Answers judged per LLM call")
+    parser.add_argument("--model", default=rag.JUDGE_MODEL, help="Judge model")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input)
+    judged, usage = judge(df, batch_size=args.batch_size, model=args.model)
+
+    if args.output:
+        judged.to_csv(args.output, index=False)
+
+    print(judged.relevance.value_counts(normalize=True))
+    print(f"{len(judged)} answers judged with {usage['requests']} requests")
+    print(f"tokens per answer: {usage['total_tokens'] / max(len(judged), 1):.0f}")
+    print(f"cost: ${usage['openai_cost']:.4f}")
+
+    if "relevance" in df.columns:
+        agreement = (df["relevance"].values == judged["relevance"].values).mean()
+        print(f"agreement with the existing verdicts: {agreement:.1%}")
@@ -0,0 +1,203 @@
+import os
+import random
+import asyncio
+import threading
+from time import time, sleep
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+import metrics
+
+# All chat-completion calls go through here. One pooled HTTP client per process,
+# a deadline per call, retries with jittered exponential backoff on rate limits,
+# server errors and timeouts, and a cap on the number of calls in flight.
+#
+# OPENAI_BASE_URL points the client at any chat-completions compatible server,
+# e.g. the local fake in fake_openai.py.
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Seconds for connecting and for each attempt; LLM_DEADLINE bounds the whole
+# call including retries and backoff
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "60"))
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+
+# Calls in flight per process (request threads and evaluator threads together),
+# and how long a call waits for a free slot before giving up
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", str(LLM_MAX_CONCURRENCY)))
+
+# The async app (asgi.py) waits on the LLM without holding a thread, so one
+# process can keep many more calls in flight
+LLM_ASYNC_MAX_CONCURRENCY = int(os.getenv("LLM_ASYNC_MAX_CONCURRENCY", "256"))
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+class LLMError(Exception):
+    # The call failed after all retries, or ran out of time
+    pass
+
+
+class LLMBusyError(LLMError):
+    # No concurrency slot became free in time
+    pass
+
+
+slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+
+# Sockets must not be shared between forked processes, so the client is
+# created on first use in every process
+lock = threading.Lock()
+client = None
+client_pid = None
+
+
+def get_client():
+    global client, client_pid
+    with lock:
+        if client is None or client_pid != os.getpid():
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE),
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            )
+            client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                base_url=OPENAI_BASE_URL,
+                http_client=http_client,
+                max_retries=0,
+            )
+            client_pid = os.getpid()
+        return client
+
+
+# The async client and its semaphore belong to the event loop they were made in
+async_clients = {}
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    if loop not in async_clients:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_ASYNC_MAX_CONCURRENCY, max_keepalive_connections=LLM_ASYNC_MAX_CONCURRENCY),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        async_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=OPENAI_BASE_URL,
+            http_client=http_client,
+            max_retries=0,
+        )
+        async_clients[loop] = (async_client, asyncio.Semaphore(LLM_ASYNC_MAX_CONCURRENCY))
+    return async_clients[loop]
+
+
+def backoff(attempt, error=None):
+    # Full jitter, but never shorter than a Retry-After sent by the server
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2**attempt))
+
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+def create(deadline, **kwargs):
+    # chat.completions.create with retries, within the deadline
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise LLMError("LLM deadline exceeded")
+
+        try:
+            return get_client().chat.completions.create(timeout=min(LLM_TIMEOUT, remaining), **kwargs)
+        except RETRYABLE_ERRORS as e:
+            delay = backoff(attempt, e)
+            if attempt == LLM_MAX_RETRIES or time() + delay >= deadline:
+                metrics.llm_failures.inc()
+                raise LLMError(f"LLM call failed: {e}") from e
+            metrics.llm_retries.inc()
+            sleep(delay)
+
+
+def acquire():
+    if not slots.acquire(timeout=LLM_QUEUE_TIMEOUT):
+        metrics.llm_failures.inc()
+        raise LLMBusyError("Too many LLM calls in flight")
+    metrics.llm_in_flight.inc()
+
+
+def release():
+    metrics.llm_in_flight.dec()
+    slots.release()
+
+
+def chat(messages, model="gpt-4o-mini", deadline=LLM_DEADLINE, **kwargs):
+    acquire()
+    try:
+        return create(time() + deadline, model=model, messages=messages, **kwargs)
+    finally:
+        release()
+
+
+def chat_stream(messages, model="gpt-4o-mini", deadline=LLM_DEADLINE, **kwargs):
+    # Yields the stream chunks. The slot is held until the stream is consumed or
+    # closed; only opening the stream is retried, not a stream cut halfway
+    acquire()
+    try:
+        stream = create(time() + deadline, model=model, messages=messages, stream=True, **kwargs)
+        try:
+            yield from stream
+        except (openai.APIError, httpx.HTTPError) as e:
+            raise LLMError(f"LLM stream failed: {e}") from e
+        finally:
+            stream.close()
+    finally:
+        release()
+
+
+async def acreate(deadline, **kwargs):
+    async_client, _ = get_async_client()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise LLMError("LLM deadline exceeded")
+
+        try:
+            return await async_client.chat.completions.create(timeout=min(LLM_TIMEOUT, remaining), **kwargs)
+        except RETRYABLE_ERRORS as e:
+            delay = backoff(attempt, e)
+            if attempt == LLM_MAX_RETRIES or time() + delay >= deadline:
+                metrics.llm_failures.inc()
+                raise LLMError(f"LLM call failed: {e}") from e
+            metrics.llm_retries.inc()
+            await asyncio.sleep(delay)
+
+
+async def achat(messages, model="gpt-4o-mini", deadline=LLM_DEADLINE, **kwargs):
+    # Same policy as chat() for the async app, capped at LLM_ASYNC_MAX_CONCURRENCY
+    # calls per event loop
+    _, async_slots = get_async_client()
+    try:
+        await asyncio.wait_for(async_slots.acquire(), LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.llm_failures.inc()
+        raise LLMBusyError("Too many LLM calls in flight")
+    metrics.llm_in_flight.inc()
+    try:
+        return await acreate(time() + deadline, model=model, messages=messages, **kwargs)
+    finally:
+        metrics.llm_in_flight.dec()
+        async_slots.release()
@@ -0,0 +1,120 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Prometheus metrics, served by GET /metrics. Under gunicorn every worker
+# writes its values to memory-mapped files in PROMETHEUS_MULTIPROC_DIR (set in
+# gunicorn.conf.py), and /metrics adds up the files of all workers, so any
+# worker gives the totals. Without that variable the metrics are per process.
+#
+# Recording is an update of a memory-mapped float: a few microseconds. Looking
+# up a labelled series costs about as much again, so the series used on the
+# request path are bound once and kept.
+
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Seconds; generation and whole requests take up to a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+requests = Counter("fridgechef_requests_total", "HTTP requests", ["endpoint", "status"])
+request_seconds = Histogram(
+    "fridgechef_request_seconds", "Time to the response (to the headers, for streams)", ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STAGES = ("retrieval", "prompt", "generation", "evaluation", "db_write")
+stage_seconds = Histogram(
+    "fridgechef_stage_seconds", "Time per pipeline stage; db_write is per write-behind flush", ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+stages = {stage: stage_seconds.labels(stage) for stage in STAGES}
+
+llm_in_flight = Gauge("fridgechef_llm_in_flight", "LLM calls in flight", multiprocess_mode="livesum")
+llm_retries = Counter("fridgechef_llm_retries_total", "LLM calls retried after an error")
+llm_failures = Counter("fridgechef_llm_failures_total", "LLM calls that failed after all retries or timed out")
+
+tokens = Counter("fridgechef_tokens_total", "Tokens used", ["model", "kind"])
+cost = Counter("fridgechef_cost_dollars_total", "OpenAI cost", ["model"])
+
+db_pool_wait_seconds = Histogram(
+    "fridgechef_db_pool_wait_seconds", "Time waited for a pooled database connection",
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+db_rows_written = Counter("fridgechef_db_rows_written_total", "Rows written by the write-behind buffer")
+
+# Hit ratio: sum of the *_hits rates over the sum of all rates
+answer_cache = Counter("fridgechef_answer_cache_lookups_total", "Answer cache lookups", ["result"])
+answer_cache_results = {
+    result: answer_cache.labels(result) for result in ("memory_hits", "shared_hits", "misses")
+}
+
+evaluations = Counter("fridgechef_evaluations_total", "Relevance verdicts", ["relevance"])
+RELEVANCE_LABELS = ("RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT")
+
+
+series = {}
+
+
+def bound(metric, *labels):
+    key = (metric, labels)
+    child = series.get(key)
+    if child is None:
+        child = series.setdefault(key, metric.labels(*labels))
+    return child
+
+
+def observe_answer(answer_data):
+    # Stage timings, tokens and cost of an answer
+    stages["retrieval"].observe(answer_data.get("retrieval_time", 0.0))
+    if answer_data.get("cached"):
+        return
+    stages["prompt"].observe(answer_data.get("prompt_time", 0.0))
+    stages["generation"].observe(answer_data.get("generation_time", 0.0))
+
+    model = answer_data["model_used"]
+    bound(tokens, model, "prompt").inc(answer_data["prompt_tokens"])
+    bound(tokens, model, "completion").inc(answer_data["completion_tokens"])
+    bound(cost, model).inc(answer_data["openai_cost"])
+
+
+def observe_evaluation(model, token_stats, openai_cost, seconds):
+    stages["evaluation"].observe(seconds)
+    bound(tokens, model, "eval_prompt").inc(token_stats.get("prompt_tokens", 0))
+    bound(tokens, model, "eval_completion").inc(token_stats.get("completion_tokens", 0))
+    bound(cost, model).inc(openai_cost)
+
+
+def observe_verdict(relevance):
+    # Whatever else the judge answered is counted as UNKNOWN, to keep the
+    # number of series bounded
+    bound(evaluations, relevance if relevance in RELEVANCE_LABELS else "UNKNOWN").inc()
+
+
+def observe_request(endpoint, status, seconds):
+    bound(requests, endpoint, status).inc()
+    bound(request_seconds, endpoint).observe(seconds)
+
+
+def render():
+    # Returns (body, content type) for /metrics
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    # From gunicorn's child_exit: drops the live gauges of a worker that exited
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
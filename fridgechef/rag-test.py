@@ -464,6 +464,38 @@ def minsearch_improved(query):
 evaluate(ground_truth, lambda q: minsearch_improved(q['question']))
 
 
+# ### Batch retrieval evaluation
+# Scores all questions in one matrix product instead of one search per question
+
+# In[ ]:
+
+
+import rag
+
+def evaluate_batch(ground_truth, boost=None, num_results=10):
+    questions = [q['question'] for q in ground_truth]
+    results = rag.search_batch(questions, boost=boost, num_results=num_results)
+
+    relevance_total = []
+    for q, doc_ids in zip(ground_truth, results):
+        relevance = [rag.get_index().docs[i]['dish_name'] == q['id'] for i in doc_ids]
+        relevance_total.append(relevance)
+
+    return {
+        'hit_rate': hit_rate(relevance_total),
+        'mrr': mrr(relevance_total),
+    }
+
+
+# In[ ]:
+
+
+def objective_batch(boost_params):
+    return evaluate_batch(gt_val, boost_params)['mrr']
+
+simple_optimize(param_ranges, objective_batch, n_iterations=200)
+
+
 # ### RAG evaluation
 
 # #### gpt-4o-mini
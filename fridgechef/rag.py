@@ -1,26 +1,74 @@
 import json
+import hashlib
 import ingest
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import asyncio
+import threading
 from time import time
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-index = ingest.load_index()
 
-def search(query):
-    boost = {}
+import llm_client
+import answer_cache
+import metrics
 
-    results = index.search(
+# Loaded on first use, or up front by warmup(); importing this module does
+# not touch the disk or the network
+index = None
+index_lock = threading.Lock()
+
+
+def get_index():
+    global index
+    if index is None:
+        with index_lock:
+            if index is None:
+                index = ingest.load_index()
+    return index
+
+# Weight of the fridge coverage signal (share of a recipe's main ingredients
+# named in the question) added to the text score
+INGREDIENT_BOOST = float(os.getenv("INGREDIENT_BOOST", "0.5"))
+
+# ingredients_full mostly repeats main_ingredients; before the ingest projection
+# its repr noise diluted it to about this weight
+DEFAULT_BOOST = {"ingredients_full": 0.25}
+
+def search(query, filters=None, max_missing=None):
+    boost = DEFAULT_BOOST
+
+    # filters are resolved to candidate recipes before scoring, e.g.
+    # {"diet": "Vegan", "cooking_time_minutes": [["<=", 30]]}
+    results = get_index().search(
         query=query,
-        filter_dict={},
+        filter_dict=filters or {},
         boost_dict=boost,
-        num_results=5
+        num_results=5,
+        output_ids=True,
+        ingredient_boost=INGREDIENT_BOOST,
+        max_missing=max_missing
     )
 
     return results
 
+
+def search_batch(queries, boost=None, num_results=5, filters=None):
+    if boost is None:
+        boost = DEFAULT_BOOST
+
+    # Top-k document ids per query, scored together in one matrix product;
+    # use index.docs[i] to get the recipe for an id
+    results = get_index().search_batch(
+        queries=list(queries),
+        filter_dict=filters or {},
+        boost_dict=boost,
+        num_results=num_results,
+        ingredient_boost=INGREDIENT_BOOST
+    )
+
+    return [doc_ids.tolist() for doc_ids in results]
+
 prompt_template = """
 You're a "Fridge Chef", a helpful cooking assistant. 
 The user will give you a list of vegetables or ingredients they have available.
@@ -33,32 +81,154 @@ CONTEXT:
 {context}
 """.strip()
 
-entry_template = """
-dish_name: {dish_name}
-cuisine: {cuisine}
-diet: {diet}
-tags: {tags}
-main_ingredients: {main_ingredients}
-cooking_time_minutes: {cooking_time_minutes}
-difficulty: {difficulty}
-ingredients_full: {ingredients_full}
-instructions: {instructions}
-substitutions: {substitutions}
-flavor_notes: {flavor_notes}
-""".strip()
+entry_template = ingest.entry_template
+
+# Prompt context budget: the top hits keep their full recipe, lower-ranked hits
+# are cut down to a summary, and hits that do not fit are dropped.
+# A budget of 0 disables packing.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "800"))
+FULL_CONTEXT_HITS = int(os.getenv("FULL_CONTEXT_HITS", "2"))
 
-def build_prompt(query, search_results):
-    context = ""
+SUMMARY_COLUMNS = [ingest.TEXT_FIELDS.index(field) for field in ingest.SUMMARY_FIELDS]
 
-    for doc in search_results:
-        context = context + entry_template.format(**doc) + "\n\n"
+
+def pack_context(search_results, token_budget=CONTEXT_TOKEN_BUDGET, full_hits=FULL_CONTEXT_HITS):
+    # Recipes returned with an "_id" use the blocks rendered at ingest time.
+    # Returns the context and the number of tokens saved against full blocks.
+    index = get_index()
+    blocks = []
+    used = 0
+    full_total = 0
+
+    for rank, doc in enumerate(search_results):
+        if "_id" not in doc or index.contexts is None:
+            blocks.append(entry_template.format(**doc))
+            continue
+
+        doc_id = doc["_id"]
+        tokens = index.field_tokens[doc_id]
+        full = int(tokens.sum())
+        summary = int(tokens[SUMMARY_COLUMNS].sum())
+        full_total += full
+
+        # The best match always keeps its full recipe
+        if token_budget <= 0 or rank == 0 or (rank < full_hits and used + full <= token_budget):
+            blocks.append(index.contexts[doc_id])
+            used += full
+        elif used + summary <= token_budget:
+            blocks.append(index.summaries[doc_id])
+            used += summary
+
+    context = "".join(block + "\n\n" for block in blocks)
+    return context, full_total - used
+
+
+def build_prompt_packed(query, search_results, token_budget=CONTEXT_TOKEN_BUDGET):
+    context, tokens_saved = pack_context(search_results, token_budget)
 
     prompt = prompt_template.format(question=query, context=context).strip()
+    return prompt, tokens_saved
+
+
+def build_prompt(query, search_results, token_budget=CONTEXT_TOKEN_BUDGET):
+    prompt, _ = build_prompt_packed(query, search_results, token_budget)
     return prompt
 
 
+# Answers to repeated questions are served from the cache without calling the
+# LLM. The key is the normalized question plus the set of retrieved recipe ids; the
+# cache is tied to the index snapshot, so new recipe data starts it empty.
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_PATH = os.getenv(
+    "ANSWER_CACHE_PATH", os.path.join(os.path.dirname(ingest.DATA_PATH), "cache", "answers.sqlite")
+)
+
+# Answers also depend on the prompt, so changing it must not serve old answers
+PROMPT_VERSION = hashlib.sha256(
+    f"{prompt_template}|{CONTEXT_TOKEN_BUDGET}|{FULL_CONTEXT_HITS}".encode("utf-8")
+).hexdigest()[:16]
+
+cache = None
+
+
+def get_cache():
+    # None when ANSWER_CACHE is off. Needs the index, for its snapshot key
+    global cache
+    if cache is None and ANSWER_CACHE:
+        snapshot = get_index().key or ""
+        with index_lock:
+            if cache is None:
+                cache = answer_cache.AnswerCache(
+                    ANSWER_CACHE_PATH,
+                    snapshot=snapshot,
+                    size=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+                    ttl=float(os.getenv("ANSWER_CACHE_TTL", "86400")),
+                )
+    return cache
+
+
+def warmup():
+    # Loads the index and opens the answer cache. gunicorn runs this once in
+    # the master, so the workers inherit both
+    get_index()
+    get_cache()
+
+
+def answer_key(query, search_results, model):
+    doc_ids = [doc["_id"] for doc in search_results]
+    return answer_cache.cache_key(query, doc_ids, namespace=f"{model}:{PROMPT_VERSION}")
+
+
+def cached_answer(query, search_results, model):
+    # Returns (key, answer); answer is None on a miss or without a cache
+    if get_cache() is None:
+        return None, None
+    key = answer_key(query, search_results, model)
+    return key, cache.get(key)
+
+
+def store_answer(key, answer):
+    if cache is not None and key is not None and answer:
+        cache.put(key, answer)
+
+
+async def acached_answer(query, search_results, model):
+    # cached_answer() for the async app. A hit in the process is answered on
+    # the loop; the SQLite file is read on a thread, so waiting for its lock
+    # does not hold up every other request of the worker
+    if get_cache() is None:
+        return None, None
+    key = answer_key(query, search_results, model)
+    answer = cache.get_memory(key)
+    if answer is not None:
+        cache.count("memory_hits")
+        return key, answer
+    return key, await asyncio.to_thread(cache.get_shared, key)
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else None
+
+
 def llm(prompt, model='gpt-4o-mini'):
-    response = client.chat.completions.create(
+    response = llm_client.chat(
+        model=model,
+        messages=[{"role": "user", "content": prompt}]
+    )
+
+    answer = response.choices[0].message.content
+
+    token_stats = {
+        "prompt_tokens": response.usage.prompt_tokens,
+        "completion_tokens": response.usage.completion_tokens,
+        "total_tokens": response.usage.total_tokens,
+    }
+
+    return answer, token_stats
+
+
+async def allm(prompt, model='gpt-4o-mini'):
+    response = await llm_client.achat(
         model=model,
         messages=[{"role": "user", "content": prompt}]
     )
@@ -73,6 +243,28 @@ def llm(prompt, model='gpt-4o-mini'):
 
     return answer, token_stats
 
+
+def llm_stream(prompt, model='gpt-4o-mini', token_stats=None):
+    # Yields the answer as it is generated; token_stats is filled in from the
+    # usage chunk the API sends at the end of the stream
+    stream = llm_client.chat_stream(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream_options={"include_usage": True}
+    )
+
+    if token_stats is None:
+        token_stats = {}
+    token_stats.update({"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
+
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        if chunk.usage is not None:
+            token_stats["prompt_tokens"] = chunk.usage.prompt_tokens
+            token_stats["completion_tokens"] = chunk.usage.completion_tokens
+            token_stats["total_tokens"] = chunk.usage.total_tokens
+
 evaluation_prompt_template = """
 You are an expert evaluator for a RAG system.
 Your task is to analyze the relevance of the generated answer to the given question.
@@ -94,17 +286,109 @@ and provide your evaluation in parsable JSON without using code blocks:
 """.strip()
 
 
-def evaluate_relevance(question, answer):
+# The model that judges answers, whichever model wrote them; its price is the
+# one evaluation costs are computed with
+JUDGE_MODEL = "gpt-4o-mini"
+
+
+def evaluate_relevance(question, answer, model=JUDGE_MODEL):
     prompt = evaluation_prompt_template.format(question=question, answer=answer)
-    evaluation, tokens = llm(prompt, model="gpt-4o-mini")
+    evaluation, tokens = llm(prompt, model=model)
 
     try:
         json_eval = json.loads(evaluation)
-        return json_eval, tokens
     except json.JSONDecodeError:
         result = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
         return result, tokens
 
+    if not isinstance(json_eval, dict):
+        return {"Relevance": "ERROR", "Explanation": "Judge reply is not a verdict"}, tokens
+    return json_eval, tokens
+
+
+batch_evaluation_prompt_template = """
+You are an expert evaluator for a RAG system.
+Your task is to analyze the relevance of each generated answer to its question.
+Based on the relevance of a generated answer, you will classify it
+as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+Here is the data for evaluation, one numbered question/answer pair per block:
+
+{pairs}
+
+Please analyze each answer in relation to its own question and provide your
+evaluations as a parsable JSON array without using code blocks, with one object
+per pair, in the same order:
+
+[
+  {{
+    "id": [number of the pair],
+    "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT",
+    "Explanation": "[Provide a brief explanation for your evaluation]"
+  }}
+]
+""".strip()
+
+pair_template = """
+[{id}]
+Question: {question}
+Generated Answer: {answer}
+""".strip()
+
+
+def parse_batch_evaluation(evaluation, n):
+    # Verdicts in pair order; pairs the judge skipped or mangled get UNKNOWN,
+    # and all of them get ERROR when the reply is valid JSON but no list
+    unknown = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
+
+    text = evaluation.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        return [dict(unknown) for _ in range(n)]
+
+    if isinstance(items, dict):
+        items = next((v for v in items.values() if isinstance(v, list)), [items])
+    if not isinstance(items, list):
+        return [{"Relevance": "ERROR", "Explanation": "Judge reply is not a list of verdicts"} for _ in range(n)]
+
+    verdicts = [None] * n
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        try:
+            i = int(item.get("id", position))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= i < n and verdicts[i] is None:
+            verdicts[i] = {
+                "Relevance": item.get("Relevance", "UNKNOWN"),
+                "Explanation": item.get("Explanation", "Failed to parse evaluation"),
+            }
+
+    return [v if v is not None else dict(unknown) for v in verdicts]
+
+
+def evaluate_relevance_batch(pairs, model=JUDGE_MODEL):
+    # Judges many (question, answer) pairs with one call, so the instructions
+    # are sent (and paid for) once per batch instead of once per answer.
+    # Returns the verdicts in the order of pairs and the token stats of the call
+    pairs = list(pairs)
+    if not pairs:
+        return [], {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    blocks = [
+        pair_template.format(id=i, question=question, answer=answer)
+        for i, (question, answer) in enumerate(pairs)
+    ]
+    prompt = batch_evaluation_prompt_template.format(pairs="\n\n".join(blocks))
+    evaluation, tokens = llm(prompt, model=model)
+
+    return parse_batch_evaluation(evaluation, len(pairs)), tokens
+
 
 def calculate_openai_cost(model, tokens):
     openai_cost = 0
@@ -119,48 +403,135 @@ def calculate_openai_cost(model, tokens):
     return openai_cost
 
 
-def rag(query,model='gpt-4o-mini'):
-    t0 = time()
+NO_TOKENS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
-    search_results = search(query)
-    prompt = build_prompt(query, search_results)
-    answer, token_stats = llm(prompt, model=model)
 
-    relevance, rel_token_stats = evaluate_relevance(query, answer)
-    
+def build_answer_data(query, answer, model, token_stats, t0, time_to_first_token, prompt_tokens_saved=0, cached=False, timings=None):
     t1 = time()
     took = t1 - t0
+    # Seconds per stage: retrieval (search and cache lookup), prompt building
+    # and generation. A cached answer has only the first
+    timings = timings or {}
 
-    openai_cost_rag = calculate_openai_cost(model, token_stats)
-    openai_cost_eval = calculate_openai_cost(model, rel_token_stats)
-
-    openai_cost = openai_cost_rag + openai_cost_eval
+    openai_cost = calculate_openai_cost(model, token_stats)
 
+    # Relevance is judged later by the background evaluator (evaluator.py), which
+    # fills in the relevance and eval_* fields and adds its cost to openai_cost.
+    # Cached answers are not judged again
     answer_data = {
         "answer": answer,
         "model_used": model,
         "response_time": took,
-        # "relevance": 0,
-        # "relevance_explanation": "RELEVANT",
-        # "prompt_tokens": token_stats["prompt_tokens"],
-        # "completion_tokens": token_stats["completion_tokens"],
-        # "total_tokens": token_stats["total_tokens"],
-        # "eval_prompt_tokens": 0,
-        # "eval_completion_tokens": 0,
-        # "eval_total_tokens": 0,
-        # "openai_cost": 0,
-        "relevance": relevance.get("Relevance", "UNKNOWN"),
-        "relevance_explanation": relevance.get(
-            "Explanation", "Failed to parse evaluation"
-        ),
+        "time_to_first_token": time_to_first_token,
+        "retrieval_time": timings.get("retrieval", 0.0),
+        "prompt_time": timings.get("prompt", 0.0),
+        "generation_time": timings.get("generation", 0.0),
+        "relevance": "CACHED" if cached else "PENDING",
+        "relevance_explanation": "Answer served from the cache" if cached else "Evaluation pending",
         "prompt_tokens": token_stats["prompt_tokens"],
         "completion_tokens": token_stats["completion_tokens"],
         "total_tokens": token_stats["total_tokens"],
-        "eval_prompt_tokens": rel_token_stats["prompt_tokens"],
-        "eval_completion_tokens": rel_token_stats["completion_tokens"],
-        "eval_total_tokens": rel_token_stats["total_tokens"],
+        "prompt_tokens_saved": prompt_tokens_saved,
+        "eval_prompt_tokens": 0,
+        "eval_completion_tokens": 0,
+        "eval_total_tokens": 0,
         "openai_cost": openai_cost,
+        "cached": cached,
     }
+    metrics.observe_answer(answer_data)
 
     return answer_data
 
+
+def rag(query,model='gpt-4o-mini', filters=None):
+    t0 = time()
+
+    search_results = search(query, filters=filters)
+
+    key, answer = cached_answer(query, search_results, model)
+    timings = {"retrieval": time() - t0}
+    if answer is not None:
+        return build_answer_data(query, answer, model, dict(NO_TOKENS), t0, time() - t0, cached=True, timings=timings)
+
+    t1 = time()
+    prompt, prompt_tokens_saved = build_prompt_packed(query, search_results)
+    t2 = time()
+    answer, token_stats = llm(prompt, model=model)
+    timings["prompt"] = t2 - t1
+    timings["generation"] = time() - t2
+    store_answer(key, answer)
+
+    # Without streaming the first token arrives together with the whole answer
+    time_to_first_token = time() - t0
+
+    return build_answer_data(query, answer, model, token_stats, t0, time_to_first_token, prompt_tokens_saved, timings=timings)
+
+
+def rag_stream(query, model='gpt-4o-mini', filters=None):
+    # Generator of events: "retrieved" once the recipes are found, "token" for
+    # every piece of the answer and "done" with the answer_data at the end
+    t0 = time()
+
+    search_results = search(query, filters=filters)
+    timings = {"retrieval": time() - t0}
+    yield {"type": "retrieved", "recipes": [doc["dish_name"] for doc in search_results]}
+
+    t1 = time()
+    key, answer = cached_answer(query, search_results, model)
+    timings["retrieval"] += time() - t1
+    if answer is not None:
+        time_to_first_token = time() - t0
+        yield {"type": "token", "text": answer}
+        answer_data = build_answer_data(query, answer, model, dict(NO_TOKENS), t0, time_to_first_token, cached=True, timings=timings)
+        yield {"type": "done", "answer_data": answer_data}
+        return
+
+    t1 = time()
+    prompt, prompt_tokens_saved = build_prompt_packed(query, search_results)
+    t2 = time()
+    timings["prompt"] = t2 - t1
+    token_stats = {}
+    chunks = []
+    time_to_first_token = None
+
+    for chunk in llm_stream(prompt, model=model, token_stats=token_stats):
+        if time_to_first_token is None:
+            time_to_first_token = time() - t0
+        chunks.append(chunk)
+        yield {"type": "token", "text": chunk}
+
+    if time_to_first_token is None:
+        time_to_first_token = time() - t0
+
+    # Includes the time the client took to read the stream
+    timings["generation"] = time() - t2
+
+    answer = "".join(chunks)
+    store_answer(key, answer)
+    answer_data = build_answer_data(query, answer, model, token_stats, t0, time_to_first_token, prompt_tokens_saved, timings=timings)
+    yield {"type": "done", "answer_data": answer_data}
+
+
+async def arag(query, model='gpt-4o-mini', filters=None):
+    # rag() for the async app: retrieval takes a few milliseconds and runs
+    # inline, the LLM call is awaited so the loop serves other requests meanwhile
+    t0 = time()
+
+    search_results = search(query, filters=filters)
+
+    key, answer = await acached_answer(query, search_results, model)
+    timings = {"retrieval": time() - t0}
+    if answer is not None:
+        return build_answer_data(query, answer, model, dict(NO_TOKENS), t0, time() - t0, cached=True, timings=timings)
+
+    t1 = time()
+    prompt, prompt_tokens_saved = build_prompt_packed(query, search_results)
+    t2 = time()
+    answer, token_stats = await allm(prompt, model=model)
+    timings["prompt"] = t2 - t1
+    timings["generation"] = time() - t2
+    await asyncio.to_thread(store_answer, key, answer)
+
+    time_to_first_token = time() - t0
+
+    return build_answer_data(query, answer, model, token_stats, t0, time_to_first_token, prompt_tokens_saved, timings=timings)
@@ -0,0 +1,256 @@
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+
+class RecipeIndex:
+    # Scores all text fields at once. The per-field TF-IDF matrices fitted by
+    # minsearch are stacked side by side into one matrix, and the field boosts
+    # become weights on the query vector, so a query is one sparse
+    # matrix-vector product instead of one cosine similarity per field.
+    #
+    # The stacked matrix is kept column-major: every column is the posting list
+    # of one (field, term) pair, so the product only reads the postings of the
+    # terms in the query and does not grow with the number of recipes.
+    #
+    # A row-major copy of the same matrix is kept for filtered searches: when
+    # the filters leave few candidates, only those rows are scored.
+
+    def __init__(self, text_fields, vectorizers, matrix, field_offsets, docs, rows=None, filters=None, ingredients=None, contexts=None, summaries=None, field_tokens=None, key=None):
+        self.text_fields = list(text_fields)
+        self.vectorizers = vectorizers
+        self.matrix = matrix
+        self.rows = rows if rows is not None else matrix.tocsr()
+        self.field_offsets = np.asarray(field_offsets)
+        self.docs = docs
+        self.filters = filters
+        self.ingredients = ingredients
+        # Pre-rendered full and compact prompt blocks per document, and the token
+        # count of each text field line (documents x text_fields)
+        self.contexts = contexts
+        self.summaries = summaries
+        self.field_tokens = field_tokens
+        # Content key of the snapshot the index was loaded from
+        self.key = key
+
+        # Every field is fitted with the same vectorizer parameters, so the query
+        # is tokenized once and each token is looked up in a combined vocabulary
+        # mapping it to its columns in the stacked matrix
+        first = vectorizers[self.text_fields[0]]
+        self.analyzer = first.build_analyzer()
+        self.norm = first.norm
+        self.sublinear_tf = first.sublinear_tf
+
+        self.idf = np.zeros(self.field_offsets[-1])
+        self.field_of_column = np.zeros(self.field_offsets[-1], dtype=np.int32)
+        columns = {}
+        for i, field in enumerate(self.text_fields):
+            start, end = self.field_offsets[i], self.field_offsets[i + 1]
+            vectorizer = vectorizers[field]
+            self.idf[start:end] = vectorizer.idf_[: end - start]
+            self.field_of_column[start:end] = i
+            for term, col in vectorizer.vocabulary_.items():
+                columns.setdefault(term, []).append(start + col)
+        self.columns = {term: np.array(cols, dtype=np.int64) for term, cols in columns.items()}
+
+    @classmethod
+    def from_minsearch(cls, index, docs=None, filters=None, ingredients=None, contexts=None, summaries=None, field_tokens=None):
+        # docs are the documents returned by searches; they default to the
+        # documents minsearch was fitted on
+        docs = index.docs if docs is None else docs
+        num_docs = len(docs)
+        blocks = []
+        offsets = [0]
+        for field in index.text_fields:
+            matrix = index.text_matrices[field]
+            # minsearch fits a one-row dummy matrix for fields without any terms
+            if matrix.shape[0] != num_docs:
+                matrix = sparse.csr_matrix((num_docs, matrix.shape[1]))
+            blocks.append(matrix)
+            offsets.append(offsets[-1] + matrix.shape[1])
+
+        rows = sparse.hstack(blocks, format="csr")
+
+        return cls(
+            text_fields=index.text_fields,
+            vectorizers=index.vectorizers,
+            matrix=rows.tocsc(),
+            rows=rows,
+            field_offsets=offsets,
+            docs=docs,
+            filters=filters,
+            ingredients=ingredients,
+            contexts=contexts,
+            summaries=summaries,
+            field_tokens=field_tokens,
+        )
+
+    def field_boosts(self, boost_dict=None):
+        boost_dict = boost_dict or {}
+        return np.array([boost_dict.get(field, 1) for field in self.text_fields], dtype=np.float64)
+
+    def encode(self, queries, boost_dict=None):
+        # Equivalent to hstacking vectorizer.transform(queries) over all fields and
+        # multiplying each field block by its boost, without running 11 vectorizers
+        boosts = self.field_boosts(boost_dict)
+        indptr = [0]
+        indices = []
+        data = []
+
+        for query in queries:
+            cols = []
+            counts = []
+            for term, count in Counter(self.analyzer(query)).items():
+                term_cols = self.columns.get(term)
+                if term_cols is not None:
+                    cols.append(term_cols)
+                    counts.append(np.full(len(term_cols), count, dtype=np.float64))
+
+            if cols:
+                cols = np.concatenate(cols)
+                values = np.concatenate(counts)
+                if self.sublinear_tf:
+                    values = np.log(values) + 1
+                values *= self.idf[cols]
+
+                fields = self.field_of_column[cols]
+                if self.norm == "l2":
+                    norms = np.sqrt(np.bincount(fields, weights=values**2, minlength=len(self.text_fields)))
+                    values /= norms[fields]
+                values *= boosts[fields]
+
+                order = np.argsort(cols)
+                indices.append(cols[order])
+                data.append(values[order])
+                indptr.append(indptr[-1] + len(cols))
+            else:
+                indptr.append(indptr[-1])
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        data = np.concatenate(data) if data else np.zeros(0)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(queries), self.matrix.shape[1]))
+
+    def candidates(self, filter_dict=None):
+        if not filter_dict:
+            return None
+        if self.filters is None:
+            raise ValueError("This index has no filterable fields")
+        return self.filters.candidates(filter_dict)
+
+    def score(self, query_matrix, candidates=None):
+        # (docs x columns) @ (columns x queries): one product for any number of
+        # queries, returning a sparse (docs x queries) matrix of scores
+        query_columns = query_matrix.T.tocsc()
+
+        if candidates is not None:
+            # Score only the candidate rows when they hold fewer entries than the
+            # posting lists of the query terms
+            row_cost = int(np.sum(self.rows.indptr[candidates + 1] - self.rows.indptr[candidates]))
+            cols = np.unique(query_matrix.indices)
+            column_cost = int(np.sum(self.matrix.indptr[cols + 1] - self.matrix.indptr[cols]))
+
+            if row_cost < column_cost:
+                scores = (self.rows[candidates] @ query_columns).tocsc()
+                return sparse.csc_matrix(
+                    (scores.data, candidates[scores.indices], scores.indptr),
+                    shape=(self.matrix.shape[0], query_matrix.shape[0]),
+                )
+
+        return (self.matrix @ query_columns).tocsc()
+
+    def top_k(self, doc_ids, scores, num_results):
+        if num_results <= 0:
+            return doc_ids[:0], scores[:0]
+
+        keep = scores > 0
+        doc_ids, scores = doc_ids[keep], scores[keep]
+
+        if len(scores) > num_results:
+            part = np.argpartition(-scores, num_results - 1)[:num_results]
+            doc_ids, scores = doc_ids[part], scores[part]
+
+        # Highest score first, ties broken by document order
+        order = np.lexsort((doc_ids, -scores))
+        return doc_ids[order], scores[order]
+
+    def rank(self, query, doc_ids, scores, candidates, num_results, ingredient_boost=0.0, max_missing=None):
+        # Adds the fridge coverage signal to the text scores of one query, keeps
+        # the filter candidates and returns the top ids
+        fridge = []
+        if self.ingredients is not None and (ingredient_boost or max_missing is not None):
+            fridge = self.ingredients.match(query)
+
+        if fridge and ingredient_boost:
+            fridge_ids = self.ingredients.candidates(fridge)
+            all_ids = np.union1d(doc_ids, fridge_ids)
+            combined = np.zeros(len(all_ids))
+            combined[np.searchsorted(all_ids, doc_ids)] += scores
+            _, _, coverage = self.ingredients.coverage(fridge, fridge_ids)
+            combined[np.searchsorted(all_ids, fridge_ids)] += ingredient_boost * coverage
+            doc_ids, scores = all_ids, combined
+
+        if max_missing is not None and self.ingredients is not None:
+            _, missing, _ = self.ingredients.coverage(fridge, doc_ids)
+            keep = missing <= max_missing
+            doc_ids, scores = doc_ids[keep], scores[keep]
+
+        if candidates is not None:
+            if len(candidates) == 0:
+                return doc_ids[:0]
+            pos = np.minimum(np.searchsorted(candidates, doc_ids), len(candidates) - 1)
+            keep = candidates[pos] == doc_ids
+            doc_ids, scores = doc_ids[keep], scores[keep]
+
+        top_ids, _ = self.top_k(doc_ids, scores, num_results)
+        return top_ids
+
+    def search_batch(self, queries, filter_dict=None, boost_dict=None, num_results=10, ingredient_boost=0.0, max_missing=None, batch_size=1024):
+        # Returns the top document ids for every query. Queries are encoded into
+        # one sparse matrix per batch and scored with one matrix-matrix product.
+        results = []
+        if not len(self.docs):
+            return [np.zeros(0, dtype=np.int64) for _ in queries]
+
+        candidates = self.candidates(filter_dict)
+
+        for start in range(0, len(queries), batch_size):
+            query_matrix = self.encode(queries[start : start + batch_size], boost_dict)
+            scores = self.score(query_matrix, candidates)
+
+            for j in range(query_matrix.shape[0]):
+                lo, hi = scores.indptr[j], scores.indptr[j + 1]
+                top_ids = self.rank(
+                    queries[start + j],
+                    scores.indices[lo:hi],
+                    scores.data[lo:hi],
+                    candidates,
+                    num_results,
+                    ingredient_boost=ingredient_boost,
+                    max_missing=max_missing,
+                )
+                results.append(top_ids)
+
+        return results
+
+    def search(self, query, filter_dict=None, boost_dict=None, num_results=10, output_ids=False, ingredient_boost=0.0, max_missing=None):
+        if not len(self.docs):
+            return []
+
+        candidates = self.candidates(filter_dict)
+        query_matrix = self.encode([query], boost_dict)
+        scores = self.score(query_matrix, candidates)
+
+        top_ids = self.rank(
+            query,
+            scores.indices,
+            scores.data,
+            candidates,
+            num_results,
+            ingredient_boost=ingredient_boost,
+            max_missing=max_missing,
+        )
+
+        if output_ids:
+            return [{**self.docs[i], "_id": int(i)} for i in top_ids]
+        return [self.docs[i] for i in top_ids]
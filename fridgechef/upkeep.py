@@ -0,0 +1,66 @@
+import os
+import threading
+from time import time, sleep
+
+import psycopg2
+from psycopg2 import pool
+
+import db
+
+# Database upkeep on a thread of its own, started in every process that serves
+# requests (warmup.warmup_worker), so it runs whether or not writes go through
+# write_behind.py: partitions for the coming months and the retention policy
+# (db.maintain) every DB_MAINTENANCE_INTERVAL seconds, and the dashboard
+# rollups (db.refresh_rollups) every DB_ROLLUP_INTERVAL seconds. Both take an
+# advisory lock, so one process at a time does the work and the others skip
+# it. `python db_prep.py --maintain` runs the same upkeep once, e.g. from cron.
+
+
+def maintain():
+    # New months' partitions must exist before rows for them arrive
+    result = db.maintain()
+    if result and result["dropped"]:
+        print(f"Dropped partitions past retention: {result['dropped']}")
+
+
+# (seconds between runs, function)
+jobs = [
+    (db.DB_MAINTENANCE_INTERVAL, maintain),
+    (db.DB_ROLLUP_INTERVAL, db.refresh_rollups),
+]
+
+lock = threading.Lock()
+upkeep_pid = None
+
+
+def start():
+    # Threads do not survive a fork, so every worker starts its own
+    global upkeep_pid
+    with lock:
+        if upkeep_pid == os.getpid():
+            return
+        upkeep_pid = os.getpid()
+        thread = threading.Thread(target=work, name="db-upkeep", daemon=True)
+        thread.start()
+
+
+def run_due(last_run):
+    for i, (interval, job) in enumerate(jobs):
+        if time() - last_run[i] < interval:
+            continue
+        last_run[i] = time()
+        try:
+            job()
+        except (psycopg2.Error, pool.PoolError) as e:
+            print(f"{job.__name__} failed: {e}")
+
+
+def work():
+    last_run = [0] * len(jobs)
+    while True:
+        try:
+            run_due(last_run)
+        except Exception as e:
+            # The thread must outlive any bug; the next run tries again
+            print(f"Database upkeep failed: {e!r}")
+        sleep(min(interval for interval, _ in jobs))
@@ -0,0 +1,66 @@
+import os
+
+import psycopg2
+from psycopg2 import pool
+
+import db
+import rag
+import upkeep
+import llm_client
+
+# Startup work, kept out of module imports. Under gunicorn, when_ready runs
+# warmup() once in the master, before the workers are forked, and every worker
+# runs warmup_worker() before taking requests. A single process (python app.py,
+# or the ASGI lifespan) runs both.
+#
+# readiness() reports whether a process can serve questions: GET /ready answers
+# 200 when it can and 503 when it cannot, for load balancers and rolling deploys.
+
+
+def warmup():
+    # Shared by all workers: the recipe index and the answer cache
+    rag.warmup()
+
+
+def warmup_worker():
+    # Per process: database connections, the upkeep thread and the LLM client
+    # cannot cross a fork. A database that is down does not stop the worker;
+    # /ready reports it, and upkeep retries on its schedule
+    upkeep.start()
+    try:
+        db.get_pool()
+        if db.RUN_TIMEZONE_CHECK:
+            db.check_timezone()
+    except (psycopg2.Error, pool.PoolError) as e:
+        print(f"Database not reachable at startup: {e}")
+    llm_client.get_client()
+
+
+def database_state():
+    try:
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+    except (psycopg2.Error, pool.PoolError) as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": True, "pool": db.pool_stats()}
+
+
+def readiness():
+    # Returns (ready, details)
+    index = rag.index
+    details = {
+        "index": {
+            "loaded": index is not None,
+            "snapshot": index.key if index is not None else None,
+            "recipes": len(index.docs) if index is not None else 0,
+        },
+        "answer_cache": {"enabled": rag.ANSWER_CACHE, "open": rag.cache is not None},
+        "db": database_state(),
+        "llm_client": {
+            "created": llm_client.client is not None and llm_client.client_pid == os.getpid(),
+            "base_url": llm_client.OPENAI_BASE_URL,
+        },
+    }
+    ready = details["index"]["loaded"] and details["db"]["ok"]
+    return ready, details
@@ -0,0 +1,411 @@
+import os
+import json
+import atexit
+import threading
+from time import time, sleep
+from datetime import datetime
+
+import psycopg2
+from psycopg2 import pool
+
+import db
+import metrics
+
+# Conversation, feedback and relevance writes are buffered here and written in
+# bulk (db.write_batch) by a background thread, so a request returns without
+# waiting for a commit. The buffer is flushed when it holds WRITE_BEHIND_BATCH
+# rows or its oldest row is WRITE_BEHIND_INTERVAL seconds old, and at exit.
+#
+# When Postgres is unreachable the rows stay buffered and are retried; after
+# WRITE_BEHIND_MAX_ATTEMPTS failed flushes, or at exit, they go to the spool
+# file (JSON lines). The spool is replayed into the buffer when a process
+# starts writing, and every WRITE_BEHIND_REPLAY_INTERVAL seconds while the
+# database is reachable. Rows Postgres itself rejects go to the rejected file
+# instead, to be looked at by hand.
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "100"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+WRITE_BEHIND_REPLAY_INTERVAL = float(os.getenv("WRITE_BEHIND_REPLAY_INTERVAL", "60"))
+
+# Past this many buffered rows, callers flush themselves instead of adding more
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "10000"))
+
+WRITE_BEHIND_SPOOL = os.getenv(
+    "WRITE_BEHIND_SPOOL", os.path.join(os.path.dirname(os.getenv("DATA_PATH", "../Data/RecipeData.json")), "spool", "writes.jsonl")
+)
+
+WRITE_BEHIND_REJECTED = os.getenv("WRITE_BEHIND_REJECTED", WRITE_BEHIND_SPOOL.replace(".jsonl", "") + ".rejected.jsonl")
+
+# Errors meaning the database could not be reached, as opposed to a bad row
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, pool.PoolError)
+
+# Errors caused by a row: Postgres rejected it, or the driver could not encode
+# it (e.g. a non-ASCII question for a SQL_ASCII database)
+ROW_ERRORS = (psycopg2.Error, ValueError)
+
+lock = threading.Lock()
+flush_lock = threading.Lock()
+wakeup = threading.Event()
+
+# Pending rows by kind, in arrival order; each entry is (row, attempts)
+buffer = {"conversations": [], "feedback": [], "relevance_updates": []}
+oldest = None
+
+counters = {
+    "queued": 0,
+    "written": 0,
+    "flushes": 0,
+    "failed_flushes": 0,
+    "spooled": 0,
+    "replayed": 0,
+    "rejected": 0,
+    "last_flush_rows": 0,
+    "last_flush_seconds": 0.0,
+}
+
+writer_pid = None
+
+# Whether the last flush reached the database
+database_up = True
+
+# Conversations this process has spooled and not replayed yet; their verdicts
+# follow them into the spool instead of updating nothing
+spooled_conversations = set()
+
+
+def start_writer():
+    global writer_pid
+    with lock:
+        if writer_pid == os.getpid():
+            return
+        writer_pid = os.getpid()
+        thread = threading.Thread(target=work, name="write-behind", daemon=True)
+        thread.start()
+    replay_spool()
+
+
+def pending():
+    return sum(len(rows) for rows in buffer.values())
+
+
+def add(kind, row):
+    global oldest
+    start_writer()
+
+    with lock:
+        buffer[kind].append((row, 0))
+        counters["queued"] += 1
+        if oldest is None:
+            oldest = time()
+        size = pending()
+
+    if size >= WRITE_BEHIND_MAX_ROWS:
+        # The writer is not keeping up; slow the producers down
+        flush()
+    elif size >= WRITE_BEHIND_BATCH:
+        wakeup.set()
+
+
+def save_conversation(conversation_id, question, answer_data, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(db.tz)
+    if not WRITE_BEHIND:
+        return db.save_conversation(conversation_id, question, answer_data, timestamp)
+    add("conversations", db.conversation_row(conversation_id, question, answer_data, timestamp))
+
+
+def save_feedback(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(db.tz)
+    if not WRITE_BEHIND:
+        return db.save_feedback(conversation_id, feedback, timestamp)
+    add("feedback", db.feedback_row(conversation_id, feedback, timestamp))
+
+
+def update_relevance(conversation_id, relevance, explanation, token_stats=None, openai_cost=0, evaluation_lag=None, evaluation_time=None):
+    if not WRITE_BEHIND:
+        return db.update_relevance(conversation_id, relevance, explanation, token_stats, openai_cost, evaluation_lag, evaluation_time)
+    add("relevance_updates", db.relevance_row(conversation_id, relevance, explanation, token_stats, openai_cost, evaluation_lag, evaluation_time))
+
+
+def take():
+    global oldest
+    with lock:
+        batch = {kind: rows for kind, rows in buffer.items()}
+        for kind in buffer:
+            buffer[kind] = []
+        oldest = None
+    return batch
+
+
+def put_back(batch):
+    # Failed rows go in front of anything buffered since, keeping the order
+    global oldest
+    with lock:
+        for kind, rows in batch.items():
+            buffer[kind] = rows + buffer[kind]
+        if oldest is None and pending():
+            oldest = time()
+
+
+def write(batch):
+    # Returns the relevance updates that matched no conversation
+    return db.write_batch(**{kind: [row for row, _ in rows] for kind, rows in batch.items()})
+
+
+def set_aside_unmatched(unmatched):
+    # A verdict whose conversation is waiting in the spool goes there too, and
+    # is replayed after it; any other verdict has no conversation to update.
+    # Returns how many of them there were
+    if not unmatched:
+        return 0
+    follow = [(row, 0) for row in unmatched if row[0] in spooled_conversations]
+    orphans = [(row, 0) for row in unmatched if row[0] not in spooled_conversations]
+    if orphans:
+        print(f"Write-behind: {len(orphans)} verdicts for conversations that were never written")
+    spool({"relevance_updates": follow})
+    spool({"relevance_updates": orphans}, WRITE_BEHIND_REJECTED, "rejected")
+    return len(unmatched)
+
+
+def requeue(batch):
+    # Rows not written for want of a database are retried; those that have
+    # had WRITE_BEHIND_MAX_ATTEMPTS tries go to the spool
+    global database_up
+    retry = {kind: [(row, attempts + 1) for row, attempts in rows] for kind, rows in batch.items()}
+    expired = {kind: [(row, a) for row, a in rows if a >= WRITE_BEHIND_MAX_ATTEMPTS] for kind, rows in retry.items()}
+    retry = {kind: [(row, a) for row, a in rows if a < WRITE_BEHIND_MAX_ATTEMPTS] for kind, rows in retry.items()}
+    spool(expired)
+    put_back(retry)
+    with lock:
+        counters["failed_flushes"] += 1
+    database_up = False
+
+
+def flush():
+    # Writes everything buffered. Returns the number of rows written
+    global database_up
+    with flush_lock:
+        batch = take()
+        size = sum(len(rows) for rows in batch.values())
+        if not size:
+            return 0
+
+        t0 = time()
+        try:
+            unmatched = write(batch)
+        except CONNECTION_ERRORS as e:
+            print(f"Write-behind flush of {size} rows failed: {e}")
+            requeue(batch)
+            return 0
+        except ROW_ERRORS as e:
+            # Some row was rejected (e.g. a timestamp outside every partition);
+            # write the rows one by one and set the failing ones aside
+            print(f"Write-behind flush of {size} rows failed, writing rows one by one: {e}")
+            written = write_rows(batch)
+        except Exception:
+            # Neither the database nor the rows: keep them for the next flush
+            put_back(batch)
+            raise
+        else:
+            written = size - set_aside_unmatched(unmatched)
+            database_up = True
+
+        took = time() - t0
+        with lock:
+            counters["flushes"] += 1
+            counters["written"] += written
+            counters["last_flush_rows"] = written
+            counters["last_flush_seconds"] = took
+        metrics.stages["db_write"].observe(took)
+        metrics.db_rows_written.inc(written)
+        return written
+
+
+def write_rows(batch):
+    # When the database goes away midway, the row that failed and all rows
+    # after it are requeued, not rejected
+    global database_up
+    written = 0
+    rejected = {kind: [] for kind in batch}
+    unwritten = {kind: [] for kind in batch}
+    for kind, rows in batch.items():
+        for row, attempts in rows:
+            if any(unwritten.values()):
+                unwritten[kind].append((row, attempts))
+                continue
+            try:
+                unmatched = write({kind: [(row, attempts)]})
+                written += 1 - set_aside_unmatched(unmatched)
+            except CONNECTION_ERRORS as e:
+                print(f"Write-behind flush interrupted, requeueing the remaining rows: {e}")
+                unwritten[kind].append((row, attempts))
+            except ROW_ERRORS as e:
+                print(f"Write-behind row rejected: {e}")
+                rejected[kind].append((row, attempts))
+    spool(rejected, WRITE_BEHIND_REJECTED, "rejected")
+    if any(unwritten.values()):
+        requeue(unwritten)
+    else:
+        database_up = True
+    return written
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+
+def spool(batch, path=WRITE_BEHIND_SPOOL, counter="spooled"):
+    lines = [
+        json.dumps({"kind": kind, "row": [encode(v) for v in row]})
+        for kind, rows in batch.items()
+        for row, _ in rows
+    ]
+    if not lines:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print(f"Could not write {len(lines)} rows to {path}: {e}")
+        for line in lines:
+            print(line)
+        return
+
+    with lock:
+        counters[counter] += len(lines)
+        if path == WRITE_BEHIND_SPOOL:
+            spooled_conversations.update(row[0] for row, _ in batch.get("conversations", []))
+
+
+# Spools written before migration 6 hold shorter rows: conversations without
+# the stage times and the hand-over time, verdicts without the judge time.
+# They are padded with what write_batch() expects; an unknown hand-over time
+# leaves db_write_time empty
+LEGACY_ROWS = {
+    "conversations": (17, (0.0, 0.0, 0.0, None)),
+    "relevance_updates": (8, (None,)),
+}
+
+
+def upgrade_row(kind, row):
+    length, padding = LEGACY_ROWS.get(kind, (None, ()))
+    if len(row) == length:
+        return row + padding
+    return row
+
+
+def replay_spool():
+    global oldest
+    # Takes the spool over atomically, so only one process replays it
+    replaying = f"{WRITE_BEHIND_SPOOL}.{os.getpid()}.replay"
+    try:
+        os.rename(WRITE_BEHIND_SPOOL, replaying)
+    except OSError:
+        return 0
+
+    count = 0
+    with open(replaying) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            row = upgrade_row(entry["kind"], tuple(decode(v) for v in entry["row"]))
+            with lock:
+                buffer[entry["kind"]].append((row, 0))
+                if entry["kind"] == "conversations":
+                    spooled_conversations.discard(row[0])
+                if oldest is None:
+                    oldest = time()
+            count += 1
+
+    os.remove(replaying)
+    with lock:
+        counters["replayed"] += count
+    if count:
+        print(f"Replaying {count} spooled writes")
+        wakeup.set()
+    return count
+
+
+def retry_spool():
+    # Rows spooled while this process kept running; replayed once writes
+    # succeed again
+    if database_up:
+        replay_spool()
+
+
+# Run by the writer thread besides flushing: (seconds between runs, function).
+# Partition upkeep and rollups run on their own thread, see upkeep.py
+periodic = [
+    (WRITE_BEHIND_REPLAY_INTERVAL, retry_spool),
+]
+
+
+def run_periodic(last_run):
+    for i, (interval, job) in enumerate(periodic):
+        if time() - last_run[i] < interval:
+            continue
+        last_run[i] = time()
+        try:
+            job()
+        except CONNECTION_ERRORS + (psycopg2.Error,) as e:
+            print(f"{job.__name__} failed: {e}")
+
+
+def step(last_run):
+    run_periodic(last_run)
+
+    with lock:
+        due = pending() >= WRITE_BEHIND_BATCH or (
+            oldest is not None and time() - oldest >= WRITE_BEHIND_INTERVAL
+        )
+    if due:
+        if not flush() and pending():
+            # The database is down; do not spin on it
+            sleep(WRITE_BEHIND_INTERVAL)
+
+
+def work():
+    last_run = [0] * len(periodic)
+    while True:
+        wakeup.wait(WRITE_BEHIND_INTERVAL)
+        wakeup.clear()
+        try:
+            step(last_run)
+        except Exception as e:
+            # The thread must outlive any bug; the rows stay buffered
+            print(f"Write-behind writer failed: {e!r}")
+            sleep(WRITE_BEHIND_INTERVAL)
+
+
+def stats():
+    with lock:
+        result = dict(counters)
+        result["pending"] = pending()
+    return result
+
+
+def close():
+    # Last flush at exit; whatever cannot be written is spooled
+    if writer_pid != os.getpid():
+        return
+    flush()
+    spool(take())
+
+
+atexit.register(close)
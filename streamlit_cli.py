@@ -1,5 +1,6 @@
 import streamlit as st
 import requests
+import json
 import pandas as pd
 import uuid
 import time
@@ -13,13 +14,44 @@ def get_random_question(file_path):
     df = pd.read_csv(file_path)
     return df.sample(n=1).iloc[0]["question"]
 
-def ask_question(url, question):
+def ask_question(url, question, filters=None):
     start_time = time.time()
     data = {"question": question}
+    if filters:
+        data["filters"] = filters
     response = requests.post(url, json=data)
     elapsed_time = time.time() - start_time
     return response.json(), elapsed_time
 
+def ask_question_stream(url, question, filters, result):
+    # Yields the answer text as the server-sent events arrive; the conversation
+    # id and the elapsed times are stored in result
+    start_time = time.time()
+    data = {"question": question}
+    if filters:
+        data["filters"] = filters
+
+    with requests.post(url, json=data, stream=True) as response:
+        if response.status_code != 200:
+            result["error"] = response.json().get("error", "Request failed")
+            return
+
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                payload = json.loads(line[len("data:"):].strip())
+                if event == "token":
+                    if "time_to_first_token" not in result:
+                        result["time_to_first_token"] = time.time() - start_time
+                    yield payload["text"]
+                elif event in ("meta", "done", "error"):
+                    result.update(payload)
+                event = "message"
+
+    result["elapsed_time"] = time.time() - start_time
+
 def send_feedback(url, conversation_id, feedback):
     feedback_data = {"conversation_id": conversation_id, "feedback": feedback}
     response = requests.post(f"{url}/feedback", json=feedback_data)
@@ -54,6 +86,20 @@ if st.session_state.stats['times']:
     st.sidebar.write(f"Avg response time: {sum(st.session_state.stats['times'])/len(st.session_state.stats['times']):.2f}s")
 
 use_random = st.sidebar.checkbox("Test with random question (from dataset)")
+stream_answers = st.sidebar.checkbox("Stream answers", value=True)
+
+st.sidebar.subheader("Filters")
+diet = st.sidebar.selectbox("Diet", ["Any", "Vegan", "Vegetarian"])
+cuisine = st.sidebar.selectbox("Cuisine", ["Any", "Indian", "Chinese", "Italian", "Thai"])
+max_time = st.sidebar.select_slider("Max cooking time (minutes)", options=["Any", 15, 20, 30, 45, 60], value="Any")
+
+filters = {}
+if diet != "Any":
+    filters["diet"] = diet
+if cuisine != "Any":
+    filters["cuisine"] = cuisine
+if max_time != "Any":
+    filters["cooking_time_minutes"] = [["<=", max_time]]
 
 if st.sidebar.button("Clear conversation"):
     st.session_state.conversation = []
@@ -83,7 +129,17 @@ if use_random and col2.button("Get a random question"):
 
 # Ask backend
 if question:
-    response, elapsed_time = ask_question(f"{BASE_URL}/question", question)
+    if stream_answers:
+        # Show the answer while it is generated; it moves into the conversation
+        # below on the next rerun
+        response = {}
+        st.markdown(f"**Q:** {question}")
+        st.write_stream(ask_question_stream(f"{BASE_URL}/question/stream", question, filters, response))
+        if "error" in response:
+            st.error(response["error"])
+        elapsed_time = response.get("elapsed_time", 0)
+    else:
+        response, elapsed_time = ask_question(f"{BASE_URL}/question", question, filters)
     answer = response.get("answer", "No answer provided")
     conv_id = response.get("conversation_id", st.session_state.conversation_id)
 
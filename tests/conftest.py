@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app modules import each other by name and read their settings from the
+# environment at import time, so the paths are set up before any test imports
+# them. Indexes, caches and spools go to a temporary directory.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP = tempfile.mkdtemp(prefix="fridgechef-tests-")
+
+os.environ["DATA_PATH"] = os.path.join(ROOT, "Data", "RecipeData.json")
+os.environ["INDEX_DIR"] = os.path.join(TMP, "index")
+os.environ["ANSWER_CACHE_PATH"] = os.path.join(TMP, "cache", "answers.sqlite")
+os.environ["WRITE_BEHIND_SPOOL"] = os.path.join(TMP, "spool", "writes.jsonl")
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+# Database tests run in their own schema of the Postgres configured by the
+# POSTGRES_* variables, and are skipped when there is none
+TEST_SCHEMA = "fridgechef_test"
+os.environ["PGOPTIONS"] = f"-c search_path={TEST_SCHEMA}"
+os.environ.setdefault("PGCONNECT_TIMEOUT", "3")
+
+sys.path[:0] = [os.path.join(ROOT, "fridgechef"), os.path.join(ROOT, "benchmarks")]
+
+
+@pytest.fixture
+def schema():
+    # An empty schema, not migrated yet; dropped afterwards
+    import psycopg2
+    import db
+
+    try:
+        conn = db.get_db_connection()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Postgres not reachable: {e}")
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {TEST_SCHEMA}")
+
+    yield db
+
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {TEST_SCHEMA} CASCADE")
+    conn.close()
+
+
+@pytest.fixture
+def database(schema):
+    # An empty, migrated schema
+    schema.migrate()
+    return schema
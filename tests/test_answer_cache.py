@@ -0,0 +1,66 @@
+import time
+import asyncio
+
+import answer_cache
+import rag
+
+
+def test_key_ignores_word_order_and_hit_order():
+    first = answer_cache.cache_key("What can I cook with tomato and onion?", [85, 18, 15, 21, 1], "m")
+    second = answer_cache.cache_key("what can I cook with onion, tomato", [85, 1, 15, 21, 18], "m")
+    assert first == second
+
+
+def test_key_depends_on_the_hits():
+    first = answer_cache.cache_key("tomato and onion", [85, 18, 15, 21, 1], "m")
+    second = answer_cache.cache_key("tomato and onion", [85, 18, 15, 21, 2], "m")
+    assert first != second
+
+
+def test_paraphrases_share_an_entry(tmp_path):
+    index = rag.get_index()
+    cache = answer_cache.AnswerCache(str(tmp_path / "answers.sqlite"), snapshot=index.key)
+
+    question = "What can I cook with tomato and onion?"
+    paraphrase = "what can I cook with onion, tomato"
+    cache.put(rag.answer_key(question, rag.search(question), "gpt-4o-mini"), "Shakshuka")
+
+    assert cache.get(rag.answer_key(paraphrase, rag.search(paraphrase), "gpt-4o-mini")) == "Shakshuka"
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_key_keeps_numbers():
+    hits = [85, 18, 15, 21, 1]
+    assert answer_cache.cache_key("pasta for 2", hits, "m") != answer_cache.cache_key("pasta for 6", hits, "m")
+    assert answer_cache.cache_key("under 20 minutes", hits, "m") != answer_cache.cache_key("under 45 minutes", hits, "m")
+
+
+def test_async_lookups_of_the_shared_file_leave_the_loop_free(tmp_path, monkeypatch):
+    cache = answer_cache.AnswerCache(str(tmp_path / "answers.sqlite"), snapshot=rag.get_index().key)
+    monkeypatch.setattr(rag, "cache", cache)
+    question = "What can I cook with tomato and onion?"
+    cache.put(rag.answer_key(question, rag.search(question), "gpt-4o-mini"), "Shakshuka")
+    cache.memory.clear()
+
+    # Another process holds the SQLite write lock for a while
+    get_shared = cache.get_shared
+    monkeypatch.setattr(cache, "get_shared", lambda key: time.sleep(0.3) or get_shared(key))
+
+    async def answer_while_ticking():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        answer_data = await rag.arag(question)
+        ticker.cancel()
+        return answer_data, ticks
+
+    answer_data, ticks = asyncio.run(answer_while_ticking())
+
+    assert answer_data["cached"] and answer_data["answer"] == "Shakshuka"
+    assert ticks >= 10
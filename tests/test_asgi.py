@@ -0,0 +1,39 @@
+import json
+import asyncio
+
+import pytest
+
+import asgi
+from app import app as flask_app
+
+
+def call(path, body):
+    # One request through the ASGI app; returns (status, JSON body)
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": []}
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+@pytest.mark.parametrize("path", ["/question", "/feedback"])
+@pytest.mark.parametrize("body", [b"[]", b'"x"', b"1", b"null"])
+def test_bodies_that_are_no_object_are_bad_requests(path, body):
+    status, result = call(path, body)
+    assert status == 400
+    assert result["error"] == "The request body must be a JSON object"
+
+    response = flask_app.test_client().post(path, data=body, content_type="application/json")
+    assert response.status_code == 400
+
+
+def test_invalid_json_is_a_bad_request():
+    assert call("/question", b"{")[0] == 400
+    assert call("/question", b"\xff")[0] == 400
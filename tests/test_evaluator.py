@@ -0,0 +1,81 @@
+import pytest
+
+import rag
+import evaluator
+import write_behind
+
+TOKENS = {"prompt_tokens": 100, "completion_tokens": 11, "total_tokens": 111}
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    # Verdicts the evaluator hands to the writer, instead of writing them
+    recorded = []
+    monkeypatch.setattr(write_behind, "update_relevance", lambda conversation_id, **kwargs: recorded.append((conversation_id, kwargs)))
+    return recorded
+
+
+def judge_replies(monkeypatch, reply):
+    models = []
+
+    def llm(prompt, model="gpt-4o-mini"):
+        models.append(model)
+        return reply, dict(TOKENS)
+
+    monkeypatch.setattr(rag, "llm", llm)
+    return models
+
+
+def jobs(n, model="gpt-4o-mini"):
+    return [(f"c{i}", f"question {i}", f"answer {i}", model, 0.0) for i in range(n)]
+
+
+def test_batch_tokens_add_up_to_the_call(monkeypatch, updates):
+    judge_replies(monkeypatch, '[{"id": 0, "Relevance": "RELEVANT"}, {"id": 1, "Relevance": "RELEVANT"}, {"id": 2, "Relevance": "RELEVANT"}]')
+
+    evaluator.evaluate(jobs(3))
+
+    for name, count in TOKENS.items():
+        shares = [kwargs["token_stats"][name] for _, kwargs in updates]
+        assert sum(shares) == count
+        assert max(shares) - min(shares) <= 1
+    assert sum(kwargs["openai_cost"] for _, kwargs in updates) == pytest.approx(rag.calculate_openai_cost("gpt-4o-mini", TOKENS))
+
+
+@pytest.mark.parametrize("reply", ["42", "null", "true", '"RELEVANT"'])
+def test_replies_that_are_no_list_mark_the_batch_failed(monkeypatch, updates, reply):
+    judge_replies(monkeypatch, reply)
+
+    evaluator.evaluate(jobs(3))
+
+    assert [kwargs["relevance"] for _, kwargs in updates] == ["ERROR"] * 3
+
+
+@pytest.mark.parametrize("reply", ["42", "null", '["RELEVANT"]'])
+def test_single_replies_that_are_no_verdict_are_errors(monkeypatch, updates, reply):
+    judge_replies(monkeypatch, reply)
+
+    evaluator.evaluate(jobs(1))
+
+    assert [kwargs["relevance"] for _, kwargs in updates] == ["ERROR"]
+
+
+def test_verdicts_the_judge_skipped_are_unknown():
+    verdicts = rag.parse_batch_evaluation('[{"id": 1, "Relevance": "RELEVANT"}, 7]', 2)
+    assert [v["Relevance"] for v in verdicts] == ["UNKNOWN", "RELEVANT"]
+
+
+@pytest.mark.parametrize("n", [1, 3])
+def test_judge_calls_are_priced_as_the_judge_model(monkeypatch, updates, n):
+    models = judge_replies(monkeypatch, '{"Relevance": "RELEVANT"}')
+    observed = []
+    monkeypatch.setattr(evaluator.metrics, "observe_evaluation", lambda model, *args: observed.append(model))
+
+    # Answers written by another model than the judge
+    evaluator.evaluate(jobs(n, model="gpt-4o"))
+
+    assert models == [rag.JUDGE_MODEL]
+    assert observed == [rag.JUDGE_MODEL]
+    expected = rag.calculate_openai_cost(rag.JUDGE_MODEL, TOKENS)
+    assert expected > 0
+    assert sum(kwargs["openai_cost"] for _, kwargs in updates) == pytest.approx(expected)
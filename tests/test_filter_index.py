@@ -0,0 +1,63 @@
+import pytest
+
+from filter_index import FilterIndex
+
+RECIPES = [
+    {"diet": "Vegan", "cooking_time_minutes": 20},
+    {"diet": "Vegetarian", "cooking_time_minutes": 45},
+    {"diet": "Vegan", "cooking_time_minutes": 30},
+]
+
+
+@pytest.fixture
+def filters():
+    return FilterIndex.build(RECIPES, ["diet"], ["cooking_time_minutes"])
+
+
+@pytest.mark.parametrize("conditions, expected", [
+    ([["<=", 30]], [0, 2]),
+    ([(">", 20), ("<", 50)], [1, 2]),
+    ([[">=", "30"]], [1, 2]),
+    (45, [1]),
+])
+def test_ranges(filters, conditions, expected):
+    assert filters.candidates({"cooking_time_minutes": conditions}).tolist() == expected
+
+
+@pytest.mark.parametrize("conditions", [
+    [30],
+    [["<=", None]],
+    [["<="]],
+    [["<=", 30, 40]],
+    [[["<="], 30]],
+    [["~", 30]],
+    [["<=", "soon"]],
+    [["<=", True]],
+    [["<=", [30]]],
+    [["<=", "nan"]],
+    {"<=": 30},
+    None,
+])
+def test_malformed_ranges_are_value_errors(filters, conditions):
+    with pytest.raises(ValueError):
+        filters.candidates({"cooking_time_minutes": conditions})
+
+
+def test_keywords(filters):
+    assert filters.candidates({"diet": "vegan"}).tolist() == [0, 2]
+    assert filters.candidates({"diet": ["Vegan", "Vegetarian"]}).tolist() == [0, 1, 2]
+
+
+def test_empty_keyword_lists_are_value_errors(filters):
+    with pytest.raises(ValueError, match="diet needs at least one value"):
+        filters.candidates({"diet": []})
+
+
+def test_question_with_malformed_filters_is_a_bad_request():
+    from app import app
+
+    response = app.test_client().post(
+        "/question", json={"question": "What can I cook with tomato?", "filters": {"cooking_time_minutes": [30]}}
+    )
+    assert response.status_code == 400
+    assert "operator, number" in response.get_json()["error"]
@@ -0,0 +1,36 @@
+import os
+import time
+
+import ingest
+
+
+def make_dirs(index_dir, *names, age=0):
+    for name in names:
+        path = index_dir / name
+        path.mkdir()
+        then = time.time() - age
+        os.utime(path, (then, then))
+
+
+def test_snapshots_are_pruned_per_dataset(tmp_path):
+    key = ingest.snapshot_key(ingest.DATA_PATH)
+    prefix = ingest.dataset_prefix(ingest.DATA_PATH)
+    assert key.startswith(prefix)
+
+    other = ingest.dataset_prefix("/elsewhere/corpus.json")
+    make_dirs(tmp_path, prefix + "0" * 16, age=300)
+    make_dirs(tmp_path, prefix + "1" * 16, age=200)
+    make_dirs(tmp_path, other + "2" * 16, other + "3" * 16, "0123456789abcdef", age=300)
+    make_dirs(tmp_path, f".tmp-{key}-crashed", age=ingest.SNAPSHOT_TMP_MAX_AGE + 60)
+    make_dirs(tmp_path, f".tmp-{other}4444-building", key)
+
+    ingest.prune_snapshots(key, str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        key,
+        prefix + "1" * 16,  # the previous snapshot of this dataset
+        other + "2" * 16,
+        other + "3" * 16,
+        "0123456789abcdef",
+        f".tmp-{other}4444-building",
+    ])
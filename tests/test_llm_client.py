@@ -0,0 +1,171 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import fake_openai
+import llm_client
+from llm_client import LLMError, LLMBusyError
+
+MESSAGES = [{"role": "user", "content": "What can I cook with tomato?"}]
+
+
+class ScriptedHandler(fake_openai.Handler):
+    # The fake LLM, but every request first takes the next (status, delay,
+    # headers) of the script; a 200, or an empty script, is a normal answer
+    script = []
+    seen = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        with self.lock:
+            ScriptedHandler.seen += 1
+            status, delay, headers = self.script.pop(0) if self.script else (200, 0, {})
+        time.sleep(delay)
+        if status == 200:
+            super().do_POST()
+            return
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_json(status, {"error": {"message": f"Scripted {status}", "type": "server_error"}}, headers)
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A client that gave up on a slow response has closed the socket
+        pass
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    ScriptedHandler.script = []
+    ScriptedHandler.seen = 0
+    server = QuietServer(("127.0.0.1", 0), ScriptedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(llm_client, "OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(llm_client, "client", None)
+    monkeypatch.setattr(llm_client, "LLM_MAX_RETRIES", 3)
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_MAX", 0.05)
+    monkeypatch.setattr(llm_client, "slots", threading.BoundedSemaphore(llm_client.LLM_MAX_CONCURRENCY))
+    yield ScriptedHandler
+    server.shutdown()
+    server.server_close()
+
+
+def recorded_sleeps(monkeypatch):
+    # Backoff delays chat() asked for, without waiting for them
+    sleeps = []
+    monkeypatch.setattr(llm_client, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_retries_rate_limits_and_server_errors(llm):
+    llm.script = [(429, 0, {}), (500, 0, {}), (503, 0, {})]
+
+    response = llm_client.chat(MESSAGES)
+
+    assert response.choices[0].message.content == fake_openai.ANSWER
+    assert llm.seen == 4
+
+
+def test_gives_up_after_the_last_retry(llm):
+    llm.script = [(500, 0, {})] * 10
+
+    with pytest.raises(LLMError, match="LLM call failed"):
+        llm_client.chat(MESSAGES)
+    assert llm.seen == llm_client.LLM_MAX_RETRIES + 1
+
+
+def test_client_errors_are_not_retried(llm):
+    llm.script = [(400, 0, {})]
+
+    with pytest.raises(Exception) as raised:
+        llm_client.chat(MESSAGES)
+    assert not isinstance(raised.value, LLMError)
+    assert llm.seen == 1
+
+
+def test_backoff_waits_at_least_retry_after(llm, monkeypatch):
+    sleeps = recorded_sleeps(monkeypatch)
+    llm.script = [(429, 0, {"Retry-After": "3"}), (429, 0, {"Retry-After": "soon"})]
+
+    llm_client.chat(MESSAGES, deadline=30)
+
+    assert sleeps[0] >= 3
+    assert sleeps[1] <= llm_client.LLM_BACKOFF_MAX
+    assert llm.seen == 3
+
+
+def test_retry_after_past_the_deadline_fails_at_once(llm, monkeypatch):
+    sleeps = recorded_sleeps(monkeypatch)
+    llm.script = [(429, 0, {"Retry-After": "30"})]
+
+    with pytest.raises(LLMError):
+        llm_client.chat(MESSAGES, deadline=5)
+    assert sleeps == []
+    assert llm.seen == 1
+
+
+def test_slow_responses_end_at_the_deadline(llm):
+    llm.script = [(200, 2, {})] * 10
+
+    t0 = time.time()
+    with pytest.raises(LLMError):
+        llm_client.chat(MESSAGES, deadline=0.5)
+    assert time.time() - t0 < 1.5
+
+
+def test_slow_attempt_is_retried_within_the_deadline(llm, monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_TIMEOUT", 0.3)
+    llm.script = [(200, 2, {})]
+
+    response = llm_client.chat(MESSAGES, deadline=5)
+
+    assert response.choices[0].message.content == fake_openai.ANSWER
+    assert llm.seen == 2
+
+
+def test_calls_past_the_concurrency_cap_are_busy(llm, monkeypatch):
+    monkeypatch.setattr(llm_client, "slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(llm_client, "LLM_QUEUE_TIMEOUT", 0.1)
+    llm.script = [(200, 0.5, {})]
+
+    first = threading.Thread(target=llm_client.chat, args=(MESSAGES,))
+    first.start()
+    while llm.seen == 0:
+        time.sleep(0.01)
+    with pytest.raises(LLMBusyError):
+        llm_client.chat(MESSAGES)
+    first.join()
+
+    # The slot is free again, also after a failed call
+    llm.script = [(500, 0, {})] * (llm_client.LLM_MAX_RETRIES + 1)
+    with pytest.raises(LLMError):
+        llm_client.chat(MESSAGES)
+    assert llm_client.chat(MESSAGES).choices[0].message.content == fake_openai.ANSWER
+
+
+def test_async_calls_retry_and_respect_the_cap(llm, monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_ASYNC_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(llm_client, "LLM_QUEUE_TIMEOUT", 0.1)
+    llm.script = [(429, 0, {}), (200, 0.5, {})]
+
+    async def calls():
+        return await asyncio.gather(llm_client.achat(MESSAGES), llm_client.achat(MESSAGES), return_exceptions=True)
+
+    answered, busy = asyncio.run(calls())
+
+    assert answered.choices[0].message.content == fake_openai.ANSWER
+    assert isinstance(busy, LLMBusyError)
+    assert llm.seen == 2
+
+
+def test_judge_prompts_get_verdicts(llm):
+    response = llm_client.chat([{"role": "user", "content": 'Answer with {"Relevance": ...}'}])
+    assert json.loads(response.choices[0].message.content)["Relevance"] == "RELEVANT"
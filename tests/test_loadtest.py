@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_spawned_run_needs_no_database():
+    # A short self-contained run, with Postgres pointed at a closed port. The
+    # metric files of an app already running on the host are left alone
+    live_metrics = tempfile.mkdtemp(prefix="fridgechef-metrics-")
+    open(os.path.join(live_metrics, "counter_1.db"), "w").close()
+    env = dict(
+        os.environ, POSTGRES_HOST="127.0.0.1", PGPORT=str(free_port()), GUNICORN_WORKERS="2",
+        PROMETHEUS_MULTIPROC_DIR=live_metrics,
+    )
+    completed = subprocess.run(
+        [
+            sys.executable, os.path.join(ROOT, "benchmarks", "loadtest.py"),
+            "--spawn", "--no-db", "--requests", "20", "--concurrency", "4", "--settle", "0",
+            "--app-port", str(free_port()), "--llm-port", str(free_port()),
+            "--llm-latency", "0.01", "--llm-latency-sigma", "0", "--startup-timeout", "60",
+            "--max-error-rate", "0",
+        ],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=180,
+    )
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    assert result["requests"] == 20
+    assert result["errors_by_kind"] == {}
+    assert os.listdir(live_metrics) == ["counter_1.db"]
+
+
+def test_streaming_is_rejected_for_the_async_app():
+    completed = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "loadtest.py"), "--spawn", "--app-module", "asgi:app", "--stream"],
+        cwd=ROOT, capture_output=True, text=True, timeout=60,
+    )
+    assert completed.returncode == 2
+    assert "/question/stream" in completed.stderr
@@ -0,0 +1,59 @@
+import uuid
+from time import time
+from datetime import datetime, timedelta, timezone
+
+import db
+from test_rollups import ANSWER_DATA
+
+MIGRATIONS = list(db.MIGRATIONS)
+
+
+def migrate_to(db, monkeypatch, version):
+    monkeypatch.setattr(db, "MIGRATIONS", [m for m in MIGRATIONS if m[0] <= version])
+    return db.migrate()
+
+
+def fetch(db, query, params=()):
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+
+
+def test_history_is_rolled_up_before_and_after_the_stage_columns(schema, monkeypatch):
+    db = schema
+    two_hours_ago = datetime.now(timezone.utc) - timedelta(hours=2)
+    migrate_to(db, monkeypatch, 4)
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            # A conversation as written before migration 6
+            cur.execute(
+                """
+                INSERT INTO conversations (id, question, answer, model_used, response_time, relevance,
+                    relevance_explanation, prompt_tokens, completion_tokens, total_tokens,
+                    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
+                VALUES (%s, 'tomato?', 'Shakshuka', 'gpt-4o-mini', 1.0, 'PENDING', '', 100, 20, 120, 0, 0, 0, 0.01, %s)
+                """,
+                (str(uuid.uuid4()), two_hours_ago),
+            )
+        conn.commit()
+
+    assert migrate_to(db, monkeypatch, 5) == [5]
+    latency = "SELECT conversations FROM metrics_latency WHERE resolution = 'hour'"
+    assert fetch(db, latency) == [(1,)]
+
+    assert migrate_to(db, monkeypatch, MIGRATIONS[-1][0]) == [m[0] for m in MIGRATIONS if m[0] > 5]
+    assert fetch(db, "SELECT conversations, retrieval_time_avg FROM metrics_latency WHERE resolution = 'hour'") == [(1, 0.0)]
+
+
+def test_write_time_is_measured_on_the_app_clock(database, monkeypatch):
+    db = database
+    # The app's clock an hour behind the database's
+    monkeypatch.setattr(db, "time", lambda: time() - 3600)
+    row = db.conversation_row(str(uuid.uuid4()), "tomato?", ANSWER_DATA, datetime.now(timezone.utc))
+    row = row[:-1] + (row[-1] - 2,)
+
+    db.write_batch(conversations=[row])
+
+    [(write_time,)] = fetch(db, "SELECT db_write_time FROM conversations")
+    assert 2 <= write_time < 3
@@ -0,0 +1,76 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+ANSWER_DATA = {
+    "answer": "Shakshuka",
+    "model_used": "gpt-4o-mini",
+    "response_time": 1.0,
+    "relevance": "PENDING",
+    "relevance_explanation": "",
+    "prompt_tokens": 100,
+    "completion_tokens": 20,
+    "total_tokens": 120,
+    "eval_prompt_tokens": 0,
+    "eval_completion_tokens": 0,
+    "eval_total_tokens": 0,
+    "openai_cost": 0.01,
+}
+
+
+def rollup(db, resolution, bucket):
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT relevance, conversations FROM metrics_conversations
+                WHERE resolution = %s AND bucket = date_trunc(%s, %s::timestamptz, 'UTC')
+                ORDER BY relevance
+                """,
+                (resolution, resolution, bucket),
+            )
+            return cur.fetchall()
+
+
+@pytest.fixture
+def two_hours_ago():
+    return datetime.now(timezone.utc) - timedelta(hours=2)
+
+
+def test_rows_written_late_are_rolled_up(database, two_hours_ago):
+    db = database
+    db.refresh_rollups()
+
+    # A spooled row replayed after the buckets of its time were rolled up
+    db.save_conversation(str(uuid.uuid4()), "tomato?", ANSWER_DATA, two_hours_ago)
+    db.refresh_rollups()
+
+    assert rollup(db, "minute", two_hours_ago) == [("PENDING", 1)]
+    assert rollup(db, "hour", two_hours_ago) == [("PENDING", 1)]
+
+
+def test_late_verdicts_are_rolled_up(database, two_hours_ago):
+    db = database
+    conversation_id = str(uuid.uuid4())
+    db.save_conversation(conversation_id, "tomato?", ANSWER_DATA, two_hours_ago)
+    db.save_conversation(str(uuid.uuid4()), "onion?", ANSWER_DATA, two_hours_ago)
+    db.refresh_rollups()
+    assert rollup(db, "minute", two_hours_ago) == [("PENDING", 2)]
+
+    db.update_relevance(conversation_id, "RELEVANT", "Uses tomato")
+    db.refresh_rollups()
+
+    assert rollup(db, "minute", two_hours_ago) == [("PENDING", 1), ("RELEVANT", 1)]
+    assert rollup(db, "hour", two_hours_ago) == [("PENDING", 1), ("RELEVANT", 1)]
+
+
+def test_dirty_marks_are_consumed(database, two_hours_ago):
+    db = database
+    db.save_conversation(str(uuid.uuid4()), "tomato?", ANSWER_DATA, two_hours_ago)
+    db.refresh_rollups()
+
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM metrics_dirty")
+            assert cur.fetchone()[0] == 0
@@ -0,0 +1,35 @@
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+
+import upkeep
+from test_rollups import ANSWER_DATA, rollup
+
+
+def test_rollups_are_refreshed_without_write_behind(database):
+    db = database
+    now = datetime.now(timezone.utc)
+    # Written straight to the database, as with WRITE_BEHIND=0
+    db.save_conversation(str(uuid.uuid4()), "tomato?", ANSWER_DATA, now)
+
+    upkeep.run_due([0] * len(upkeep.jobs))
+
+    assert rollup(db, "minute", now) == [("PENDING", 1)]
+
+
+def test_failed_jobs_wait_for_their_next_run(monkeypatch):
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise psycopg2.OperationalError("down")
+
+    monkeypatch.setattr(upkeep, "jobs", [(60, failing)])
+    last_run = [0]
+
+    upkeep.run_due(last_run)
+    upkeep.run_due(last_run)
+
+    assert calls == [1]
+    assert last_run[0] > 0
@@ -0,0 +1,158 @@
+import os
+import uuid
+import threading
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+
+import write_behind
+from test_rollups import ANSWER_DATA
+
+
+@pytest.fixture(autouse=True)
+def empty_buffer():
+    write_behind.take()
+    for name in write_behind.counters:
+        write_behind.counters[name] = 0
+    write_behind.database_up = True
+    write_behind.spooled_conversations.clear()
+    for path in (write_behind.WRITE_BEHIND_SPOOL, write_behind.WRITE_BEHIND_REJECTED):
+        if os.path.exists(path):
+            os.remove(path)
+    yield
+    write_behind.take()
+
+
+def buffer_rows(*rows):
+    for row in rows:
+        write_behind.buffer["conversations"].append((row, 0))
+
+
+def failing_write(*errors):
+    # A write() that fails with the given errors in turn; None means success
+    errors = list(errors)
+    written = []
+
+    def write(batch):
+        error = errors.pop(0) if errors else None
+        if error is not None:
+            raise error
+        written.extend(row for rows in batch.values() for row, _ in rows)
+
+    write.written = written
+    return write
+
+
+def test_rejected_rows_are_set_aside(monkeypatch):
+    write = failing_write(psycopg2.DataError("bad batch"), None, psycopg2.DataError("bad row"), None)
+    monkeypatch.setattr(write_behind, "write", write)
+    buffer_rows(("a",), ("b",), ("c",))
+
+    assert write_behind.flush() == 2
+    assert write.written == [("a",), ("c",)]
+    assert write_behind.stats()["rejected"] == 1
+    assert write_behind.pending() == 0
+
+
+def test_rows_are_requeued_when_the_connection_drops_midway(monkeypatch):
+    write = failing_write(psycopg2.DataError("bad batch"), None, psycopg2.OperationalError("gone"))
+    monkeypatch.setattr(write_behind, "write", write)
+    buffer_rows(("a",), ("b",), ("c",))
+
+    assert write_behind.flush() == 1
+    assert write_behind.stats()["rejected"] == 0
+    assert not os.path.exists(write_behind.WRITE_BEHIND_REJECTED)
+    assert write_behind.buffer["conversations"] == [(("b",), 1), (("c",), 1)]
+    assert not write_behind.database_up
+
+
+def test_unexpected_errors_keep_the_rows(monkeypatch):
+    monkeypatch.setattr(write_behind, "write", failing_write(RuntimeError("bug")))
+    buffer_rows(("a",))
+
+    with pytest.raises(RuntimeError):
+        write_behind.flush()
+    assert write_behind.buffer["conversations"] == [(("a",), 0)]
+
+
+def test_spool_is_retried_once_the_database_is_back():
+    write_behind.spool({"conversations": [(("a",), 5)]})
+
+    write_behind.database_up = False
+    write_behind.retry_spool()
+    assert write_behind.pending() == 0
+
+    write_behind.database_up = True
+    write_behind.retry_spool()
+    assert write_behind.buffer["conversations"] == [(("a",), 0)]
+
+
+def test_writer_survives_unexpected_errors(monkeypatch):
+    calls = []
+    survived = threading.Event()
+
+    def step(last_run):
+        calls.append(last_run)
+        if len(calls) == 1:
+            raise RuntimeError("bug")
+        survived.set()
+        threading.Event().wait()  # parks the daemon thread
+
+    monkeypatch.setattr(write_behind, "step", step)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_INTERVAL", 0.01)
+    thread = threading.Thread(target=write_behind.work, daemon=True)
+    thread.start()
+
+    assert survived.wait(5)
+
+
+def test_spooled_rows_from_before_the_stage_columns_are_replayed(database):
+    conversation_id = str(uuid.uuid4())
+    timestamp = datetime.now(timezone.utc)
+    row = database.conversation_row(conversation_id, "tomato?", ANSWER_DATA, timestamp)[:17]
+    verdict = database.relevance_row(conversation_id, "RELEVANT", "Uses tomato")[:8]
+    write_behind.spool({"conversations": [(row, 5)], "relevance_updates": [(verdict, 5)]})
+
+    assert write_behind.replay_spool() == 2
+    assert write_behind.flush() == 2
+
+    with database.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT relevance, retrieval_time, generation_time, db_write_time, evaluation_time FROM conversations WHERE id = %s",
+                (conversation_id,),
+            )
+            assert cur.fetchone() == ("RELEVANT", 0.0, 0.0, None, None)
+
+
+def relevance(db, conversation_id):
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT relevance FROM conversations WHERE id = %s", (conversation_id,))
+            return cur.fetchall()
+
+
+def test_verdicts_follow_their_spooled_conversation(database):
+    conversation_id = str(uuid.uuid4())
+    row = database.conversation_row(conversation_id, "tomato?", ANSWER_DATA, datetime.now(timezone.utc))
+    # The conversation ran out of attempts while the database was down
+    write_behind.requeue({"conversations": [(row, write_behind.WRITE_BEHIND_MAX_ATTEMPTS - 1)]})
+    assert write_behind.pending() == 0
+
+    # Its verdict arrives once the database is back, before the spool is replayed
+    write_behind.buffer["relevance_updates"].append((database.relevance_row(conversation_id, "RELEVANT", "Uses tomato"), 0))
+    assert write_behind.flush() == 0
+    assert relevance(database, conversation_id) == []
+
+    assert write_behind.replay_spool() == 2
+    assert write_behind.flush() == 2
+    assert relevance(database, conversation_id) == [("RELEVANT",)]
+
+
+def test_verdicts_without_a_conversation_are_rejected(database):
+    write_behind.buffer["relevance_updates"].append((database.relevance_row("missing", "RELEVANT", ""), 0))
+
+    assert write_behind.flush() == 0
+    assert write_behind.stats()["rejected"] == 1
+    assert not os.path.exists(write_behind.WRITE_BEHIND_SPOOL)